@@ -1,4 +1,12 @@
 
 from .sdk import TransactionStatus, TokenSDK, create_keyfile
+from .address import Address, canonical_address
+from .dispatcher import Dispatcher
+from .checkpoint import FileCheckpoint, SqliteCheckpoint
+from .cache import Cache
+from .providers import BroadcastProvider, HedgedProvider, RateLimitedProvider
+from .send_queue import NonceAuditor, SendQueue
+from .wallets import Wallet, load_wallets
+from .sharding import ShardedTokenMonitor
 from .exceptions import SdkConfigurationError, SdkNotConfiguredError
 from .version import __version__
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*
+
+# Copyright (C) 2017 Kin Foundation
+
+"""Canonical addresses.
+
+Addresses given as hex strings are validated once (including the checksum of mixed case addresses), and converted
+to a single interned :class:`Address` instance per address, so that addresses compare and hash as raw bytes.
+"""
+
+from binascii import hexlify, unhexlify
+from collections import OrderedDict
+import threading
+import weakref
+
+from eth_utils import (
+    to_checksum_address,
+    to_normalized_address,
+)
+from web3.utils.validation import validate_address
+
+from .compat import (
+    binary_types,
+    string_types,
+)
+
+
+# the number of recently converted address strings remembered, to skip validating them again.
+ADDRESS_CACHE_SIZE = 100000
+
+_lock = threading.Lock()
+_interned = weakref.WeakValueDictionary()  # raw bytes -> Address
+_converted = OrderedDict()  # address string -> Address, least recently used first
+
+
+class Address(object):
+    """A canonical address: 20 raw bytes. There is a single instance per address, compared and hashed as bytes.
+    Use :func:`canonical_address` to convert hex strings.
+    """
+    __slots__ = ('raw', '_checksum', '__weakref__')
+
+    def __new__(cls, raw):
+        """Get the address of the given raw bytes.
+
+        :param bytes raw: the 20 address bytes.
+
+        :raises: ValueError: if the address is not 20 bytes long.
+        """
+        if len(raw) != 20:
+            raise ValueError('address must be 20 bytes long')
+        with _lock:
+            address = _interned.get(raw)
+            if address is None:
+                address = object.__new__(cls)
+                address.raw = raw
+                address._checksum = None
+                _interned[raw] = address
+        return address
+
+    @property
+    def hex(self):
+        """The lowercase hex form of the address."""
+        return '0x' + hexlify(self.raw).decode('ascii')
+
+    @property
+    def checksum(self):
+        """The checksum hex form of the address, computed once."""
+        if self._checksum is None:
+            self._checksum = to_checksum_address(self.hex)
+        return self._checksum
+
+    def __eq__(self, other):
+        return self is other or isinstance(other, Address) and self.raw == other.raw
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.raw)
+
+    def __str__(self):
+        return self.checksum
+
+    def __repr__(self):
+        return 'Address({})'.format(self.checksum)
+
+    def __reduce__(self):
+        return Address, (self.raw,)
+
+
+def canonical_address(value):
+    """Convert an address to its canonical form. Converting the same string again skips the validation.
+
+    :param value: a hex address string (with or without the `0x` prefix), 20 raw address bytes,
+        or an :class:`Address`. On python 2, where `bytes` is `str`, raw bytes must be given as a `bytearray`
+        (or converted with :class:`Address`): a `str` is always taken as a hex address.
+
+    :returns: the canonical address.
+    :rtype: :class:`Address`
+
+    :raises: ValueError: if the address has a wrong format or a wrong checksum.
+    """
+    if isinstance(value, Address):
+        return value
+    if isinstance(value, binary_types) and len(value) == 20:  # raw address bytes
+        return Address(bytes(value))
+    with _lock:
+        address = _converted.pop(value, None)
+        if address is not None:
+            _converted[value] = address  # move to the end, python 2 OrderedDict has no move_to_end()
+            return address
+    # web3 checks the checksum of a mixed case address in its prefixed form only
+    prefixed = value
+    if isinstance(value, string_types) and not value.startswith(('0x', '0X')):
+        prefixed = '0x' + value
+    validate_address(prefixed)
+    address = Address(unhexlify(to_normalized_address(value)[2:]))
+    with _lock:
+        _converted[value] = address
+        if len(_converted) > ADDRESS_CACHE_SIZE:
+            _converted.popitem(last=False)
+    return address
+
+
+def address_bytes(value):
+    """Get the raw bytes of a hex address returned by the node, without validating it.
+    Used in hot loops, to compare addresses as bytes.
+
+    :param str value: a hex address string, or None.
+
+    :returns: the 20 address bytes, or None.
+    :rtype: bytes
+    """
+    return unhexlify(value[2:]) if value else None
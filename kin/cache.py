@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*
+
+# Copyright (C) 2017 Kin Foundation
+
+from collections import OrderedDict
+import threading
+from time import time
+
+
+DEFAULT_CACHE_SIZE = 10000
+DEFAULT_CACHE_TTL = 5  # seconds
+
+
+class Cache(object):
+    """A size-bounded read-through cache, evicting the least recently used values.
+
+    Values expire after `ttl` seconds. With `per_block=True`, values also expire when a new block is seen, which
+    the SDK reports while monitoring transactions. Static values, such as the token decimals, never expire.
+    Values can be invalidated explicitly, e.g. when a transaction changes the balance of an address.
+    """
+
+    def __init__(self, size=DEFAULT_CACHE_SIZE, ttl=DEFAULT_CACHE_TTL, per_block=False):
+        """Create a new cache.
+
+        :param int size: the maximal number of cached values.
+
+        :param float ttl: the number of seconds a value is valid for. If None, values expire only when invalidated
+            or when a new block is seen.
+
+        :param bool per_block: whether values expire when a new block is seen.
+
+        :raises: ValueError: if some of the parameters are invalid.
+        """
+        if size < 1:
+            raise ValueError('cache size must be positive')
+        if ttl is not None and ttl <= 0:
+            raise ValueError('cache ttl must be positive')
+        self.size = size
+        self.ttl = ttl
+        self.per_block = per_block
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (value, expiry time, block number)
+        self._block_number = 0
+        self._epoch = 0  # incremented on every invalidation, to avoid caching values loaded meanwhile
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key, load_fn, static=False):
+        """Get a value from the cache, loading it on a miss.
+
+        :param key: the value key.
+
+        :param load_fn: a function with the signature `func()` returning the value.
+
+        :param bool static: whether the value never changes, and so never expires.
+
+        :returns: the value.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry and self._is_fresh(entry):
+                self._entries[key] = entry  # move to the end, python 2 OrderedDict has no move_to_end()
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            epoch = self._epoch
+            block_number = self._block_number
+
+        value = load_fn()
+
+        with self._lock:
+            if epoch == self._epoch:
+                if static:
+                    self._entries[key] = (value, None, None)
+                else:
+                    self._entries[key] = (value, time() + self.ttl if self.ttl else None, block_number)
+                if len(self._entries) > self.size:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+        return value
+
+    def invalidate(self, *keys):
+        """Remove values from the cache.
+
+        :param keys: the keys of the values to remove.
+        """
+        with self._lock:
+            self._epoch += 1
+            for key in keys:
+                if self._entries.pop(key, None):
+                    self.invalidations += 1
+
+    def new_block(self, block_number):
+        """Report a new block. With `per_block=True`, all the non static values cached before it expire.
+
+        :param int block_number: the new block number.
+        """
+        with self._lock:
+            if block_number > self._block_number:
+                self._block_number = block_number
+                if self.per_block:
+                    self._epoch += 1
+
+    def clear(self):
+        with self._lock:
+            self._epoch += 1
+            self._entries.clear()
+
+    def stats(self):
+        """Get the cache counters.
+
+        :returns: the number of hits, misses, evictions (of least recently used values) and invalidations,
+            and the number of cached values.
+        :rtype: dict
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'size': len(self._entries),
+            }
+
+    def _is_fresh(self, entry):
+        _, expiry, block_number = entry
+        if expiry is not None and time() >= expiry:
+            return False
+        if self.per_block and block_number is not None and block_number < self._block_number:
+            return False
+        return True
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*
+
+# Copyright (C) 2017 Kin Foundation
+
+import json
+import os
+import sqlite3
+import threading
+
+
+class FileCheckpoint(object):
+    """Stores the monitoring checkpoint (the last processed block) in a JSON file.
+    The file is replaced atomically on every save, so a crash never leaves a partially written checkpoint.
+    """
+
+    def __init__(self, path):
+        """Create a new file checkpoint.
+
+        :param str path: the checkpoint file path.
+        """
+        self.path = path
+
+    def load(self):
+        """Load the checkpoint.
+
+        :returns: the number and hash of the last processed block, or None if there is no checkpoint.
+        :rtype: tuple(int, str)
+        """
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, 'r') as f:
+            checkpoint = json.load(f)
+        return checkpoint['block_number'], checkpoint['block_hash']
+
+    def save(self, block_number, block_hash):
+        """Save the checkpoint.
+
+        :param int block_number: the number of the last processed block.
+
+        :param str block_hash: the hash of the last processed block.
+        """
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'block_number': block_number, 'block_hash': block_hash}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.path)
+
+
+class SqliteCheckpoint(object):
+    """Stores monitoring checkpoints (the last processed block) in a SQLite database.
+    Several named checkpoints can share the same database.
+    """
+
+    def __init__(self, path, name='default'):
+        """Create a new SQLite checkpoint.
+
+        :param str path: the database file path.
+
+        :param str name: the checkpoint name.
+        """
+        self.path = path
+        self.name = name
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS checkpoints '
+                             '(name TEXT PRIMARY KEY, block_number INTEGER NOT NULL, block_hash TEXT NOT NULL)')
+
+    def load(self):
+        """Load the checkpoint.
+
+        :returns: the number and hash of the last processed block, or None if there is no checkpoint.
+        :rtype: tuple(int, str)
+        """
+        with self._lock:
+            row = self._db.execute('SELECT block_number, block_hash FROM checkpoints WHERE name = ?',
+                                   (self.name,)).fetchone()
+        return tuple(row) if row else None
+
+    def save(self, block_number, block_hash):
+        """Save the checkpoint.
+
+        :param int block_number: the number of the last processed block.
+
+        :param str block_hash: the hash of the last processed block.
+        """
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO checkpoints (name, block_number, block_hash) VALUES (?, ?, ?)',
+                             (self.name, block_number, block_hash))
+
+    def close(self):
+        self._db.close()
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*
+
+# Copyright (C) 2017 Kin Foundation
+
+"""Python 2/3 compatibility helpers."""
+
+import sys
+
+if sys.version_info.major >= 3:
+    string_types = (str,)
+    integer_types = (int,)
+    binary_types = (bytes, bytearray)
+else:
+    string_types = (basestring,)  # noqa: F821
+    integer_types = (int, long)  # noqa: F821
+    binary_types = (bytearray,)  # bytes is str, which is text as well
+
+try:
+    import queue  # noqa: F401
+except ImportError:  # python 2
+    import Queue as queue  # noqa: F401
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*
+
+# Copyright (C) 2017 Kin Foundation
+
+import threading
+
+from .compat import queue
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# default dispatcher configuration.
+DEFAULT_NUM_WORKERS = 4
+DEFAULT_QUEUE_SIZE = 10000
+CLOSED_CHECK_INTERVAL = 0.5  # seconds, how often a blocked submitter checks if the dispatcher was closed
+
+_STOP = object()
+
+
+class Dispatcher(object):
+    """Runs monitoring callbacks on a pool of worker threads, decoupling them from block ingestion.
+
+    Callbacks are queued in bounded queues, one per worker. Callbacks submitted with the same key (the monitored
+    address) always go to the same worker, so they are called in the order of submission. When a queue is full,
+    the overflow policy decides what happens:
+        - `DROP_NEWEST` (the default): the submitted callback is dropped, so that ingestion never waits for the
+          callbacks.
+        - `DROP_OLDEST`: the oldest queued callback is dropped to make room for the submitted one.
+        - `BLOCK`: the submitter waits for a free slot. Nothing is lost, but a single slow callback stalls the
+          ingestion once its queue is full.
+    Callbacks submitted after the dispatcher is closed are dropped too. Dropped callbacks are counted,
+    see :meth:`stats`, and are not called again.
+    """
+    BLOCK = 'block'
+    DROP_NEWEST = 'drop_newest'
+    DROP_OLDEST = 'drop_oldest'
+
+    def __init__(self, num_workers=DEFAULT_NUM_WORKERS, queue_size=DEFAULT_QUEUE_SIZE, overflow_policy=DROP_NEWEST):
+        """Create a new dispatcher and start its workers.
+
+        :param int num_workers: the number of callback worker threads.
+
+        :param int queue_size: the total number of callbacks that can be queued, divided between the workers.
+
+        :param str overflow_policy: what to do when a queue is full: `DROP_NEWEST`, `DROP_OLDEST` or `BLOCK`.
+
+        :raises: ValueError: if some of the parameters are invalid.
+        """
+        if num_workers < 1:
+            raise ValueError('number of workers must be positive')
+        if queue_size < num_workers:
+            raise ValueError('queue size must not be less than the number of workers')
+        if overflow_policy not in (self.BLOCK, self.DROP_NEWEST, self.DROP_OLDEST):
+            raise ValueError('invalid overflow policy: {}'.format(overflow_policy))
+        self.overflow_policy = overflow_policy
+
+        self._lock = threading.Lock()
+        self._closed = False
+        self._submitted = 0
+        self._delivered = 0
+        self._dropped = 0
+        self._failed = 0
+
+        self._queues = [queue.Queue(queue_size // num_workers) for _ in range(num_workers)]
+        self._threads = []
+        for i, q in enumerate(self._queues):
+            thread = threading.Thread(target=self._work, args=(q,), name='kin-dispatcher-{}'.format(i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, key, callback_fn, *args):
+        """Queue a callback call.
+
+        :param key: the ordering key. Calls with equal keys are made in the order of submission.
+
+        :param callback_fn: the callback function.
+
+        :param args: the callback arguments.
+
+        :returns: False if the call was dropped, True otherwise.
+        :rtype: bool
+        """
+        q = self._queues[hash(key) % len(self._queues)]
+        item = (callback_fn, args)
+        with self._lock:
+            self._submitted += 1
+        if self._closed:
+            logger.debug('dispatcher closed, dropping a callback')
+            self._count_dropped()
+            return False
+
+        if self.overflow_policy == self.BLOCK:
+            # the workers stop once closed, do not wait for them forever
+            while True:
+                try:
+                    q.put(item, timeout=CLOSED_CHECK_INTERVAL)
+                    return True
+                except queue.Full:
+                    if self._closed:
+                        self._count_dropped()
+                        return False
+
+        if self.overflow_policy == self.DROP_NEWEST:
+            try:
+                q.put_nowait(item)
+                return True
+            except queue.Full:
+                self._count_dropped()
+                return False
+
+        # DROP_OLDEST
+        while True:
+            try:
+                q.put_nowait(item)
+                return True
+            except queue.Full:
+                try:
+                    q.get_nowait()
+                    self._count_dropped()
+                except queue.Empty:
+                    pass
+
+    def stats(self):
+        """Get the dispatcher counters.
+
+        :returns: the number of submitted, delivered (called), dropped and failed (raised exception) callbacks,
+            and the number of currently queued callbacks.
+        :rtype: dict
+        """
+        with self._lock:
+            stats = {
+                'submitted': self._submitted,
+                'delivered': self._delivered,
+                'dropped': self._dropped,
+                'failed': self._failed,
+            }
+        stats['queued'] = sum(q.qsize() for q in self._queues)
+        return stats
+
+    def close(self):
+        """Call the queued callbacks and stop the workers. Callbacks submitted from now on are dropped."""
+        self._closed = True
+        for q in self._queues:
+            q.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        # a blocked submitter may have queued a callback behind the stop marker
+        for q in self._queues:
+            while True:
+                try:
+                    q.get_nowait()
+                except queue.Empty:
+                    break
+                self._count_dropped()
+
+    def _work(self, q):
+        while True:
+            item = q.get()
+            if item is _STOP:
+                return
+            callback_fn, args = item
+            failed = False
+            try:
+                callback_fn(*args)
+            except Exception:
+                failed = True
+                logger.exception('monitoring callback failed')
+            with self._lock:
+                self._delivered += 1
+                if failed:
+                    self._failed += 1
+
+    def _count_dropped(self):
+        with self._lock:
+            self._dropped += 1
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*
+
+# Copyright (C) 2017 Kin Foundation
+
+"""Columnar export of token transfers, for analytics over large block ranges.
+
+Transfers are read from the token contract `Transfer` event logs, and decoded in bulk into NumPy arrays,
+without creating a Python object per transfer. Requires the optional `numpy` package, and `pyarrow` for the
+Arrow IPC and Parquet formats.
+"""
+
+from binascii import unhexlify
+import os
+
+from .exceptions import SdkConfigurationError
+from .monitor import iter_block_range
+from .rpc import batch_request
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# keccak('Transfer(address,address,uint256)')
+TRANSFER_EVENT_TOPIC = '0xddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef'
+
+# default export configuration.
+DEFAULT_CHUNK_BLOCKS = 1000
+DEFAULT_EXPORT_WORKERS = 4
+DEFAULT_AMOUNT_DECIMALS = 6  # fixed-point decimals of the amount column, up to 9.2 * 10^12 KIN
+
+NPZ = 'npz'
+ARROW = 'arrow'
+PARQUET = 'parquet'
+
+# the columns of a decoded chunk, in order.
+COLUMNS = ('block_number', 'tx_index', 'log_index', 'tx_hash', 'from', 'to', 'amount', 'amount_raw')
+
+
+def decode_transfer_logs(logs, amount_decimals=DEFAULT_AMOUNT_DECIMALS):
+    """Decode raw `Transfer` event logs into columnar arrays.
+
+    :param list logs: raw JSON-RPC log objects, as returned by `eth_getLogs`.
+
+    :param int amount_decimals: the number of token decimals kept in the fixed-point `amount` column.
+
+    :returns: a dict of NumPy arrays, one per column:
+        - block_number (uint64), tx_index (uint32), log_index (uint32)
+        - tx_hash: 32 bytes per transfer, as a (n, 32) uint8 array
+        - from, to: 20 bytes per transfer, as (n, 20) uint8 arrays
+        - amount: the amount in units of 10^-amount_decimals KIN (int64), truncated
+        - amount_raw: the exact amount in base units, as 32 big-endian bytes per transfer, a (n, 32) uint8 array
+    :rtype: dict
+
+    :raises: ValueError: if an amount does not fit in the fixed-point `amount` column.
+    """
+    np = _import_numpy()
+    logs = [log for log in logs if len(log['topics']) == 3]  # ERC20 transfers have indexed from and to
+    count = len(logs)
+    scale = 10 ** (18 - amount_decimals)
+
+    def byte_column(hex_values, width):
+        return np.frombuffer(unhexlify(''.join(hex_values)), dtype=np.uint8).reshape(count, width)
+
+    try:
+        amount = np.fromiter((int(log['data'][:66], 16) // scale for log in logs), dtype=np.int64, count=count)
+    except OverflowError:
+        raise ValueError('amount too large for {} decimals'.format(amount_decimals))
+    return {
+        'block_number': np.fromiter((int(log['blockNumber'], 16) for log in logs), dtype=np.uint64, count=count),
+        'tx_index': np.fromiter((int(log['transactionIndex'], 16) for log in logs), dtype=np.uint32, count=count),
+        'log_index': np.fromiter((int(log['logIndex'], 16) for log in logs), dtype=np.uint32, count=count),
+        'tx_hash': byte_column((log['transactionHash'][2:] for log in logs), 32),
+        'from': byte_column((log['topics'][1][26:] for log in logs), 20),
+        'to': byte_column((log['topics'][2][26:] for log in logs), 20),
+        'amount': amount,
+        'amount_raw': byte_column((log['data'][2:66] for log in logs), 32),
+    }
+
+
+def iter_transfer_chunks(provider, token_address, first_block, last_block, chunk_blocks=DEFAULT_CHUNK_BLOCKS,
+                         amount_decimals=DEFAULT_AMOUNT_DECIMALS, num_workers=DEFAULT_EXPORT_WORKERS):
+    """Fetch and decode the token transfers of a block range, one chunk of blocks at a time.
+    Chunks are fetched concurrently, and yielded in order.
+
+    :param provider: JSON-RPC provider to work with.
+    :type provider: :class:`web3:providers:BaseProvider`
+
+    :param str token_address: the token contract address.
+
+    :param int first_block: the first block number.
+
+    :param int last_block: the last block number (inclusive).
+
+    :param int chunk_blocks: the number of blocks per chunk.
+
+    :param int amount_decimals: the number of token decimals kept in the fixed-point `amount` column.
+
+    :param int num_workers: the number of fetching threads.
+
+    :returns: a generator of (first block, last block, columns) tuples, see :func:`decode_transfer_logs`.
+    """
+    def fetch_chunk(first, last):
+        logs = batch_request(provider, [('eth_getLogs', [{
+            'fromBlock': '0x%x' % first,
+            'toBlock': '0x%x' % last,
+            'address': token_address,
+            'topics': [TRANSFER_EVENT_TOPIC],
+        }])])[0]
+        return [(first, last, decode_transfer_logs(logs, amount_decimals))]
+
+    for chunk in iter_block_range(fetch_chunk, first_block, last_block, num_workers, chunk_blocks):
+        yield chunk
+
+
+def export_transfers(provider, token_address, path, first_block, last_block, format=NPZ,
+                     chunk_blocks=DEFAULT_CHUNK_BLOCKS, amount_decimals=DEFAULT_AMOUNT_DECIMALS,
+                     num_workers=DEFAULT_EXPORT_WORKERS):
+    """Export the token transfers of a block range, writing one chunk at a time, so that memory use is bounded.
+    The `eth_getLogs` request of a chunk is not split if the provider rejects its result as too large: the export
+    fails, and should be run again with a smaller `chunk_blocks`.
+
+    :param provider: JSON-RPC provider to work with.
+    :type provider: :class:`web3:providers:BaseProvider`
+
+    :param str token_address: the token contract address.
+
+    :param str path: the output path. For the `npz` format, a directory of compressed NumPy files, one per chunk
+        with transfers. For the `arrow` (Arrow IPC stream) and `parquet` formats, a single file.
+
+    :param int first_block: the first block number.
+
+    :param int last_block: the last block number (inclusive).
+
+    :param str format: one of `npz`, `arrow` or `parquet`.
+
+    :param int chunk_blocks: the number of blocks per chunk.
+
+    :param int amount_decimals: the number of token decimals kept in the fixed-point `amount` column.
+
+    :param int num_workers: the number of fetching threads.
+
+    :returns: the number of exported transfers.
+    :rtype: int
+
+    :raises: ValueError: if the format is invalid.
+    :raises: :class:`~kin.exceptions.SdkConfigurationError`: if a package required for the format is missing.
+    """
+    if format not in (NPZ, ARROW, PARQUET):
+        raise ValueError('invalid export format: {}'.format(format))
+    np = _import_numpy()
+    if format == NPZ:
+        writer = _NpzWriter(np, path)
+    else:
+        writer = _ArrowWriter(path, format)
+
+    count = 0
+    try:
+        for first, last, columns in iter_transfer_chunks(provider, token_address, first_block, last_block,
+                                                         chunk_blocks, amount_decimals, num_workers):
+            writer.write(first, last, columns)
+            count += len(columns['amount'])
+            logger.debug('exported blocks %d-%d: %d transfers', first, last, len(columns['amount']))
+    finally:
+        writer.close()
+    return count
+
+
+class _NpzWriter(object):
+    def __init__(self, np, path):
+        self.np = np
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def write(self, first, last, columns):
+        if not len(columns['amount']):
+            return
+        # zero padded block numbers keep the files sorted by name
+        file_path = os.path.join(self.path, 'transfers-{:010d}-{:010d}.npz'.format(first, last))
+        self.np.savez_compressed(file_path, **columns)
+
+    def close(self):
+        pass
+
+
+class _ArrowWriter(object):
+    def __init__(self, path, format):
+        try:
+            import pyarrow as pa
+        except ImportError:
+            raise SdkConfigurationError('pyarrow package is required for the {} export format'.format(format))
+        self.pa = pa
+        self.schema = pa.schema([
+            ('block_number', pa.uint64()),
+            ('tx_index', pa.uint32()),
+            ('log_index', pa.uint32()),
+            ('tx_hash', pa.binary(32)),
+            ('from', pa.binary(20)),
+            ('to', pa.binary(20)),
+            ('amount', pa.int64()),
+            ('amount_raw', pa.binary(32)),
+        ])
+        if format == PARQUET:
+            import pyarrow.parquet as pq
+            self._writer = pq.ParquetWriter(path, self.schema)
+            self._write = lambda batch: self._writer.write_table(pa.Table.from_batches([batch]))
+        else:
+            self._sink = pa.OSFile(path, 'wb')
+            self._writer = pa.RecordBatchStreamWriter(self._sink, self.schema)  # pa.ipc.new_stream needs 0.17
+            self._write = self._writer.write_batch
+
+    def write(self, first, last, columns):
+        count = len(columns['amount'])
+        if not count:
+            return
+        arrays = []
+        for field in self.schema:
+            column = columns[field.name]
+            if column.ndim == 2:  # fixed width bytes, wrapped without copying
+                arrays.append(self.pa.FixedSizeBinaryArray.from_buffers(
+                    field.type, count, [None, self.pa.py_buffer(column)]))
+            else:
+                arrays.append(self.pa.array(column, type=field.type))
+        self._write(self.pa.RecordBatch.from_arrays(arrays, schema=self.schema))
+
+    def close(self):
+        self._writer.close()
+        if hasattr(self, '_sink'):
+            self._sink.close()
+
+
+def _import_numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise SdkConfigurationError('numpy package is required for columnar export')
+    return numpy
@@ -0,0 +1,390 @@
+# -*- coding: utf-8 -*
+
+# Copyright (C) 2017 Kin Foundation
+
+from collections import (
+    OrderedDict,
+    deque,
+)
+from multiprocessing.pool import ThreadPool
+import threading
+
+from .compat import queue
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# the maximal reorg depth the block tracker can recover from, on top of the confirmation depth.
+MAX_REORG_DEPTH = 64
+
+# default pending transaction ingestion configuration.
+DEFAULT_SEEN_SIZE = 100000  # the number of recent transaction ids remembered
+DEFAULT_PENDING_BATCH_SIZE = 500
+DEFAULT_PENDING_QUEUE_SIZE = 100000
+POLL_TIMEOUT = 1  # how long the ingestion thread blocks before checking whether it should stop
+
+# default catch-up configuration.
+DEFAULT_CATCH_UP_WORKERS = 8
+DEFAULT_CATCH_UP_BATCH_SIZE = 20  # blocks per batch request
+
+
+class MonitorHandle(object):
+    """A handle of a registered transaction monitor, used to stop it. Can be used as a context manager,
+    stopping the monitor on exit.
+    """
+
+    def __init__(self, stop_fn):
+        """Create a new monitor handle.
+
+        :param stop_fn: a function with the signature `func()` that unregisters the monitor.
+        """
+        self._stop_fn = stop_fn
+        self._lock = threading.Lock()
+        self._stopped = False
+
+    @property
+    def stopped(self):
+        return self._stopped
+
+    def stop(self):
+        """Stop the monitor. Its callback is not called anymore, except for the calls already queued by a dispatcher.
+        Stopping a stopped monitor does nothing.
+        """
+        with self._lock:
+            if self._stopped:
+                return
+            self._stopped = True
+        self._stop_fn()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+class BlockEntry(object):
+    """A block in the block tracker buffer.
+    The full block is kept only until it is confirmed. Afterwards, only the header fields and the monitoring
+    events reported for the block are kept, to be able to roll them back if the block is orphaned.
+    """
+    __slots__ = ('number', 'hash', 'parent_hash', 'block', 'confirmed', 'events')
+
+    def __init__(self, block):
+        self.number = block['number']
+        self.hash = block['hash']
+        self.parent_hash = block['parentHash']
+        self.block = block
+        self.confirmed = False
+        self.events = []  # (monitor, callback args) tuples reported for this block
+
+
+class BlockTracker(object):
+    """Follows the canonical chain using a bounded ring buffer of recent blocks.
+
+    Every new block is linked to the buffered chain by its parent hash. Missing blocks (skipped by the block
+    source) are fetched and linked as well. If the new block does not extend the buffered tip, the blocks after
+    the common ancestor are orphaned (a reorg).
+
+    Blocks are confirmed once `confirmations` blocks (including the block itself) are on top of the chain,
+    so with `confirmations=1` a block is confirmed as soon as it arrives.
+    """
+
+    def __init__(self, get_block_fn, confirmations=1, buffer_size=None):
+        """Create a new block tracker.
+
+        :param get_block_fn: a function with the signature `func(block_hash)` returning a full block.
+
+        :param int confirmations: the number of confirmations needed for a block to be confirmed.
+
+        :param int buffer_size: the number of recent blocks to keep. Defaults to `confirmations + MAX_REORG_DEPTH`.
+
+        :raises: ValueError: if some of the parameters are invalid.
+        """
+        if confirmations < 1:
+            raise ValueError('confirmations must be positive')
+        if buffer_size is None:
+            buffer_size = confirmations + MAX_REORG_DEPTH
+        if buffer_size <= confirmations:
+            raise ValueError('buffer size must be greater than confirmations')
+        self.get_block_fn = get_block_fn
+        self.confirmations = confirmations
+        self._entries = deque(maxlen=buffer_size)
+        self.reorgs = 0
+
+    def seed(self, block_number, block_hash):
+        """Start the chain from an already processed block, e.g. a checkpoint.
+
+        :param int block_number: the block number.
+
+        :param str block_hash: the block hash.
+        """
+        entry = BlockEntry({'number': block_number, 'hash': block_hash, 'parentHash': None})
+        entry.block = None
+        entry.confirmed = True
+        self._entries.clear()
+        self._entries.append(entry)
+
+    @property
+    def head(self):
+        """The tip of the buffered chain, or None if no block was added yet."""
+        return self._entries[-1] if self._entries else None
+
+    def add(self, block):
+        """Add a new block to the chain.
+
+        :param dict block: the new block.
+
+        :returns: the orphaned entries, newest first, and the newly confirmed entries, oldest first.
+        :rtype: tuple(list, list)
+        """
+        if any(entry.hash == block['hash'] for entry in self._entries):
+            return [], []  # already seen
+
+        new_chain, linked = self._link(block)
+        orphaned = []
+        if not linked:
+            # no common ancestor in the buffer: the reorg is deeper than the buffer, start over from the new chain.
+            logger.error('reorg deeper than %d blocks at block %d', len(self._entries), block['number'])
+            orphaned = list(reversed(self._entries))
+            self._entries.clear()
+        else:
+            ancestor_hash = new_chain[0].parent_hash
+            while self._entries and self._entries[-1].hash != ancestor_hash:
+                orphaned.append(self._entries.pop())
+        if orphaned:
+            self.reorgs += 1
+            logger.warning('reorg at block %d: %d blocks orphaned', new_chain[0].number, len(orphaned))
+
+        # confirm while appending, so that the entries of a long chain are not evicted before being confirmed
+        confirmed = []
+        for entry in new_chain:
+            self._entries.append(entry)
+            confirmed.extend(self._confirm())
+        return orphaned, confirmed
+
+    def _confirm(self):
+        """Mark the entries having enough confirmations as confirmed, and return them, oldest first."""
+        confirmed_number = self._entries[-1].number - self.confirmations + 1
+        confirmed = []
+        for entry in reversed(self._entries):  # unconfirmed entries are always at the end of the chain
+            if entry.confirmed:
+                break
+            if entry.number <= confirmed_number:
+                entry.confirmed = True
+                confirmed.append(entry)
+        confirmed.reverse()
+        return confirmed
+
+    def _link(self, block):
+        """Find the chain of new entries linking the block to the buffered chain.
+
+        :returns: the new entries, oldest first, and whether they link to a buffered block. If they do not,
+            the entries go back as far as the oldest buffered block.
+        :rtype: tuple(list, bool)
+        """
+        new_chain = [BlockEntry(block)]  # newest first while walking back
+        linked = True
+        if self._entries:
+            hashes = set(entry.hash for entry in self._entries)
+            oldest_number = self._entries[0].number
+            while new_chain[-1].parent_hash not in hashes:
+                parent = None
+                if new_chain[-1].number > oldest_number:
+                    parent = self.get_block_fn(new_chain[-1].parent_hash)
+                if not parent:
+                    linked = False
+                    break
+                new_chain.append(BlockEntry(parent))
+        new_chain.reverse()
+        return new_chain, linked
+
+
+class LRUSet(object):
+    """A set bounded in size, evicting the least recently used items."""
+
+    def __init__(self, size):
+        self.size = size
+        self._items = OrderedDict()
+
+    def add(self, item):
+        """Add an item to the set, or mark it as recently used if it is already there.
+
+        :returns: True if the item was already in the set.
+        :rtype: bool
+        """
+        if item in self._items:
+            del self._items[item]  # move to the end, python 2 OrderedDict has no move_to_end()
+            self._items[item] = None
+            return True
+        self._items[item] = None
+        if len(self._items) > self.size:
+            self._items.popitem(last=False)
+        return False
+
+    def discard(self, item):
+        self._items.pop(item, None)
+
+    def __contains__(self, item):
+        return item in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+
+class PendingTxIngestor(object):
+    """Collects pending transaction ids, skips those already seen, and fetches the new ones in batches
+    on a dedicated thread, so that the source of the ids (a filter poll or a subscription) is never blocked.
+    When the queue of ids to fetch is full, new ids are dropped and counted. Dropped ids, and the ids of a failed
+    fetch, are forgotten, so that they are handled if received again.
+    """
+
+    def __init__(self, fetch_txs_fn, handle_txs_fn, seen_size=DEFAULT_SEEN_SIZE,
+                 batch_size=DEFAULT_PENDING_BATCH_SIZE, queue_size=DEFAULT_PENDING_QUEUE_SIZE):
+        """Create a new pending transaction ingestor.
+
+        :param fetch_txs_fn: a function with the signature `func(tx_ids)` returning the list of transactions,
+            with None for the missing ones.
+
+        :param handle_txs_fn: a function with the signature `func(txs)` to handle the fetched transactions.
+
+        :param int seen_size: the number of recent transaction ids to remember.
+
+        :param int batch_size: the maximal number of transactions to fetch at once.
+
+        :param int queue_size: the maximal number of transaction ids waiting to be fetched.
+        """
+        self.fetch_txs_fn = fetch_txs_fn
+        self.handle_txs_fn = handle_txs_fn
+        self.batch_size = batch_size
+        self.seen = LRUSet(seen_size)
+
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(queue_size)
+        self._thread = None
+        self._running = False
+
+        self.received = 0
+        self.skipped = 0
+        self.dropped = 0
+        self.fetched = 0
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='kin-pending-ingestor')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self, wait=True):
+        """Stop the ingestion thread.
+
+        :param bool wait: whether to wait for the thread to exit.
+        """
+        self._running = False
+        if wait and self._thread and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._running
+
+    def add(self, tx_ids):
+        """Queue new pending transaction ids to be fetched. Ids already seen are skipped.
+
+        :param list tx_ids: transaction ids.
+        """
+        for tx_id in tx_ids:
+            with self._lock:
+                self.received += 1
+                if self.seen.add(tx_id):
+                    self.skipped += 1
+                    continue
+            try:
+                self._queue.put_nowait(tx_id)
+            except queue.Full:
+                with self._lock:
+                    self.dropped += 1
+                    self.seen.discard(tx_id)
+
+    def forget(self, tx_id):
+        """Forget a transaction id, so that it is handled again if seen again."""
+        with self._lock:
+            self.seen.discard(tx_id)
+
+    def stats(self):
+        """Get the ingestion counters.
+
+        :returns: the number of received, skipped (already seen), dropped (queue full) and fetched transaction ids,
+            and the number of ids waiting to be fetched.
+        :rtype: dict
+        """
+        with self._lock:
+            return {
+                'received': self.received,
+                'skipped': self.skipped,
+                'dropped': self.dropped,
+                'fetched': self.fetched,
+                'queued': self._queue.qsize(),
+            }
+
+    def _run(self):
+        while self._running:
+            try:
+                batch = [self._queue.get(timeout=POLL_TIMEOUT)]
+            except queue.Empty:
+                continue
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                txs = self.fetch_txs_fn(batch)
+            except Exception:
+                logger.exception('pending transaction fetch failed')
+                with self._lock:
+                    for tx_id in batch:  # not handled, so that they are fetched if received again
+                        self.seen.discard(tx_id)
+                continue
+            with self._lock:
+                self.fetched += len(batch)
+            try:
+                self.handle_txs_fn([tx for tx in txs if tx])  # missing ones were probably removed from the tx pool
+            except Exception:
+                logger.exception('pending transaction ingestion failed')
+
+
+def iter_block_range(fetch_blocks_fn, first, last, num_workers=DEFAULT_CATCH_UP_WORKERS,
+                     batch_size=DEFAULT_CATCH_UP_BATCH_SIZE):
+    """Fetch a range of blocks concurrently, and yield them in order.
+    The range is split into batches fetched by a pool of threads, one window of `num_workers` batches at a time,
+    so that the memory used is bounded regardless of the range size.
+
+    :param fetch_blocks_fn: a function with the signature `func(first, last)` returning the blocks in the range.
+
+    :param int first: the first block number.
+
+    :param int last: the last block number (inclusive).
+
+    :param int num_workers: the number of fetching threads.
+
+    :param int batch_size: the number of blocks fetched by a single call to `fetch_blocks_fn`.
+    """
+    if last < first:
+        return
+    pool = ThreadPool(num_workers)
+    try:
+        window = num_workers * batch_size
+        for window_start in range(first, last + 1, window):
+            window_end = min(window_start + window - 1, last)
+            ranges = [(start, min(start + batch_size - 1, window_end))
+                      for start in range(window_start, window_end + 1, batch_size)]
+            for blocks in pool.map(lambda block_range: fetch_blocks_fn(*block_range), ranges):
+                for block in blocks:
+                    yield block
+    finally:
+        pool.terminate()
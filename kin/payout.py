@@ -0,0 +1,435 @@
+# -*- coding: utf-8 -*
+
+# Copyright (C) 2017 Kin Foundation
+
+"""The `kin-payout` command: send tokens to a list of recipients.
+
+Recipients are read from a CSV file with `address,amount` rows (a header row is optional), or from a JSON lines
+file with `{"address": ..., "amount": ...}` objects. The file is streamed, so it can be of any size:
+all the rows are validated first, and nothing is sent if any row is invalid.
+
+Transfers are sent through a :class:`~kin.SendQueue`, with at most `--concurrency` transfers not yet accepted by
+the node. Each row is sent with an idempotency key derived from its row number, and its result is appended to the
+results file once the node accepts or rejects it. Running the command again with the same results file resumes
+the payout: rows already sent are skipped, rejected rows are sent again unless the node knows their rejected
+transfer after all, and rows whose transfer was signed before an interruption are not sent twice.
+
+A rejected transfer leaves its nonce unused, which holds all the later transfers back. A
+:class:`~kin.NonceAuditor` runs during the payout, and once more at its end, to fill such gaps.
+"""
+
+import argparse
+from collections import deque
+import csv
+from decimal import Decimal, InvalidOperation
+import itertools
+import json
+import os
+import sys
+from time import sleep, time
+
+from eth_utils import encode_hex
+
+from .address import canonical_address
+from .compat import integer_types, string_types
+from .exceptions import SdkConfigurationError
+from .rpc import DEFAULT_BATCH_SIZE, batch_request, hex_to_int
+from .send_queue import (
+    CONFIRMED,
+    DEFAULT_AUDIT_INTERVAL,
+    FAILED,
+    SENT,
+    NonceAuditor,
+    SendQueue,
+)
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_CONCURRENCY = 100
+PROGRESS_INTERVAL = 1  # seconds between progress reports
+MAX_REPORTED_ERRORS = 20
+RESULT_FIELDS = ['row', 'address', 'amount', 'tx_id', 'status']
+TOKEN_DECIMALS = 18
+
+
+def iter_payments(path):
+    """Read the payments of a CSV or JSON lines file, one at a time.
+
+    :param str path: the file path. Files ending with `.jsonl` or `.json` are read as JSON lines,
+        all others as CSV.
+
+    :returns: a generator of (row number, address, amount) tuples, where the amount is as written in the file.
+        Unparsable rows are yielded with None for the address.
+    """
+    if path.endswith('.jsonl') or path.endswith('.json'):
+        with open(path, 'r') as f:
+            for row_number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    payment = json.loads(line)
+                    yield row_number, payment['address'], payment['amount']
+                except (ValueError, KeyError, TypeError):
+                    yield row_number, None, None
+        return
+
+    with _open_csv(path, 'r') as f:
+        for row_number, row in enumerate(csv.reader(f), 1):
+            if not row or not ''.join(row).strip():
+                continue
+            if row_number == 1 and row[0].strip().lower() == 'address':
+                continue  # header
+            if len(row) != 2:
+                yield row_number, None, None
+                continue
+            yield row_number, row[0].strip(), row[1].strip()
+
+
+def parse_amount(amount, base_units=False):
+    """Parse and validate a payment amount.
+
+    :param amount: the amount, as a string or a number.
+
+    :param bool base_units: whether the amount is an integer amount of base units, rather than an amount of KIN.
+
+    :returns: the amount.
+    :rtype: Decimal or int
+
+    :raises: ValueError: if the amount is invalid.
+    """
+    if isinstance(amount, float):
+        amount = repr(amount)
+    try:
+        value = Decimal(amount) if isinstance(amount, string_types + integer_types) else None
+    except InvalidOperation:
+        value = None
+    if value is None or not value.is_finite():
+        raise ValueError('invalid amount: {}'.format(amount))
+    if value <= 0:
+        raise ValueError('amount must be positive')
+    if base_units:
+        if value != value.to_integral_value():
+            raise ValueError('amount must be an integer in base units mode')
+        return int(value)
+    if value != value.quantize(Decimal(1).scaleb(-TOKEN_DECIMALS), rounding='ROUND_DOWN'):
+        raise ValueError('amount has more than {} decimals'.format(TOKEN_DECIMALS))
+    return value
+
+
+def validate_payments(path, base_units=False):
+    """Validate all the payments of a file.
+
+    :param str path: the file path.
+
+    :param bool base_units: whether the amounts are integer amounts of base units.
+
+    :returns: the number of payments, their total amount and the error messages of the invalid rows.
+        At most `MAX_REPORTED_ERRORS` messages are returned, followed by a summary of the rest.
+    :rtype: tuple(int, Decimal, list)
+    """
+    count = 0
+    total = 0
+    errors = []
+    num_errors = 0
+    for row_number, address, amount in iter_payments(path):
+        try:
+            if address is None:
+                raise ValueError('cannot parse row')
+            canonical_address(address)
+            total += parse_amount(amount, base_units)
+            count += 1
+        except ValueError as e:
+            num_errors += 1
+            if num_errors <= MAX_REPORTED_ERRORS:
+                errors.append('row {}: {}'.format(row_number, e))
+    if num_errors > MAX_REPORTED_ERRORS:
+        errors.append('and {} more invalid rows'.format(num_errors - MAX_REPORTED_ERRORS))
+    return count, total, errors
+
+
+def load_results(path):
+    """Load the results of a previous run.
+
+    :param str path: the results file path.
+
+    :returns: the row numbers already sent, and the transaction ids of the failed attempts of each row not yet sent.
+    :rtype: tuple(set, dict)
+    """
+    sent = set()
+    failures = {}
+    if not os.path.exists(path):
+        return sent, failures
+    with _open_csv(path, 'r') as f:
+        for result in csv.DictReader(f):
+            row = int(result['row'])
+            if result['status'] == FAILED:
+                failures.setdefault(row, []).append(result['tx_id'])
+            else:
+                sent.add(row)
+                failures.pop(row, None)
+    return sent, failures
+
+
+class Payout(object):
+    """Sends the payments of a file through a send queue, recording the results."""
+
+    def __init__(self, sdk, path, results_path, concurrency=DEFAULT_CONCURRENCY, out=sys.stderr,
+                 audit_interval=DEFAULT_AUDIT_INTERVAL):
+        """Create a new payout.
+
+        :param sdk: the SDK to send with.
+        :type sdk: :class:`~kin.TokenSDK`
+
+        :param str path: the payments file path.
+
+        :param str results_path: the results file path. The send queue write-ahead log is kept next to it.
+
+        :param int concurrency: the maximal number of transfers not yet accepted by the node.
+
+        :param out: the stream to report progress to.
+
+        :param float audit_interval: the number of seconds between nonce audits.
+        """
+        self.sdk = sdk
+        self.path = path
+        self.results_path = results_path
+        self.concurrency = concurrency
+        self.out = out
+        self.audit_interval = audit_interval
+
+        self.sent = 0
+        self.failed = 0
+        self.skipped = 0
+        self._in_flight = deque()  # (row number, address, amount, tx_id) tuples
+        self._last_progress = 0
+        self._start = None
+
+    def run(self):
+        """Send all the payments not sent yet.
+
+        :returns: the number of sent, failed and skipped (already sent) payments.
+        :rtype: tuple(int, int, int)
+        """
+        done, failures = load_results(self.results_path)
+        send_queue = SendQueue(self.sdk, self.results_path + '.wal')
+        send_queue.start()
+        auditor = NonceAuditor(send_queue, self.audit_interval)
+        auditor.start()
+        is_new = not os.path.exists(self.results_path)
+        self._start = time()
+        completed = False
+        try:
+            with _open_csv(self.results_path, 'a') as results_file:
+                results = csv.writer(results_file)
+                if is_new:
+                    results.writerow(RESULT_FIELDS)
+                batch = []
+                for row_number, address, amount in iter_payments(self.path):
+                    if row_number in done:
+                        self.skipped += 1
+                        continue
+                    if row_number in failures:
+                        # a failed transfer may have reached the node after all: send the row again only if not
+                        tx_id = self._find_known(failures[row_number])
+                        if tx_id:
+                            results.writerow([row_number, address, amount, tx_id, SENT])
+                            self.skipped += 1
+                            continue
+                    # a row sent again after a failure needs a new key, the old one maps to the failed transfer
+                    key = '{}:{}'.format(row_number, len(failures.get(row_number, [])))
+                    batch.append((row_number, address, parse_amount(amount, self.sdk.base_units), key))
+                    if len(self._in_flight) + len(batch) >= self.concurrency:
+                        self._send(send_queue, batch)
+                        batch = []
+                        # refill in batches rather than one by one, each batch is logged with a single disk flush
+                        while len(self._in_flight) > self.concurrency // 2:
+                            self._collect(send_queue, results, results_file)
+                self._send(send_queue, batch)
+                while self._in_flight:
+                    self._collect(send_queue, results, results_file)
+            # the transfers after a gap left by the last rejected rows are held back until it is filled
+            auditor.stop()
+            auditor.audit()
+            completed = True
+        finally:
+            auditor.stop()
+            send_queue.close(wait=completed)  # submit the gap fills
+        self._report(send_queue, final=True)
+        return self.sent, self.failed, self.skipped
+
+    def _find_known(self, tx_ids):
+        """Find a transaction known to the node among the failed attempts of a row.
+
+        :param list tx_ids: the transaction ids of the failed attempts.
+
+        :returns: the id of a transaction known to the node, or None if the node knows none of them.
+        :rtype: str
+        """
+        for tx_id in tx_ids:
+            if tx_id and self.sdk.web3.eth.getTransaction(tx_id) is not None:
+                logger.warning('transaction %s recorded as failed is known to the node', tx_id)
+                return tx_id
+        return None
+
+    def _send(self, send_queue, batch):
+        if not batch:
+            return
+        tx_ids = send_queue.send_tokens_many([(address, amount, key) for _, address, amount, key in batch])
+        for (row_number, address, amount, _), tx_id in zip(batch, tx_ids):
+            self._in_flight.append((row_number, address, amount, tx_id))
+
+    def _collect(self, send_queue, results, results_file):
+        """Record the results of the transfers accepted or rejected by the node, waiting for at least one."""
+        pending = deque()
+        collected = 0
+        while self._in_flight:
+            row_number, address, amount, tx_id = payment = self._in_flight.popleft()
+            state = send_queue.get_transaction_state(tx_id)
+            if state in (SENT, CONFIRMED, FAILED):
+                results.writerow([row_number, address, amount, tx_id, FAILED if state == FAILED else SENT])
+                collected += 1
+                if state == FAILED:
+                    self.failed += 1
+                else:
+                    self.sent += 1
+            else:
+                pending.append(payment)
+        self._in_flight = pending
+        if collected:
+            results_file.flush()
+        else:
+            sleep(0.01)
+        self._report(send_queue)
+
+    def _report(self, send_queue, final=False):
+        now = time()
+        if not final and now - self._last_progress < PROGRESS_INTERVAL:
+            return
+        self._last_progress = now
+        elapsed = now - self._start
+        self.out.write('sent {}, failed {}, skipped {}, pending {}, {:.1f} tx/s{}'.format(
+            self.sent, self.failed, self.skipped, len(self._in_flight),
+            self.sent / elapsed if elapsed else 0, '\n' if final else '\r'))
+        self.out.flush()
+
+
+def estimate_cost(sdk, path, count, total):
+    """Estimate the cost of a payout, without sending anything.
+
+    :param sdk: the SDK to send with.
+    :type sdk: :class:`~kin.TokenSDK`
+
+    :param str path: the payments file path. All its rows must be valid.
+
+    :param int count: the number of payments.
+
+    :param total: the total token amount.
+
+    :returns: the estimated gas, the estimated Ether cost, the Ether needed to cover the gas limit of all transfers,
+        and the token and Ether balances of the sending wallet. Ether amounts are in base units in base units mode.
+    :rtype: dict
+    """
+    from .sdk import DEFAULT_GAS_PER_TX, DEFAULT_GAS_PRICE
+
+    # the gas of a transfer depends on its recipient (a first transfer to an address costs more), so every row is
+    # estimated, in batches
+    gas = 0
+    payments = iter_payments(path)
+    while True:
+        calls = []
+        for _, address, amount in itertools.islice(payments, DEFAULT_BATCH_SIZE):
+            value = sdk._to_base_units(parse_amount(amount, sdk.base_units))
+            calls.append(('eth_estimateGas', [{
+                'from': sdk.address,
+                'to': sdk.token_contract.address,
+                'data': encode_hex(sdk._encode_token_transfer(address, value)),
+            }]))
+        if not calls:
+            break
+        gas += sum(hex_to_int(result) for result in batch_request(sdk.provider, calls))
+    return {
+        'payments': count,
+        'tokens': total,
+        'gas': gas,
+        'ether': sdk._from_base_units(gas * DEFAULT_GAS_PRICE),
+        'ether_reserved': sdk._from_base_units(DEFAULT_GAS_PER_TX * count * DEFAULT_GAS_PRICE),
+        'token_balance': sdk.get_token_balance(),
+        'ether_balance': sdk.get_ether_balance(),
+    }
+
+
+def main(argv=None):
+    """The `kin-payout` command entry point."""
+    parser = argparse.ArgumentParser(prog='kin-payout', description='Send KIN to a list of recipients.')
+    parser.add_argument('payments', help='a CSV file of address,amount rows, or a JSON lines file (.jsonl)')
+    parser.add_argument('--results', help='the results file, used to resume the payout '
+                                          '(default: the payments file name with a .results.csv suffix)')
+    parser.add_argument('--keyfile', help='the wallet keyfile. Its password is read from the KIN_KEYFILE_PASSWORD '
+                                          'environment variable. If not provided, the wallet private key is read '
+                                          'from the KIN_PRIVATE_KEY environment variable.')
+    parser.add_argument('--provider-endpoint', help='the JSON-RPC endpoint URI of the node')
+    parser.add_argument('--contract-address', help='the token contract address')
+    parser.add_argument('--base-units', action='store_true', help='amounts are integers in base units')
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                        help='the maximal number of transfers not yet accepted by the node')
+    parser.add_argument('--dry-run', action='store_true', help='validate and estimate the cost, without sending')
+    args = parser.parse_args(argv)
+
+    if args.concurrency < 1:
+        parser.error('concurrency must be positive')
+
+    count, total, errors = validate_payments(args.payments, args.base_units)
+    if errors:
+        sys.stderr.write('invalid payments file:\n{}\n'.format('\n'.join(errors)))
+        return 1
+    if not count:
+        sys.stderr.write('no payments to send\n')
+        return 0
+    sys.stderr.write('{} valid payments, {} in total\n'.format(count, total))
+
+    from .sdk import TokenSDK
+    sdk_args = {'base_units': args.base_units}
+    if args.keyfile:
+        sdk_args.update(keyfile=args.keyfile, password=os.environ.get('KIN_KEYFILE_PASSWORD', ''))
+    else:
+        sdk_args['private_key'] = os.environ.get('KIN_PRIVATE_KEY', '')
+    if args.provider_endpoint:
+        sdk_args['provider_endpoint_uri'] = args.provider_endpoint
+    if args.contract_address:
+        sdk_args['contract_address'] = args.contract_address
+    try:
+        sdk = TokenSDK(**sdk_args)
+    except SdkConfigurationError as e:
+        sys.stderr.write('cannot initialize the SDK: {}\n'.format(e))
+        return 1
+    if not sdk.address:
+        sys.stderr.write('no wallet: provide --keyfile or set KIN_PRIVATE_KEY\n')
+        return 1
+
+    if args.dry_run:
+        estimate = estimate_cost(sdk, args.payments, count, total)
+        for name in ('payments', 'tokens', 'gas', 'ether', 'ether_reserved', 'token_balance', 'ether_balance'):
+            sys.stderr.write('{}: {}\n'.format(name, estimate[name]))
+        if estimate['token_balance'] < total:
+            sys.stderr.write('insufficient token balance\n')
+            return 1
+        if estimate['ether_balance'] < estimate['ether_reserved']:
+            sys.stderr.write('insufficient Ether balance to cover the gas limit of all transfers\n')
+            return 1
+        return 0
+
+    results_path = args.results or os.path.splitext(args.payments)[0] + '.results.csv'
+    sent, failed, skipped = Payout(sdk, args.payments, results_path, args.concurrency).run()
+    return 1 if failed else 0
+
+
+def _open_csv(path, mode):
+    if sys.version_info.major >= 3:
+        return open(path, mode, newline='')
+    return open(path, mode + 'b')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,540 @@
+# -*- coding: utf-8 -*
+
+# Copyright (C) 2017 Kin Foundation
+
+"""JSON-RPC provider wrappers."""
+
+from binascii import unhexlify
+from collections import Counter, deque
+import itertools
+from multiprocessing.pool import ThreadPool
+import threading
+from time import time
+
+from eth_utils import encode_hex, keccak
+from requests.exceptions import HTTPError
+from web3.providers.base import BaseProvider
+
+from .compat import queue
+from .rpc import batch_responses, is_known_transaction_error
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# read methods hedged by default. `eth_getTransactionCount` is left out, nonces must come from a single node.
+DEFAULT_HEDGED_METHODS = ('eth_blockNumber', 'eth_call', 'eth_getBalance', 'eth_getBlockByHash',
+                          'eth_getBlockByNumber', 'eth_getTransactionByHash', 'eth_getTransactionReceipt')
+
+# read methods whose null result may only mean that a lagging node has not seen the block or transaction yet.
+BY_HASH_METHODS = ('eth_getBlockByHash', 'eth_getTransactionByHash', 'eth_getTransactionReceipt')
+
+# methods with side effects, never hedged.
+WRITE_METHODS = ('eth_sendRawTransaction', 'eth_sendTransaction', 'eth_sign', 'personal_sendTransaction')
+
+# default hedging configuration.
+DEFAULT_HEDGE_PERCENTILE = 95
+DEFAULT_HEDGE_BUDGET = 0.05  # at most 5% extra requests
+DEFAULT_HEDGE_DELAY = 0.5  # seconds, used until enough latencies of a method were measured
+DEFAULT_HEDGE_WORKERS = 16
+
+LATENCY_WINDOW = 100  # the number of recent latencies kept per method
+MIN_LATENCY_SAMPLES = 20
+MAX_HEDGE_TOKENS = 10  # the maximal burst of hedged requests
+
+# the default number of threads sending raw transactions to the nodes.
+DEFAULT_BROADCAST_WORKERS = 16
+
+# request priorities, lower is served first.
+HIGH_PRIORITY = 0
+NORMAL_PRIORITY = 1
+LOW_PRIORITY = 2
+PRIORITY_NAMES = {HIGH_PRIORITY: 'high', NORMAL_PRIORITY: 'normal', LOW_PRIORITY: 'low'}
+
+# sends and receipts go before balance and pending transaction reads. Other methods have normal priority.
+DEFAULT_PRIORITIES = {
+    'eth_sendRawTransaction': HIGH_PRIORITY,
+    'eth_sendTransaction': HIGH_PRIORITY,
+    'eth_getTransactionReceipt': HIGH_PRIORITY,
+    'eth_getTransactionCount': HIGH_PRIORITY,
+    'eth_getBalance': LOW_PRIORITY,
+    'eth_call': LOW_PRIORITY,
+    'eth_getTransactionByHash': LOW_PRIORITY,
+    'eth_getFilterChanges': LOW_PRIORITY,
+}
+
+RATE_LIMIT_RETRIES = 5  # the number of times a request rejected by the node rate limit (HTTP 429) is queued again
+MAX_QUEUE_WAIT = 0.1  # seconds, the longest a queued request sleeps before checking its turn again
+
+
+class HedgedProvider(BaseProvider):
+    """A provider that hedges reads across several nodes, to cut the tail latency caused by a slow node.
+
+    Requests go to the primary (first) provider. If a hedged method has not been answered within the given
+    percentile of its recent latencies, the request is sent again to one of the other providers, and the first
+    valid response is returned. The late response is ignored, as requests in flight cannot be cancelled.
+    A null result of a read by hash is returned only if the other request does not return a non-null one, since
+    a lagging node does not know the latest blocks and transactions. When the primary request fails outright
+    (raises) before it was hedged, the request fails over to another provider at once, outside of the budget.
+
+    Hedging is limited by a budget: every hedged method request earns `budget` of an extra request, so with the
+    default budget of 0.05 at most 5% of the requests are sent twice. Write methods are never hedged, and all
+    other requests (including batches) go to the primary provider only.
+    """
+
+    def __init__(self, providers, hedged_methods=DEFAULT_HEDGED_METHODS, percentile=DEFAULT_HEDGE_PERCENTILE,
+                 budget=DEFAULT_HEDGE_BUDGET, initial_delay=DEFAULT_HEDGE_DELAY, num_workers=DEFAULT_HEDGE_WORKERS):
+        """Create a new hedged provider.
+
+        :param list providers: the providers to use, the first one is the primary.
+
+        :param hedged_methods: the JSON-RPC methods to hedge.
+
+        :param float percentile: the latency percentile (0-100) after which a request is hedged.
+
+        :param float budget: the fraction of extra requests allowed, between 0 and 1.
+
+        :param float initial_delay: the hedging delay in seconds, used until enough latencies were measured.
+
+        :param int num_workers: the number of threads running hedged method requests.
+
+        :raises: ValueError: if some of the parameters are invalid.
+        """
+        if not providers:
+            raise ValueError('at least one provider is required')
+        for method in hedged_methods:
+            if method in WRITE_METHODS:
+                raise ValueError('write method cannot be hedged: {}'.format(method))
+        if not 0 < percentile < 100:
+            raise ValueError('percentile must be between 0 and 100')
+        if not 0 <= budget <= 1:
+            raise ValueError('budget must be between 0 and 1')
+        if num_workers < 1:
+            raise ValueError('number of workers must be positive')
+
+        self.providers = list(providers)
+        self.hedged_methods = frozenset(hedged_methods)
+        self.percentile = percentile
+        self.budget = budget
+        self.initial_delay = initial_delay
+
+        self._lock = threading.Lock()
+        self._latencies = {}  # method -> deque of recent latencies
+        self._tokens = 0.0
+        self._next_secondary = 0
+        self._requests = 0
+        self._hedged = 0
+        self._hedge_wins = 0
+        self._budget_denied = 0
+        self._failovers = 0
+        self._pool = ThreadPool(num_workers)
+
+    def make_request(self, method, params):
+        primary = self.providers[0]
+        if method not in self.hedged_methods or len(self.providers) < 2:
+            return primary.make_request(method, params)
+
+        with self._lock:
+            self._requests += 1
+            self._tokens = min(self._tokens + self.budget, MAX_HEDGE_TOKENS)
+
+        results = queue.Queue()
+        self._pool.apply_async(self._call, (0, primary, method, params, results))
+        pending = 1
+        hedged = False
+        try:
+            result = results.get(timeout=self._hedge_delay(method))
+        except queue.Empty:
+            secondary = self._take_secondary()
+            if secondary is not None:
+                logger.debug('hedging %s', method)
+                self._pool.apply_async(self._call, (1, secondary, method, params, results))
+                pending += 1
+                hedged = True
+            result = results.get()
+
+        first_failure = None
+        first_null = None
+        while True:
+            pending -= 1
+            index, response, error = result
+            if error is None and 'error' not in response:
+                if pending and response.get('result') is None and method in BY_HASH_METHODS:
+                    first_null = first_null or result  # wait for the other request
+                else:
+                    if index == 1:
+                        with self._lock:
+                            self._hedge_wins += 1
+                    return response
+            else:
+                first_failure = first_failure or result
+                if error is not None and not hedged:  # the primary failed outright, no need to wait for the delay
+                    logger.debug('primary failed, failing over %s: %s', method, error)
+                    self._pool.apply_async(self._call, (2, self._take_failover(), method, params, results))
+                    pending += 1
+                    hedged = True
+            if not pending:
+                break
+            result = results.get()
+
+        if first_null:
+            if first_null[0] == 1:
+                with self._lock:
+                    self._hedge_wins += 1
+            return first_null[1]
+        _, response, error = first_failure
+        if error is not None:
+            raise error
+        return response
+
+    def make_batch_request(self, calls):
+        return batch_responses(self.providers[0], calls)
+
+    def isConnected(self):
+        return self.providers[0].isConnected()
+
+    def stats(self):
+        """Get the hedging statistics.
+
+        :returns: a dict with the number of hedged method requests, the number of hedged (duplicated) requests,
+            the number of requests answered by the hedge, the number of hedges denied by the budget, and the number
+            of requests failed over after a primary error.
+        :rtype: dict
+        """
+        with self._lock:
+            return {
+                'requests': self._requests,
+                'hedged': self._hedged,
+                'hedge_wins': self._hedge_wins,
+                'budget_denied': self._budget_denied,
+                'failovers': self._failovers,
+            }
+
+    def close(self):
+        """Stop the worker threads. Requests in flight are abandoned."""
+        self._pool.terminate()
+
+    def _call(self, index, provider, method, params, results):
+        start = time()
+        try:
+            response = provider.make_request(method, params)
+        except Exception as e:
+            results.put((index, None, e))
+            return
+        if index == 0 and 'error' not in response:  # the hedging delay follows the primary latencies
+            with self._lock:
+                latencies = self._latencies.get(method)
+                if latencies is None:
+                    latencies = self._latencies[method] = deque(maxlen=LATENCY_WINDOW)
+                latencies.append(time() - start)
+        results.put((index, response, None))
+
+    def _hedge_delay(self, method):
+        """The time to wait for the primary provider before hedging: the percentile of the recent latencies."""
+        with self._lock:
+            latencies = self._latencies.get(method)
+            if latencies is None or len(latencies) < MIN_LATENCY_SAMPLES:
+                return self.initial_delay
+            latencies = sorted(latencies)
+        return latencies[min(int(len(latencies) * self.percentile / 100.0), len(latencies) - 1)]
+
+    def _take_secondary(self):
+        """Charge the budget for a hedge, and pick the next secondary provider, or return None if over budget."""
+        with self._lock:
+            if self._tokens < 1:
+                self._budget_denied += 1
+                return None
+            self._tokens -= 1
+            self._hedged += 1
+            return self._pick_secondary()
+
+    def _take_failover(self):
+        """Pick the next secondary provider for a request that failed on the primary. Failovers are not charged
+        to the budget, as they replace a request rather than duplicate it."""
+        with self._lock:
+            self._failovers += 1
+            return self._pick_secondary()
+
+    def _pick_secondary(self):
+        """Pick the next secondary provider, round-robin. Must be called with the lock held."""
+        self._next_secondary = self._next_secondary % (len(self.providers) - 1) + 1
+        return self.providers[self._next_secondary]
+
+
+class RateLimitedProvider(BaseProvider):
+    """A provider that keeps the request rate within the node limits, serving the most important requests first.
+
+    Requests take tokens from a token bucket refilled at the given rate, and optionally from a bucket of their
+    method. When tokens run out, requests are queued instead of being sent to the node and rejected, and are
+    served by priority: transaction sends and receipts first, balance and pending transaction reads last.
+    Requests rejected by the node rate limit anyway (HTTP 429) are queued again.
+    A batch takes a token per call, at most a full bucket, and has the priority of its most important call.
+    """
+
+    def __init__(self, provider, rate, burst=None, method_rates=None, priorities=None):
+        """Create a new rate limited provider.
+
+        :param provider: the provider to send the requests to.
+        :type provider: :class:`web3:providers:BaseProvider`
+
+        :param float rate: the maximal number of requests per second.
+
+        :param int burst: the maximal number of requests sent at once after an idle period. Defaults to the rate.
+
+        :param dict method_rates: per-method budgets, a dict of method -> the maximal number of requests per second.
+            A method may burst up to one second of requests.
+
+        :param dict priorities: a dict of method -> `HIGH_PRIORITY`, `NORMAL_PRIORITY` or `LOW_PRIORITY`,
+            overriding the default priorities.
+
+        :raises: ValueError: if some of the parameters are invalid.
+        """
+        if rate <= 0:
+            raise ValueError('rate must be positive')
+        method_rates = method_rates or {}
+        for method, method_rate in method_rates.items():
+            if method_rate <= 0:
+                raise ValueError('rate of {} must be positive'.format(method))
+        self.priorities = dict(DEFAULT_PRIORITIES)
+        for method, priority in (priorities or {}).items():
+            if priority not in PRIORITY_NAMES:
+                raise ValueError('invalid priority of {}: {}'.format(method, priority))
+            self.priorities[method] = priority
+        self.provider = provider
+
+        self._cond = threading.Condition()
+        self._bucket = _TokenBucket(rate, burst or rate)
+        self._method_buckets = dict((method, _TokenBucket(method_rate, max(method_rate, 1)))
+                                    for method, method_rate in method_rates.items())
+        self._waiting = []  # queued requests, as (priority, sequence number, method counts, number of calls)
+        self._sequence = itertools.count()
+        self._throttled = 0
+        self._delays = dict((priority, [0, 0.0, 0.0]) for priority in PRIORITY_NAMES)  # count, total, max
+
+    def make_request(self, method, params):
+        return self._send({method: 1}, self.provider.make_request, method, params)
+
+    def make_batch_request(self, calls):
+        return self._send(Counter(method for method, _ in calls), batch_responses, self.provider, calls)
+
+    def isConnected(self):
+        return self.provider.isConnected()
+
+    def stats(self):
+        """Get the rate limiting statistics.
+
+        :returns: a dict with the number of currently queued requests, the number of requests rejected by the node
+            rate limit, and the queue delay per priority: the number of requests and the mean and maximal
+            delay in seconds.
+        :rtype: dict
+        """
+        with self._cond:
+            queue_delay = {}
+            for priority, (count, total, longest) in self._delays.items():
+                queue_delay[PRIORITY_NAMES[priority]] = {
+                    'requests': count,
+                    'mean': total / count if count else 0.0,
+                    'max': longest,
+                }
+            return {
+                'queued': len(self._waiting),
+                'throttled': self._throttled,
+                'queue_delay': queue_delay,
+            }
+
+    def _send(self, counts, request_fn, *args):
+        for attempt in range(RATE_LIMIT_RETRIES + 1):
+            self._acquire(counts)
+            try:
+                return request_fn(*args)
+            except HTTPError as e:
+                if getattr(e.response, 'status_code', None) != 429 or attempt == RATE_LIMIT_RETRIES:
+                    raise
+                with self._cond:
+                    self._throttled += 1
+                    self._bucket.tokens = min(self._bucket.tokens, 0)  # the node is over its limit, back off
+                logger.warning('rate limited by the node, queueing %s again', ', '.join(counts))
+
+    def _acquire(self, counts):
+        """Wait until the request is the most important one that can be sent, and take its tokens."""
+        priority = min(self.priorities.get(method, NORMAL_PRIORITY) for method in counts)
+        request = (priority, next(self._sequence), counts, sum(counts.values()))
+        start = time()
+        with self._cond:
+            self._waiting.append(request)
+            while True:
+                now = time()
+                self._bucket.refill(now)
+                for bucket in self._method_buckets.values():
+                    bucket.refill(now)
+
+                # requests held by their method budget do not block the others
+                wait = self._method_wait(counts)
+                if not wait:
+                    ready = min(r for r in self._waiting if not self._method_wait(r[2]))
+                    if ready is request:
+                        wait = self._bucket.wait_time(request[3])
+                        if not wait:
+                            break
+                    else:
+                        wait = MAX_QUEUE_WAIT
+                self._cond.wait(min(wait, MAX_QUEUE_WAIT))
+
+            self._waiting.remove(request)
+            # a batch over the burst takes a full bucket, and does not hold back the next requests any longer
+            self._bucket.tokens -= min(request[3], self._bucket.burst)
+            for method, count in counts.items():
+                if method in self._method_buckets:
+                    bucket = self._method_buckets[method]
+                    bucket.tokens -= min(count, bucket.burst)
+            delay = time() - start
+            delays = self._delays[priority]
+            delays[0] += 1
+            delays[1] += delay
+            delays[2] = max(delays[2], delay)
+            self._cond.notify_all()
+
+    def _method_wait(self, counts):
+        return max([self._method_buckets[method].wait_time(count)
+                    for method, count in counts.items() if method in self._method_buckets] or [0])
+
+
+class BroadcastProvider(BaseProvider):
+    """A provider that broadcasts raw transactions to several nodes at once, for a faster propagation to miners.
+
+    Raw transactions are sent concurrently to all the providers. The first node to accept a transaction answers
+    the request, and the other nodes are not waited for. A node rejecting the transaction as already known
+    counts as accepting it. If all the nodes reject the transaction, the response of the first provider is
+    returned. All other requests go to the first provider only.
+
+    The acceptance latency of each node (the time to mempool) is recorded, see :meth:`stats`.
+    """
+
+    def __init__(self, providers, num_workers=DEFAULT_BROADCAST_WORKERS):
+        """Create a new broadcast provider.
+
+        :param list providers: the providers to broadcast to, the first one also serves all other requests.
+
+        :param int num_workers: the number of threads sending raw transactions.
+
+        :raises: ValueError: if some of the parameters are invalid.
+        """
+        if not providers:
+            raise ValueError('at least one provider is required')
+        if num_workers < 1:
+            raise ValueError('number of workers must be positive')
+        self.providers = list(providers)
+        self.endpoints = [getattr(provider, 'endpoint_uri', None) or str(i) for i, provider in enumerate(providers)]
+
+        self._lock = threading.Lock()
+        self._transactions = 0
+        self._failed = 0
+        # per endpoint: accepted, rejected, failed (exception), first to accept, total and max acceptance latency
+        self._endpoint_stats = [[0, 0, 0, 0, 0.0, 0.0] for _ in providers]
+        self._pool = ThreadPool(num_workers)
+
+    def make_request(self, method, params):
+        if method != 'eth_sendRawTransaction' or len(self.providers) < 2:
+            return self.providers[0].make_request(method, params)
+
+        with self._lock:
+            self._transactions += 1
+        results = queue.Queue()
+        for index, provider in enumerate(self.providers):
+            self._pool.apply_async(self._send, (index, provider, params, results))
+
+        responses = {}
+        for _ in self.providers:
+            index, response, error = results.get()
+            if response is not None and 'error' not in response:
+                with self._lock:
+                    self._endpoint_stats[index][3] += 1
+                return response
+            responses[index] = (response, error)
+
+        with self._lock:
+            self._failed += 1
+        response, error = responses[0]
+        if error is not None:
+            raise error
+        return response
+
+    def make_batch_request(self, calls):
+        return batch_responses(self.providers[0], calls)
+
+    def isConnected(self):
+        return self.providers[0].isConnected()
+
+    def stats(self):
+        """Get the broadcast statistics.
+
+        :returns: a dict with the number of broadcast transactions, the number of transactions rejected by all the
+            nodes, and per endpoint: the number of transactions accepted, rejected and failed to send, the number of
+            times the endpoint was the first to accept, and the mean and maximal acceptance latency in seconds.
+        :rtype: dict
+        """
+        with self._lock:
+            endpoints = {}
+            for endpoint, (accepted, rejected, failed, first, total, longest) in zip(self.endpoints,
+                                                                                    self._endpoint_stats):
+                endpoints[endpoint] = {
+                    'accepted': accepted,
+                    'rejected': rejected,
+                    'failed': failed,
+                    'first': first,
+                    'mean_latency': total / accepted if accepted else 0.0,
+                    'max_latency': longest,
+                }
+            return {
+                'transactions': self._transactions,
+                'failed': self._failed,
+                'endpoints': endpoints,
+            }
+
+    def close(self):
+        """Stop the worker threads. Transactions being sent are abandoned."""
+        self._pool.terminate()
+
+    def _send(self, index, provider, params, results):
+        start = time()
+        try:
+            response = provider.make_request('eth_sendRawTransaction', params)
+        except Exception as e:
+            logger.warning('broadcast to %s failed: %s', self.endpoints[index], e)
+            with self._lock:
+                self._endpoint_stats[index][2] += 1
+            results.put((index, None, e))
+            return
+
+        error = response.get('error')
+        if error is not None:
+            message = error.get('message', '') if isinstance(error, dict) else str(error)
+            if is_known_transaction_error(message):  # accepted before
+                tx_id = encode_hex(keccak(unhexlify(params[0][2:])))
+                response = {'jsonrpc': '2.0', 'id': response.get('id'), 'result': tx_id}
+        latency = time() - start
+        with self._lock:
+            stats = self._endpoint_stats[index]
+            if 'error' in response:
+                stats[1] += 1
+            else:
+                stats[0] += 1
+                stats[4] += latency
+                stats[5] = max(stats[5], latency)
+        results.put((index, response, None))
+
+
+class _TokenBucket(object):
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self._updated = time()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self, cost):
+        """The time until the bucket has the tokens for the cost. A cost over the burst waits for a full bucket."""
+        return max(min(cost, self.burst) - self.tokens, 0) / self.rate
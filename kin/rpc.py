@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*
+
+# Copyright (C) 2017 Kin Foundation
+
+import itertools
+import json
+import re
+
+import requests
+from web3 import HTTPProvider
+
+from .compat import string_types
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# maximal number of calls to put in a single batch request.
+DEFAULT_BATCH_SIZE = 500
+
+# seconds to wait for a batch response, unless the provider request kwargs set a timeout.
+HTTP_TIMEOUT = 10
+
+# raw transaction send errors meaning that the node already has the transaction: geth answers 'known transaction'
+# or 'already known', parity 'Transaction with the same hash was already imported'. Not 'unknown account'.
+_KNOWN_TRANSACTION_ERROR = re.compile(r'\b(known transaction|already known|already imported)\b', re.IGNORECASE)
+
+_request_counter = itertools.count()
+
+
+def batch_request(provider, calls):
+    """Perform several JSON-RPC calls in a single round trip.
+    Providers that know how to batch (expose `make_batch_request`) are used as is, HTTP providers
+    are batched by posting a JSON-RPC batch array, and all other providers fall back to sequential calls.
+
+    :param provider: JSON-RPC provider to work with.
+    :type provider: :class:`web3:providers:BaseProvider`
+
+    :param list calls: a list of (method, params) tuples.
+
+    :returns: a list of call results, in the same order as the calls.
+    :rtype: list
+
+    :raises: ValueError: if any of the calls returned an error.
+    """
+    results = []
+    for response in batch_responses(provider, calls):
+        if 'error' in response:
+            raise ValueError(response['error'])
+        results.append(response.get('result'))
+    return results
+
+
+def batch_responses(provider, calls):
+    """Same as :func:`batch_request`, but returns the raw JSON-RPC responses, including the errors.
+
+    :returns: a list of JSON-RPC response objects, in the same order as the calls.
+    :rtype: list
+    """
+    if not calls:
+        return []
+    if hasattr(provider, 'make_batch_request'):
+        return provider.make_batch_request(calls)
+    if isinstance(provider, HTTPProvider):
+        return _http_batch_request(provider, calls)
+    return [provider.make_request(method, params) for method, params in calls]
+
+
+def chunked_batch_request(provider, calls, batch_size=DEFAULT_BATCH_SIZE):
+    """Same as :func:`batch_request`, but splits the calls into batches of at most `batch_size` calls."""
+    results = []
+    for i in range(0, len(calls), batch_size):
+        results.extend(batch_request(provider, calls[i:i + batch_size]))
+    return results
+
+
+def _http_batch_request(provider, calls):
+    """Post a JSON-RPC batch to an HTTP provider endpoint and return the responses ordered as the calls."""
+    payload = []
+    for method, params in calls:
+        payload.append({
+            'jsonrpc': '2.0',
+            'method': method,
+            'params': params or [],
+            'id': next(_request_counter),
+        })
+    request_kwargs = dict(provider.get_request_kwargs())
+    headers = dict(request_kwargs.pop('headers', None) or {})
+    headers.setdefault('Content-Type', 'application/json')
+    request_kwargs.setdefault('timeout', HTTP_TIMEOUT)  # as web3 does, so that a hung node does not block forever
+
+    response = requests.post(provider.endpoint_uri, data=json.dumps(payload), headers=headers, **request_kwargs)
+    response.raise_for_status()
+    raw_responses = response.json()
+    if isinstance(raw_responses, dict):  # the whole batch was rejected
+        raise ValueError(raw_responses.get('error', raw_responses))
+
+    # responses to a batch may arrive in any order
+    responses_by_id = {r.get('id'): r for r in raw_responses}
+    return [responses_by_id.get(request['id'], {'error': 'missing response'}) for request in payload]
+
+
+def is_known_transaction_error(message):
+    """Whether the error message of a raw transaction send means that the node already has the transaction."""
+    return bool(_KNOWN_TRANSACTION_ERROR.search(message or ''))
+
+
+def hex_to_int(value):
+    """Convert a JSON-RPC quantity to int. Values that are not hex strings (ints, None) are returned as is."""
+    if isinstance(value, string_types):
+        return int(value, 16)
+    return value
+
+
+# transaction fields returned by the node as hex quantities.
+TRANSACTION_QUANTITY_FIELDS = ('blockNumber', 'gas', 'gasPrice', 'nonce', 'transactionIndex', 'value')
+
+
+def format_transaction(tx):
+    """Convert the quantity fields of a raw JSON-RPC transaction to ints, the way web3 does.
+
+    :param dict tx: a raw transaction object, or None.
+
+    :returns: the formatted transaction, or None.
+    :rtype: dict
+    """
+    if not tx:
+        return tx
+    tx = dict(tx)
+    for field in TRANSACTION_QUANTITY_FIELDS:
+        if field in tx:
+            tx[field] = hex_to_int(tx[field])
+    return tx
+
+
+# block fields returned by the node as hex quantities.
+BLOCK_QUANTITY_FIELDS = ('difficulty', 'gasLimit', 'gasUsed', 'number', 'size', 'timestamp', 'totalDifficulty')
+
+
+def format_block(block):
+    """Convert the quantity fields of a raw JSON-RPC block and its transactions to ints, the way web3 does.
+
+    :param dict block: a raw block object, or None.
+
+    :returns: the formatted block, or None.
+    :rtype: dict
+    """
+    if not block:
+        return block
+    block = dict(block)
+    for field in BLOCK_QUANTITY_FIELDS:
+        if field in block:
+            block[field] = hex_to_int(block[field])
+    block['transactions'] = [format_transaction(tx) if isinstance(tx, dict) else tx
+                             for tx in block.get('transactions', [])]
+    return block
@@ -2,10 +2,11 @@
 
 # Copyright (C) 2017 Kin Foundation
 
+from binascii import unhexlify
 import json
-from time import sleep
+import threading
+from time import sleep, time
 
-from eth_abi import decode_abi
 from eth_keys import keys
 from eth_keys.exceptions import ValidationError
 from eth_utils import (
@@ -20,18 +21,45 @@ from web3.contract import Contract
 from web3.utils.encoding import (
     hexstr_if_str,
     to_bytes,
-    to_hex,
 )
 
-from web3.utils.validation import (
-    validate_abi,
-    validate_address,
-)
+from web3.utils.validation import validate_abi
 
+from .address import (
+    address_bytes,
+    canonical_address,
+)
+from .compat import integer_types
 from .exceptions import (
     SdkConfigurationError,
     SdkNotConfiguredError,
 )
+from .export import (
+    DEFAULT_CHUNK_BLOCKS,
+    NPZ,
+    export_transfers,
+)
+from .monitor import (
+    DEFAULT_SEEN_SIZE,
+    BlockTracker,
+    LRUSet,
+    MonitorHandle,
+    PendingTxIngestor,
+    iter_block_range,
+)
+from .rpc import (
+    DEFAULT_BATCH_SIZE,
+    batch_request,
+    chunked_batch_request,
+    format_block,
+    format_transaction,
+    hex_to_int,
+)
+from .subscription import (
+    NEW_HEADS,
+    NEW_PENDING_TRANSACTIONS,
+    SubscriptionClient,
+)
 
 import logging
 logger = logging.getLogger(__name__)
@@ -48,6 +76,12 @@ ERC20_TRANSFER_ABI_PREFIX = encode_hex(function_signature_to_4byte_selector('tra
 DEFAULT_GAS_PER_TX = 90000
 DEFAULT_GAS_PRICE = 50 * 10 ** 9  # 50 gwei
 
+# default filter polling interval, in seconds.
+FILTER_POLL_INTERVAL = 0.2
+
+# the number of caught up blocks between checkpoint saves.
+CHECKPOINT_INTERVAL = 100
+
 # default request retry configuration (linear backoff).
 RETRY_ATTEMPTS = 3
 RETRY_DELAY = 0.3
@@ -60,16 +94,23 @@ class TransactionStatus:
     PENDING = 1
     SUCCESS = 2
     FAIL = 3
+    ROLLED_BACK = 4  # the transaction was reported mined, but its block was orphaned by a chain reorganization
 
 
 class TransactionData(object):
     """Token transaction data holder"""
-    from_address = None
-    to_address = None
-    ether_amount = 0
-    token_amount = 0
-    status = TransactionStatus.UNKNOWN
-    num_confirmations = -1
+    __slots__ = ('tx_id', 'from_address', 'to_address', 'ether_amount', 'token_amount', 'status',
+                 'num_confirmations')
+
+    def __init__(self, tx_id=None, from_address=None, to_address=None, ether_amount=0, token_amount=0,
+                 status=TransactionStatus.UNKNOWN, num_confirmations=-1):
+        self.tx_id = tx_id
+        self.from_address = from_address
+        self.to_address = to_address
+        self.ether_amount = ether_amount
+        self.token_amount = token_amount
+        self.status = status
+        self.num_confirmations = num_confirmations
 
 
 class TokenSDK(object):
@@ -81,7 +122,9 @@ class TokenSDK(object):
 
     def __init__(self, keyfile='', password='', private_key='',
                  provider='', provider_endpoint_uri='http://159.89.240.147:8545',
-                 contract_address=KIN_CONTRACT_ADDRESS, contract_abi=KIN_ABI):
+                 contract_address=KIN_CONTRACT_ADDRESS, contract_abi=KIN_ABI, base_units=False,
+                 subscription_endpoint_uri='', dispatcher=None, confirmations=1, checkpoint=None, cache=None,
+                 wallet=None):
         """Create a new instance of the KIN SDK.
 
         The SDK needs a JSON-RPC provider, contract definitions and the wallet private key.
@@ -114,6 +157,43 @@ class TokenSDK(object):
 
         :param dict contract_abi: The contract ABI. If not provided, a default KIN contract ABI will be used.
 
+        :param bool base_units: if True, all amounts (balances, amounts to send, monitoring callbacks and
+            transaction data) are integers in base units (Wei for Ether, 10^-18 KIN for tokens) and no
+            Decimal/float conversions take place. By default, amounts are in Ether and KIN.
+
+        :param str subscription_endpoint_uri: a WebSocket URI (`ws://` or `wss://`) or an IPC socket path of the
+            node. If provided, transaction monitoring receives new blocks and pending transactions pushed over a
+            persistent connection using `eth_subscribe`, instead of polling filters. WebSocket endpoints require
+            the `websocket-client` package.
+
+        :param dispatcher: a dispatcher to run the monitoring callbacks on. If not provided, the callbacks are called
+            directly by the threads receiving new blocks and pending transactions, so slow callbacks delay them.
+            The callbacks of a monitored address are called in order.
+        :type dispatcher: :class:`~kin.Dispatcher`
+
+        :param int confirmations: the number of block confirmations (including the transaction block itself) after
+            which monitoring reports a mined transaction. With the default of 1, transactions are reported as soon
+            as they are mined. If a block whose transactions were reported is orphaned by a chain reorganization,
+            the transactions are reported again with the `ROLLED_BACK` status, and reported again once mined in
+            the new chain.
+
+        :param checkpoint: a checkpoint store to resume monitoring from. The last processed block is saved to the
+            checkpoint, and when monitoring starts, the blocks produced since the saved block are fetched in parallel
+            and processed before following new blocks. While catching up, the checkpoint is saved every
+            `CHECKPOINT_INTERVAL` blocks, so a crash may report that many blocks again. Note that with a dispatcher,
+            a block is considered processed once its callbacks are queued.
+        :type checkpoint: :class:`~kin.FileCheckpoint` or :class:`~kin.SqliteCheckpoint`
+
+        :param cache: a cache for balances and token contract values. Cached balances of an address are invalidated
+            when the SDK sends a transaction involving the address, and when monitoring reports a transaction
+            involving it. Monitoring also reports new blocks to the cache.
+        :type cache: :class:`~kin.Cache`
+
+        :param wallet: a wallet loaded with :func:`~kin.load_wallets`, used instead of a private key or keyfile.
+            If the wallet keystore is still being decrypted, the SDK is usable right away, and the first transaction
+            sent waits for the decryption.
+        :type wallet: :class:`~kin.Wallet`
+
         :returns: An instance of the SDK.
         :rtype: :class:`~kin.TokenSDK`
 
@@ -127,7 +207,7 @@ class TokenSDK(object):
             raise SdkConfigurationError('token contract address not provided')
 
         try:
-            validate_address(contract_address)
+            token_address = canonical_address(contract_address)
         except ValueError:
             raise SdkConfigurationError('invalid token contract address')
 
@@ -139,18 +219,24 @@ class TokenSDK(object):
         except Exception as e:
             raise SdkConfigurationError('invalid token contract abi: ' + str(e))
 
-        if provider:
-            self.web3 = Web3(provider)
-        else:
-            self.web3 = Web3(HTTPProvider(provider_endpoint_uri))
+        if confirmations < 1:
+            raise SdkConfigurationError('confirmations must be positive')
+
+        self.provider = provider or HTTPProvider(provider_endpoint_uri)
+        self.web3 = Web3(self.provider)
         if not self.web3.isConnected():
             raise SdkConfigurationError('cannot connect to provider endpoint')
 
         self.token_contract = self.web3.eth.contract(contract_address, abi=contract_abi, ContractFactoryClass=Contract)
+        self._token_address = token_address
+        self.base_units = base_units
         self.private_key = None
         self.address = None
+        self._wallet = wallet
 
-        if keyfile:
+        if wallet:
+            self.address = self.web3.eth.defaultAccount = wallet.address
+        elif keyfile:
             with open(keyfile, 'r') as f:
                 try:
                     keystore = json.load(f)
@@ -174,9 +260,30 @@ class TokenSDK(object):
                 raise SdkConfigurationError('cannot load private key: ' + str(e))
             self.address = self.web3.eth.defaultAccount = pk.public_key.to_checksum_address()
 
-        # monitoring filters
-        self._pending_tx_filter = None
-        self._new_block_filter = None
+        # monitoring filters, polled by a single thread
+        self._pending_tx_filter_id = None
+        self._new_block_filter_id = None
+        self._filter_poll_thread = None
+        self._filter_poll_stop = None
+
+        # monitoring subscriptions, used instead of the filters if the subscription endpoint is provided
+        self.subscription_endpoint_uri = subscription_endpoint_uri
+        self._subscription_client = None
+
+        self.dispatcher = dispatcher
+
+        # monitoring state: all monitors share the ingestion of new blocks and pending transactions
+        self.confirmations = confirmations
+        self._monitors = []  # (callback_fn, match_fn, mined_status_fn) tuples, replaced rather than modified
+        self._monitor_lock = threading.RLock()  # reentrant, so that callbacks can stop monitors
+        self._sharded_monitors = []  # started by monitor_token_transactions_sharded, stopped by close
+        self._block_tracker = None
+        self._pending_tx_ingestor = None
+        self._mined_tx_ids = LRUSet(DEFAULT_SEEN_SIZE)  # to report pending transactions only until mined
+        self.checkpoint = checkpoint
+        self._catch_up_stats = None
+
+        self.cache = cache
 
     def get_address(self):
         """Get public address of the SDK wallet.
@@ -195,99 +302,128 @@ class TokenSDK(object):
         """Get Ether balance of the SDK wallet.
         The wallet is configured by a private key supplied in during SDK initialization.
 
-        :returns: : the balance in Ether of the internal wallet.
-        :rtype: Decimal
+        :returns: : the balance in Ether of the internal wallet, or in Wei in base units mode.
+        :rtype: Decimal or int
 
         :raises: :class:`~kin.exceptions.SdkConfigurationError`: if the SDK was not configured with a private key.
         """
         if not self.address:
             raise SdkNotConfiguredError('address not configured')
-        return self.web3.fromWei(self.web3.eth.getBalance(self.address), 'ether')
+        return self.get_address_ether_balance(self.address)
 
     def get_token_balance(self):
         """Get KIN balance of the SDK wallet.
         The wallet is configured by a private key supplied in during SDK initialization.
 
-        :returns: : the balance in KIN of the internal wallet.
-        :rtype: Decimal
+        :returns: : the balance in KIN of the internal wallet, or in base units in base units mode.
+        :rtype: Decimal or int
 
         :raises: :class:`~kin.exceptions.SdkConfigurationError`: if the SDK was not configured with a private key.
         """
         if not self.address:
             raise SdkNotConfiguredError('address not configured')
-        return self.web3.fromWei(self.token_contract.call().balanceOf(self.address), 'ether')
+        return self.get_address_token_balance(self.address)
 
     def get_address_ether_balance(self, address):
         """Get Ether balance of a public address.
 
         :param: str address: a public address to query.
 
-        :returns: the balance in Ether of the provided address.
-        :rtype: Decimal
+        :returns: the balance in Ether of the provided address, or in Wei in base units mode.
+        :rtype: Decimal or int
 
         :raises: ValueError: if the supplied address has a wrong format.
         """
-        validate_address(address)
-        return self.web3.fromWei(self.web3.eth.getBalance(address), 'ether')
+        address = canonical_address(address)
+        balance = self._cached(('ether_balance', address), lambda: self.web3.eth.getBalance(address.checksum))
+        return self._from_base_units(balance)
 
     def get_address_token_balance(self, address):
         """Get KIN balance of a public address.
 
         :param: str address: a public address to query.
 
-        :returns: : the balance in KIN of the provided address.
-        :rtype: Decimal
+        :returns: : the balance in KIN of the provided address, or in base units in base units mode.
+        :rtype: Decimal or int
 
         :raises: ValueError: if the supplied address has a wrong format.
         """
-        validate_address(address)
-        return self.web3.fromWei(self.token_contract.call().balanceOf(address), 'ether')
+        address = canonical_address(address)
+        balance = self._cached(('token_balance', address),
+                               lambda: self.token_contract.call().balanceOf(address.checksum))
+        return self._from_base_units(balance)
+
+    def get_token_decimals(self):
+        """Get the number of decimals of the token.
+
+        :returns: the number of decimals.
+        :rtype: int
+        """
+        return self._cached(('token', 'decimals'), lambda: self.token_contract.call().decimals(), static=True)
+
+    def get_token_symbol(self):
+        """Get the symbol of the token.
+
+        :returns: the token symbol.
+        :rtype: str
+        """
+        return self._cached(('token', 'symbol'), lambda: self.token_contract.call().symbol(), static=True)
+
+    def get_token_total_supply(self):
+        """Get the total supply of the token.
+
+        :returns: the total supply in KIN, or in base units in base units mode.
+        :rtype: Decimal or int
+        """
+        return self._from_base_units(self._cached(('token', 'totalSupply'),
+                                                  lambda: self.token_contract.call().totalSupply()))
 
     def send_ether(self, address, amount):
         """Send Ether from my wallet to address.
 
         :param str address: the address to send Ether to.
 
-        :param float amount: the amount of Ether to transfer.
+        :param float amount: the amount of Ether to transfer. In base units mode, an int amount of Wei.
 
         :return: transaction id
         :rtype: str
 
         :raises: :class:`~kin.exceptions.SdkConfigurationError`: if the SDK was not configured with a private key.
-        :raises: ValueError: if the amount is not positive.
+        :raises: ValueError: if the amount is not positive, or is not an int in base units mode.
         :raises: ValueError: if the nonce is incorrect.
         :raises: ValueError if insufficient funds for for gas * price + value.
         """
         if not self.address:
             raise SdkNotConfiguredError('address not configured')
-        validate_address(address)
-        if amount <= 0:
-            raise ValueError('amount must be positive')
-        return self._send_raw_transaction(address, amount)
+        address = canonical_address(address)
+        value = self._to_base_units(amount)
+        tx_id = self._send_raw_transaction(address.checksum, value)
+        self._invalidate_balances(self.address, address)
+        return tx_id
 
     def send_tokens(self, address, amount):
         """Send tokens from my wallet to address.
 
         :param str address: the address to send tokens to.
 
-        :param float amount: the amount of tokens to transfer.
+        :param float amount: the amount of tokens to transfer. In base units mode, an int amount of base units.
 
         :returns: transaction id
         :rtype: str
 
         :raises: :class:`~kin.exceptions.SdkConfigurationError`: if the SDK was not configured with a private key.
-        :raises: ValueError: if the amount is not positive.
+        :raises: ValueError: if the amount is not positive, or is not an int in base units mode.
         :raises: ValueError: if the nonce is incorrect.
         :raises: ValueError if insufficient funds for for gas * price.
         """
         if not self.address:
             raise SdkNotConfiguredError('address not configured')
-        validate_address(address)
-        if amount <= 0:
-            raise ValueError('amount must be positive')
-        hex_data = self.token_contract._encode_transaction_data('transfer', args=(address, self.web3.toWei(amount, 'ether')))
-        data = hexstr_if_str(to_bytes, hex_data)
-        return self._send_raw_transaction(self.token_contract.address, 0, data)
+        address = canonical_address(address)
+        value = self._to_base_units(amount)
+        data = self._encode_token_transfer(address.checksum, value)
+        tx_id = self._send_raw_transaction(self.token_contract.address, 0, data)
+        self._invalidate_balances(self.address, address)
+        return tx_id
 
     def get_transaction_status(self, tx_id):
         """Get the transaction status.
@@ -309,13 +445,13 @@ class TokenSDK(object):
         :return: transaction data
         :rtype: :class:`~kin.TransactionData`
         """
-        tx_data = TransactionData()
+        tx_data = TransactionData(tx_id)
         tx = self.web3.eth.getTransaction(tx_id)
         if not tx:
             return tx_data
         tx_data.from_address = tx['from']
         tx_data.to_address = tx['to']
-        tx_data.ether_amount = float(self.web3.fromWei(tx['value'], 'ether'))
+        tx_data.ether_amount = self._tx_data_amount(tx['value'])
         tx_data.status = self._get_tx_status(tx)
         if not tx.get('blockNumber'):
             tx_data.num_confirmations = 0
@@ -323,56 +459,88 @@ class TokenSDK(object):
             tx_block_number = int(tx['blockNumber'])
             cur_block_number = int(self.web3.eth.blockNumber)
             tx_data.num_confirmations = cur_block_number - tx_block_number + 1
-        if tx.get('input') and not (tx['input'] == '0x' or tx['input'] == '0x0'):  # contract transaction
-            to, amount = decode_abi(['uint256', 'uint256'], tx['input'][len(ERC20_TRANSFER_ABI_PREFIX):])
-            tx_data.to_address = to_hex(to)
-            tx_data.token_amount = float(self.web3.fromWei(amount, 'ether'))
+        transfer = self._parse_token_transfer(tx)
+        if transfer:
+            tx_data.to_address = transfer[0]
+            tx_data.token_amount = self._tx_data_amount(transfer[1])
         return tx_data
 
+    def get_transactions_data(self, tx_ids, batch_size=DEFAULT_BATCH_SIZE):
+        """Gets data of many transactions at once.
+        Transactions and receipts are fetched with batched JSON-RPC requests, and the number of confirmations
+        of all transactions is calculated against the same head block.
+
+        :param list tx_ids: transaction ids
+
+        :param int batch_size: the maximal number of calls in a single JSON-RPC batch request.
+
+        :return: transaction data, in the same order as the supplied transaction ids
+        :rtype: list of :class:`~kin.TransactionData`
+        """
+        tx_ids = list(tx_ids)
+        calls = [('eth_blockNumber', [])] + [('eth_getTransactionByHash', [tx_id]) for tx_id in tx_ids]
+        results = chunked_batch_request(self.provider, calls, batch_size)
+        cur_block_number = hex_to_int(results[0])
+        txs = results[1:]
+
+        mined_tx_ids = [tx['hash'] for tx in txs if tx and tx.get('blockNumber')]
+        receipt_calls = [('eth_getTransactionReceipt', [tx_id]) for tx_id in mined_tx_ids]
+        receipts = dict(zip(mined_tx_ids, chunked_batch_request(self.provider, receipt_calls, batch_size)))
+
+        tx_data_list = []
+        for tx_id, tx in zip(tx_ids, txs):
+            if not tx:
+                tx_data_list.append(TransactionData(tx_id))
+                continue
+            tx_block_number = hex_to_int(tx.get('blockNumber'))
+            tx_data = TransactionData(
+                tx_id,
+                from_address=tx['from'],
+                to_address=tx['to'],
+                ether_amount=self._tx_data_amount(hex_to_int(tx['value'])),
+                status=self._get_tx_status(tx, receipts.get(tx['hash'])),
+                num_confirmations=cur_block_number - tx_block_number + 1 if tx_block_number else 0,
+            )
+            transfer = self._parse_token_transfer(tx)
+            if transfer:
+                tx_data.to_address = transfer[0]
+                tx_data.token_amount = self._tx_data_amount(transfer[1])
+            tx_data_list.append(tx_data)
+        return tx_data_list
+
     def monitor_ether_transactions(self, callback_fn, from_address=None, to_address=None):
         """Monitors Ether transactions and calls back on transactions matching the supplied filter.
 
-        :param callback_fn: the callback function with the signature `func(tx_id, status, from_address, to_address, amount)`
+        :param callback_fn: the callback function with the signature `func(tx_id, status, from_address, to_address, amount)`.
+            The amount is a Decimal, or an int in base units mode.
 
         :param str from_address: the transactions must originate from this address. If not provided,
             all addresses will match.
 
         :param str to_address: the transactions must be sent to this address. If not provided,
             all addresses will match.
+
+        :returns: the monitor handle, used to stop the monitor.
+        :rtype: :class:`~kin.monitor.MonitorHandle`
         """
         filter_args = self._get_filter_args(from_address, to_address)
+        callback_fn = self._dispatched(callback_fn, filter_args)
+        from_raw, to_raw = self._get_filter_bytes(filter_args)
 
-        def check_and_callback(tx, status):
+        def match_fn(tx):
             if tx.get('input') and not (tx['input'] == '0x' or tx['input'] == '0x0'):  # contract transaction, skip it
-                return
-            if ('from' in filter_args and tx['from'].lower() == filter_args['from'].lower() and
-                    ('to' not in filter_args or tx['to'].lower() == filter_args['to'].lower()) or
-                    ('to' in filter_args and tx['to'].lower() == filter_args['to'].lower())):
-                callback_fn(tx['hash'], status, tx['from'], tx['to'], self.web3.fromWei(tx['value'], 'ether'))
-
-        def pending_tx_callback_adapter_fn(tx_id):
-            tx = self.web3.eth.getTransaction(tx_id)
-            if not tx:  # probably invalid and removed from tx pool
-                return
-            check_and_callback(tx, TransactionStatus.PENDING)
-
-        def new_block_callback_adapter_fn(block_id):
-            block = self.web3.eth.getBlock(block_id, True)
-            for tx in block['transactions']:
-                check_and_callback(tx, TransactionStatus.SUCCESS)  # TODO: number of block confirmations
+                return None
+            if self._match_filter(from_raw, to_raw, address_bytes(tx['from']), address_bytes(tx['to'])):
+                return tx['from'], tx['to'], self._from_base_units(tx['value'])
+            return None
 
-        if not self._pending_tx_filter:
-            self._pending_tx_filter = self.web3.eth.filter('pending')
-        self._pending_tx_filter.watch(pending_tx_callback_adapter_fn)
-
-        if not self._new_block_filter:
-            self._new_block_filter = self.web3.eth.filter('latest')
-        self._new_block_filter.watch(new_block_callback_adapter_fn)
+        return self._watch(callback_fn, match_fn, lambda tx: TransactionStatus.SUCCESS)
 
     def monitor_token_transactions(self, callback_fn, from_address=None, to_address=None):
         """Monitors token transactions and calls back on transactions matching the supplied filter.
 
-        :param callback_fn: the callback function with the signature `func(tx_id, status, from_address, to_address, amount)`
+        :param callback_fn: the callback function with the signature `func(tx_id, status, from_address, to_address, amount)`.
+            The amount is a Decimal, or an int in base units mode.
 
         :param str from_address: the transactions must originate from this address. If not provided,
             all addresses will match.
@@ -381,8 +549,12 @@ class TokenSDK(object):
             all addresses will match. Note that token transactions are always sent to the contract, and the real
             recipient is found in transaction data. This function will decode the data and return the correct
             recipient address.
+
+        :returns: the monitor handle, used to stop the monitor.
+        :rtype: :class:`~kin.monitor.MonitorHandle`
         """
         filter_args = self._get_filter_args(from_address, to_address)
+        callback_fn = self._dispatched(callback_fn, filter_args)
 
         '''Not used: event log filtering.
         filter_params = {
@@ -413,37 +585,484 @@ class TokenSDK(object):
             #    self.web3.eth.uninstallFilter(transfer_filter.filter_id)
         '''
 
-        def pending_tx_callback_adapter_fn(tx_id):
-            tx = self.web3.eth.getTransaction(tx_id)
-            if not tx:  # probably invalid and removed from tx pool
-                return
+        def match_fn(tx):
             ok, tx_from, tx_to, amount = self._check_parse_contract_tx(tx, filter_args)
-            if ok:
-                callback_fn(tx['hash'], TransactionStatus.PENDING, tx_from, tx_to, amount)
+            return (tx_from, tx_to, amount) if ok else None
+
+        return self._watch(callback_fn, match_fn, self._get_tx_status)
+
+    def monitor_token_transactions_sharded(self, callback_fn, addresses, num_workers=None):
+        """Monitors the token transactions of a large set of addresses, calling back from worker processes.
+        Every block is fetched, decoded and matched once, by a single ingestion thread, and the transfers of the
+        watched addresses are partitioned by address across the workers, so that the callbacks are not limited to a
+        single core. Mined transactions are reported with the SDK confirmations, pending transactions are not
+        reported. See :class:`~kin.ShardedTokenMonitor`.
+
+        :param callback_fn: the callback function with the signature
+            `func(address, tx_id, status, from_address, to_address, amount)`, where `address` is the watched address
+            of the transfer. It is called in a worker process.
+
+        :param list addresses: the addresses to watch. More can be added with :meth:`~kin.ShardedTokenMonitor.watch`.
+
+        :param int num_workers: the number of worker processes. Defaults to the number of CPUs.
+
+        :returns: the started monitor. It is stopped by :meth:`close`.
+        :rtype: :class:`~kin.ShardedTokenMonitor`
+        """
+        from .sharding import ShardedTokenMonitor
+        monitor = ShardedTokenMonitor(self.provider, callback_fn, self.token_contract.address,
+                                      num_workers=num_workers, confirmations=self.confirmations,
+                                      base_units=self.base_units, cache=self.cache)
+        monitor.watch(*addresses)
+        monitor.start()
+        with self._monitor_lock:
+            self._sharded_monitors.append(monitor)
+        return monitor
 
-        def new_block_callback_adapter_fn(block_id):
-            block = self.web3.eth.getBlock(block_id, True)
-            for tx in block['transactions']:
-                ok, tx_from, tx_to, amount = self._check_parse_contract_tx(tx, filter_args)
-                if ok:
-                    status = self._get_tx_status(tx)
-                    callback_fn(tx['hash'], status, tx_from, tx_to, amount)
+    def export_transfers(self, path, first_block, last_block, format=NPZ, chunk_blocks=DEFAULT_CHUNK_BLOCKS):
+        """Export the token transfers of a block range in a columnar format, for analytics.
+        Transfers are read from the token contract `Transfer` event logs, fetched and written in chunks of blocks.
+        Requires the `numpy` package, and `pyarrow` for the `arrow` and `parquet` formats.
+        See :func:`~kin.export.decode_transfer_logs` for the exported columns.
 
-        if not self._pending_tx_filter:
-            self._pending_tx_filter = self.web3.eth.filter('pending')
-        self._pending_tx_filter.watch(pending_tx_callback_adapter_fn)
+        :param str path: the output path. For the `npz` format, a directory of compressed NumPy files, one per
+            chunk with transfers. For the `arrow` (Arrow IPC stream) and `parquet` formats, a single file.
+
+        :param int first_block: the first block number.
+
+        :param int last_block: the last block number (inclusive).
+
+        :param str format: one of `npz`, `arrow` or `parquet`.
+
+        :param int chunk_blocks: the number of blocks per chunk.
+
+        :returns: the number of exported transfers.
+        :rtype: int
+
+        :raises: ValueError: if the format is invalid.
+        :raises: :class:`~kin.exceptions.SdkConfigurationError`: if a package required for the format is missing.
+        """
+        return export_transfers(self.provider, self.token_contract.address, path, first_block, last_block,
+                                format=format, chunk_blocks=chunk_blocks)
+
+    def get_monitoring_stats(self):
+        """Get transaction monitoring statistics.
+
+        :returns: a dict with the following fields:
+            - monitors: the number of registered monitors.
+            - threads: the number of threads ingesting new blocks and pending transactions. It does not depend
+              on the number of monitors.
+            - filters: the number of filters installed on the node.
+            - subscriptions: the number of node subscriptions, when using the subscription endpoint.
+            - reorgs: the number of chain reorganizations detected.
+            - pending: pending transaction ingestion counters, see :meth:`~kin.monitor.PendingTxIngestor.stats`.
+            - dispatcher: the dispatcher counters, see :meth:`~kin.Dispatcher.stats`.
+            - catch_up: the number of blocks caught up from the checkpoint, the time it took in seconds
+              and the throughput in blocks per second.
+            Fields of components not in use are None.
+        :rtype: dict
+        """
+        with self._monitor_lock:
+            threads = 0
+            if self._filter_poll_thread and self._filter_poll_thread.is_alive():
+                threads += 1
+            if self._pending_tx_ingestor and self._pending_tx_ingestor.running:
+                threads += 1
+            if self._subscription_client:
+                threads += 1
+            return {
+                'monitors': len(self._monitors),
+                'threads': threads,
+                'filters': len([filter_id for filter_id in (self._pending_tx_filter_id, self._new_block_filter_id)
+                                if filter_id is not None]),
+                'subscriptions': self._subscription_client.num_subscriptions if self._subscription_client else 0,
+                'reorgs': self._block_tracker.reorgs if self._block_tracker else 0,
+                'pending': self._pending_tx_ingestor.stats() if self._pending_tx_ingestor else None,
+                'dispatcher': self.dispatcher.stats() if self.dispatcher else None,
+                'catch_up': self._catch_up_stats,
+            }
+
+    def get_cache_stats(self):
+        """Get the cache counters, see :meth:`~kin.Cache.stats`.
+
+        :returns: the cache counters, or None if the SDK was not configured with a cache.
+        :rtype: dict
+        """
+        return self.cache.stats() if self.cache else None
 
-        if not self._new_block_filter:
-            self._new_block_filter = self.web3.eth.filter('latest')
-        self._new_block_filter.watch(new_block_callback_adapter_fn)
+    def close(self):
+        """Stop all the monitors and release the monitoring resources: uninstall the node filters, stop the
+        monitoring threads, the subscription connection and the sharded monitors, and close the dispatcher, if
+        configured, after it calls the queued callbacks. Must not be called from a monitoring callback.
+        """
+        with self._monitor_lock:
+            self._monitors = []
+            ingestion = self._detach_ingestion()
+            sharded_monitors, self._sharded_monitors = self._sharded_monitors, []
+        self._release_ingestion(ingestion, wait=True)
+        for monitor in sharded_monitors:
+            monitor.close()
+        if self.dispatcher:
+            self.dispatcher.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     # helpers
 
-    def _get_tx_status(self, tx):
+    def _dispatched(self, callback_fn, filter_args):
+        """Wrap a monitoring callback to be called by the dispatcher, if configured.
+        The calls are ordered per monitored address: the recipient address of the filter if provided, the sender
+        address otherwise. Calls of all the monitors of an address go to the same worker.
+
+        :param callback_fn: the monitoring callback function.
+
+        :param dict filter_args: the monitoring filter that contains fields 'to', 'from' or both.
+
+        :returns: the callback function to use.
+        """
+        if not self.dispatcher:
+            return callback_fn
+        from_raw, to_raw = self._get_filter_bytes(filter_args)
+        key = to_raw or from_raw
+
+        def dispatched_callback_fn(*args):
+            self.dispatcher.submit(key, callback_fn, *args)
+        return dispatched_callback_fn
+
+    def _watch(self, callback_fn, match_fn, mined_status_fn):
+        """Register a monitor. The first monitor starts the ingestion of new blocks and pending transactions:
+        if the subscription endpoint is configured, they are driven by `eth_subscribe` notifications,
+        otherwise by polling the `pending` and `latest` filters. All the monitors share the ingestion, so the
+        number of threads does not grow with the number of monitors. Stopping the last monitor stops the ingestion.
+        If the ingestion cannot be started (e.g. the node rejects a filter), the error is raised, the monitor is not
+        registered, and the next monitor tries again.
+
+        :param callback_fn: the monitoring callback function.
+
+        :param match_fn: a function with the signature `func(tx)` returning a (from address, to address, amount)
+            tuple if the transaction matches the monitor, or None otherwise.
+
+        :param mined_status_fn: a function with the signature `func(tx)` returning the status of a mined transaction.
+
+        :returns: the monitor handle.
+        :rtype: :class:`~kin.monitor.MonitorHandle`
+        """
+        monitor = (callback_fn, match_fn, mined_status_fn)
+        with self._monitor_lock:
+            self._monitors = self._monitors + [monitor]
+            if not self._block_tracker:
+                try:
+                    self._start_ingestion()
+                except Exception:
+                    # do not leave a half started ingestion behind, so that the next monitor starts over
+                    self._monitors = [m for m in self._monitors if m is not monitor]
+                    self._release_ingestion(self._detach_ingestion(), wait=False)
+                    raise
+        return MonitorHandle(lambda: self._unwatch(monitor))
+
+    def _unwatch(self, monitor):
+        """Unregister a monitor. If it was the last one, stop the ingestion without waiting for the threads,
+        since a monitoring callback may be stopping its own monitor.
+        """
+        with self._monitor_lock:
+            self._monitors = [m for m in self._monitors if m is not monitor]
+            if self._monitors:
+                return
+            ingestion = self._detach_ingestion()
+        self._release_ingestion(ingestion, wait=False)
+
+    def _start_ingestion(self):
+        """Start ingesting new blocks and pending transactions. Must be called with the monitor lock held."""
+        self._block_tracker = BlockTracker(lambda block_hash: self.web3.eth.getBlock(block_hash, True),
+                                           self.confirmations)
+        ingestor = self._pending_tx_ingestor = PendingTxIngestor(self._fetch_txs, self._on_pending_txs)
+        ingestor.start()
+
+        if self.subscription_endpoint_uri:
+            self._subscription_client = SubscriptionClient(self.subscription_endpoint_uri)
+            self._subscription_client.start()
+            self._subscription_client.subscribe(NEW_PENDING_TRANSACTIONS, lambda tx_id: ingestor.add([tx_id]))
+            self._subscription_client.subscribe(NEW_HEADS, lambda header: self._on_new_block(header['hash']))
+            return
+
+        self._pending_tx_filter_id = self.web3.eth.filter('pending').filter_id
+        self._new_block_filter_id = self.web3.eth.filter('latest').filter_id
+        self._filter_poll_stop = threading.Event()
+        self._filter_poll_thread = threading.Thread(
+            target=self._poll_filters,
+            args=(self._pending_tx_filter_id, self._new_block_filter_id, ingestor, self._filter_poll_stop),
+            name='kin-filter-poller')
+        self._filter_poll_thread.daemon = True
+        self._filter_poll_thread.start()
+
+    def _detach_ingestion(self):
+        """Detach the ingestion components from the SDK. Must be called with the monitor lock held.
+
+        :returns: the detached components, to release with :meth:`_release_ingestion`, or None if not ingesting.
+        :rtype: tuple
+        """
+        if not self._block_tracker:
+            return None
+        ingestion = (self._pending_tx_ingestor, self._subscription_client, self._filter_poll_thread,
+                     self._filter_poll_stop, [filter_id for filter_id in (self._pending_tx_filter_id,
+                                                                          self._new_block_filter_id)
+                                              if filter_id is not None])
+        self._block_tracker = None
+        self._pending_tx_ingestor = None
+        self._subscription_client = None
+        self._filter_poll_thread = None
+        self._filter_poll_stop = None
+        self._pending_tx_filter_id = None
+        self._new_block_filter_id = None
+        return ingestion
+
+    def _release_ingestion(self, ingestion, wait):
+        """Stop the threads and uninstall the filters of detached ingestion components.
+        Must be called without the monitor lock held when waiting, since the threads take the lock.
+
+        :param tuple ingestion: the detached components, as returned by :meth:`_detach_ingestion`.
+
+        :param bool wait: whether to wait for the threads to exit.
+        """
+        if not ingestion:
+            return
+        ingestor, subscription_client, poll_thread, poll_stop, filter_ids = ingestion
+        if poll_stop:
+            poll_stop.set()
+            if wait and poll_thread is not threading.current_thread():
+                poll_thread.join()
+        ingestor.close(wait)
+        if subscription_client:
+            subscription_client.close(wait)
+        for filter_id in filter_ids:
+            try:
+                self.web3.eth.uninstallFilter(filter_id)
+            except Exception as e:
+                logger.warning('cannot uninstall filter %s: %s', filter_id, e)
+
+    def _poll_filters(self, pending_tx_filter_id, new_block_filter_id, ingestor, stop_event):
+        """Poll the pending and latest filters with a single batch request per poll. All the new transaction ids
+        of each poll are passed to the ingestor at once, and the new blocks are tracked in order.
+        """
+        calls = [('eth_getFilterChanges', [pending_tx_filter_id]), ('eth_getFilterChanges', [new_block_filter_id])]
+        while not stop_event.is_set():
+            try:
+                tx_ids, block_hashes = batch_request(self.provider, calls)
+                if tx_ids:
+                    ingestor.add(tx_ids)
+                for block_hash in block_hashes or []:
+                    if stop_event.is_set():
+                        break
+                    self._on_new_block(block_hash)
+            except Exception:
+                logger.exception('filter poll failed')
+            stop_event.wait(FILTER_POLL_INTERVAL)
+
+    def _fetch_txs(self, tx_ids):
+        """Fetch transactions with a batch request.
+
+        :param list tx_ids: transaction ids.
+
+        :returns: the transactions, None for the missing ones.
+        :rtype: list
+        """
+        calls = [('eth_getTransactionByHash', [tx_id]) for tx_id in tx_ids]
+        return [format_transaction(tx) for tx in chunked_batch_request(self.provider, calls)]
+
+    def _on_pending_txs(self, txs):
+        """Report new pending transactions matching the monitors.
+        Transactions already reported as mined are not reported as pending.
+
+        :param list txs: the new pending transactions.
+        """
+        with self._monitor_lock:
+            for tx in txs:
+                if tx['hash'] in self._mined_tx_ids:
+                    continue
+                for callback_fn, match_fn, _ in self._iter_monitors():
+                    match = match_fn(tx)
+                    if match:
+                        self._invalidate_balances(*match[:2])
+                        self._call_monitor_callback(callback_fn, tx['hash'], TransactionStatus.PENDING, *match)
+
+    def _on_new_block(self, block_id):
+        """Track a new block and report the monitored transactions of the confirmed and orphaned blocks.
+        The transactions of orphaned blocks are reported with the `ROLLED_BACK` status, newest first.
+
+        :param block_id: the new block hash.
+        """
+        block = self.web3.eth.getBlock(block_id, True)
+        if not block:  # already orphaned
+            return
+        if self.cache:
+            self.cache.new_block(block['number'])
+        with self._monitor_lock:
+            block_tracker = self._block_tracker
+            if not block_tracker:  # monitoring was stopped
+                return
+            catch_up = self.checkpoint and not block_tracker.head
+        if catch_up:
+            self._catch_up(block_tracker, block['number'] - 1)
+        with self._monitor_lock:
+            if self._block_tracker is not block_tracker:  # monitoring was stopped meanwhile
+                return
+            last_confirmed = self._track_block(block)
+            if self.checkpoint and last_confirmed:
+                self.checkpoint.save(last_confirmed.number, last_confirmed.hash)
+
+    def _track_block(self, block):
+        """Add a block to the block tracker and report the monitored transactions of the confirmed and
+        orphaned blocks. Must be called with the monitor lock held.
+
+        :param dict block: the block.
+
+        :returns: the last confirmed block entry, if any.
+        :rtype: :class:`~kin.monitor.BlockEntry`
+        """
+        if not self._block_tracker:  # monitoring was stopped by a callback
+            return None
+        orphaned, confirmed = self._block_tracker.add(block)
+
+        for entry in orphaned:
+            for monitor, event in reversed(entry.events):
+                # the transaction may be pending again, and reported as such
+                self._mined_tx_ids.discard(event[0])
+                if self._pending_tx_ingestor:
+                    self._pending_tx_ingestor.forget(event[0])
+                self._invalidate_balances(*event[2:4])
+                if monitor in self._monitors:
+                    self._call_monitor_callback(monitor[0], event[0], TransactionStatus.ROLLED_BACK, *event[2:])
+
+        for entry in confirmed:
+            for tx in entry.block['transactions']:
+                for monitor in self._iter_monitors():
+                    callback_fn, match_fn, mined_status_fn = monitor
+                    match = match_fn(tx)
+                    if match:
+                        event = (tx['hash'], mined_status_fn(tx)) + tuple(match)
+                        entry.events.append((monitor, event))
+                        self._mined_tx_ids.add(tx['hash'])
+                        self._invalidate_balances(*match[:2])
+                        self._call_monitor_callback(callback_fn, *event)
+            entry.block = None  # keep only what is needed for a rollback
+        return confirmed[-1] if confirmed else None
+
+    def _iter_monitors(self):
+        """Iterate over the registered monitors. Must be called with the monitor lock held.
+        Monitors stopped during the iteration (by a callback) are skipped.
+        """
+        monitors = self._monitors
+        for monitor in monitors:
+            if monitors is self._monitors or monitor in self._monitors:
+                yield monitor
+
+    def _catch_up(self, block_tracker, last_block_number):
+        """Process the blocks from the checkpoint up to the given block, fetching them in parallel.
+        Called before the first live block is tracked. The live block is then linked to the caught up chain by the
+        block tracker, so that no block is missed or processed twice. The blocks are fetched without the monitor
+        lock, which is held only to track each block, so that monitors can be stopped meanwhile. The checkpoint is
+        saved without the lock every `CHECKPOINT_INTERVAL` blocks, and once more when the catch up ends or is
+        stopped, so that the reported blocks are not reported again.
+
+        :param block_tracker: the block tracker of the monitoring being started.
+        :type block_tracker: :class:`~kin.monitor.BlockTracker`
+
+        :param int last_block_number: the last block number to catch up to.
+        """
+        saved = self.checkpoint.load()
+        if not saved:
+            return
+        checkpoint_number, checkpoint_hash = saved
+        with self._monitor_lock:
+            if self._block_tracker is not block_tracker:  # monitoring was stopped
+                return
+            block_tracker.seed(checkpoint_number, checkpoint_hash)
+        logger.info('catching up from block %d to block %d', checkpoint_number, last_block_number)
+
+        start = time()
+        num_blocks = 0
+        last_confirmed = None
+        for block in iter_block_range(self._fetch_blocks, checkpoint_number + 1, last_block_number):
+            with self._monitor_lock:
+                if self._block_tracker is not block_tracker:  # monitoring was stopped meanwhile
+                    break
+                last_confirmed = self._track_block(block) or last_confirmed
+            num_blocks += 1
+            if last_confirmed and num_blocks % CHECKPOINT_INTERVAL == 0:
+                self.checkpoint.save(last_confirmed.number, last_confirmed.hash)
+        if last_confirmed:
+            self.checkpoint.save(last_confirmed.number, last_confirmed.hash)
+
+        duration = time() - start
+        self._catch_up_stats = {
+            'blocks': num_blocks,
+            'seconds': duration,
+            'blocks_per_second': num_blocks / duration if duration else 0,
+        }
+        logger.info('caught up %d blocks in %.2f seconds', num_blocks, duration)
+
+    def _fetch_blocks(self, first, last):
+        """Fetch a range of full blocks with a batch request.
+
+        :param int first: the first block number.
+
+        :param int last: the last block number (inclusive).
+
+        :returns: the blocks, with their transactions.
+        :rtype: list
+        """
+        calls = [('eth_getBlockByNumber', ['0x%x' % number, True]) for number in range(first, last + 1)]
+        return [format_block(block) for block in batch_request(self.provider, calls) if block]
+
+    def _cached(self, key, load_fn, static=False):
+        """Get a value through the cache, if configured.
+
+        :param tuple key: the value key.
+
+        :param load_fn: a function with the signature `func()` returning the value.
+
+        :param bool static: whether the value never changes.
+
+        :returns: the value.
+        """
+        if not self.cache:
+            return load_fn()
+        return self.cache.get(key, load_fn, static)
+
+    def _invalidate_balances(self, *addresses):
+        """Invalidate the cached balances of addresses.
+
+        :param addresses: the addresses. Empty addresses are ignored.
+        """
+        if not self.cache:
+            return
+        keys = []
+        for address in addresses:
+            if address:
+                address = canonical_address(address)
+                keys.extend([('ether_balance', address), ('token_balance', address)])
+        self.cache.invalidate(*keys)
+
+    @staticmethod
+    def _call_monitor_callback(callback_fn, *args):
+        """Call a monitoring callback, so that a failing callback does not affect the others."""
+        try:
+            callback_fn(*args)
+        except Exception:
+            logger.exception('monitoring callback failed')
+
+    def _get_tx_status(self, tx, tx_receipt=None):
         """Determines transaction status.
 
         :param dict tx: transaction object
 
+        :param dict tx_receipt: transaction receipt, if already fetched. If not provided, it will be
+            requested from the node.
+
         :returns: the status of this transaction.
         :rtype: `kin.TransactionStatus`
         """
@@ -451,7 +1070,8 @@ class TokenSDK(object):
             return TransactionStatus.PENDING
 
         # transaction is mined
-        tx_receipt = self.web3.eth.getTransactionReceipt(tx['hash'])
+        if not tx_receipt:
+            tx_receipt = self.web3.eth.getTransactionReceipt(tx['hash'])
 
         # Byzantium fork introduced a status field
         status = tx_receipt.get('status')
@@ -462,12 +1082,39 @@ class TokenSDK(object):
 
         # pre-Byzantium, no status field
         # failed transaction usually consumes all the gas
-        if tx_receipt.get('gasUsed') < tx.get('gas'):
+        if hex_to_int(tx_receipt.get('gasUsed')) < hex_to_int(tx.get('gas')):
             return TransactionStatus.SUCCESS  # TODO: number of block confirmations
         # WARNING: there can be cases when gasUsed == gas for successful transactions!
         # In our case however, we create our transactions with fixed gas limit
         return TransactionStatus.FAIL
 
+    def _from_base_units(self, value):
+        """Convert a base units value to the amount returned to the user: Ether/KIN Decimal by default,
+        or the value itself in base units mode.
+        """
+        if self.base_units:
+            return value
+        return self.web3.fromWei(value, 'ether')
+
+    def _to_base_units(self, amount):
+        """Convert a user supplied amount to base units, validating it.
+
+        :raises: ValueError: if the amount is not positive, or is not an int in base units mode.
+        """
+        if self.base_units and not isinstance(amount, integer_types):
+            raise ValueError('amount must be an integer in base units mode')
+        if amount <= 0:
+            raise ValueError('amount must be positive')
+        if self.base_units:
+            return amount
+        return self.web3.toWei(amount, 'ether')
+
+    def _tx_data_amount(self, value):
+        """Convert a base units value to a :class:`~kin.TransactionData` amount (float, or int in base units mode)."""
+        if self.base_units:
+            return value
+        return float(self.web3.fromWei(value, 'ether'))
+
     def _check_parse_contract_tx(self, tx, filter_args):
         """Parse contract transaction and check whether it matches the supplied filter.
         If the transaction matches the filter, the first returned value will be True, and the rest will be
@@ -479,30 +1126,50 @@ class TokenSDK(object):
 
         :returns: matching status, from address, to address, token amount
         """
-        if not tx.get('to') or tx['to'].lower() != self.token_contract.address.lower():  # must be sent to our contract
-            return False, '', '', 0
-        if not tx.get('input') or tx['input'] == '0x':  # not a contract transaction
-            return False, '', '', 0
-        if not tx['input'].startswith(ERC20_TRANSFER_ABI_PREFIX):  # only interested in calls to 'transfer' method
+        transfer = self._parse_token_transfer(tx)
+        if not transfer:
             return False, '', '', 0
-
-        to, amount = decode_abi(['uint256', 'uint256'], tx['input'][len(ERC20_TRANSFER_ABI_PREFIX):])
-        to = to_hex(to)
-        amount = self.web3.fromWei(amount, 'ether')
-        if ('from' in filter_args and tx['from'].lower() == filter_args['from'].lower() and
-                ('to' not in filter_args or to.lower() == filter_args['to'].lower()) or
-                ('to' in filter_args and to.lower() == filter_args['to'].lower())):
-            return True, tx['from'], to, amount
+        tx_to, amount = transfer
+        from_raw, to_raw = self._get_filter_bytes(filter_args)
+        if self._match_filter(from_raw, to_raw, address_bytes(tx['from']), address_bytes(tx_to)):
+            return True, tx['from'], tx_to, self._from_base_units(amount)
         return False, '', '', 0
 
-    def _send_raw_transaction(self, address, amount, data=b''):
+    def _parse_token_transfer(self, tx):
+        """Parse a call to the `transfer` method of the token contract.
+
+        :param dict tx: transaction object
+
+        :returns: the recipient address (lowercase hex) and the amount in base units, or None if the transaction is
+            not a token transfer.
+        :rtype: tuple
+        """
+        if address_bytes(tx.get('to')) != self._token_address.raw:  # must be sent to our contract
+            return None
+        if not tx.get('input') or not tx['input'].startswith(ERC20_TRANSFER_ABI_PREFIX):  # 'transfer' calls only
+            return None
+
+        # the arguments are two 32 byte words: the recipient address (right aligned) and the amount.
+        # slicing them is much cheaper than decoding the ABI, and is done for every monitored transaction.
+        args = tx['input'][len(ERC20_TRANSFER_ABI_PREFIX):]
+        if len(args) < 128:
+            return None
+        to_hex_address = args[24:64]
+        try:
+            unhexlify(to_hex_address)
+            amount = int(args[64:128], 16)
+        except (TypeError, ValueError):  # malformed data
+            return None
+        return '0x' + to_hex_address.lower(), amount
+
+    def _send_raw_transaction(self, address, value, data=b''):
         """Send transaction with retry.
         Submitting a raw transaction can result in a nonce collision error. In this case, the submission is
         retried with a new nonce.
 
         :param str address: the target address.
 
-        :param float amount: the amount of Ether to send.
+        :param int value: the amount of Wei to send.
 
         :param data: binary data to put into transaction data field.
 
@@ -512,7 +1179,7 @@ class TokenSDK(object):
         attempts = 0
         while True:
             try:
-                raw_tx_hex = self._build_raw_transaction(address, amount, data)
+                raw_tx_hex = self._build_raw_transaction(address, value, data)
                 return self.web3.eth.sendRawTransaction(raw_tx_hex)
             except ValueError as ve:
                 if 'message' in ve.args[0] \
@@ -525,12 +1192,12 @@ class TokenSDK(object):
                     continue
                 raise
 
-    def _build_raw_transaction(self, address, amount, data=b''):
+    def _build_raw_transaction(self, address, value, data=b''):
         """Builds a raw transaction string.
 
         :param str address: the target address.
 
-        :param float amount: the amount of Ether to send.
+        :param int value: the amount of Wei to send.
 
         :param data: binary data to put into transaction.
 
@@ -538,16 +1205,47 @@ class TokenSDK(object):
         :rtype: str
         """
         nonce = self.web3.eth.getTransactionCount(self.address, 'pending')
+        return self._sign_transaction(address, value, data, nonce)[1]
+
+    def _sign_transaction(self, address, value, data, nonce):
+        """Builds and signs a transaction with the given nonce.
+
+        :param str address: the target address.
+
+        :param int value: the amount of Wei to send.
+
+        :param data: binary data to put into transaction.
+
+        :param int nonce: the transaction nonce.
+
+        :returns: the transaction id (hash) and the raw transaction as a string of hex chars.
+        :rtype: tuple(str, str)
+        """
+        if self.private_key is None and self._wallet:
+            self.private_key = self._wallet.private_key  # waits for the wallet keystore decryption
         # TODO: replace pyethereum code with the newer code in web3.py (v4) and remove pyethereum from requirements.
         tx = Transaction(
             nonce=nonce,
             gasprice=DEFAULT_GAS_PRICE,   # TODO: optimal gas price
             startgas=DEFAULT_GAS_PER_TX,  # TODO: optimal gas limit
             to=address,
-            value=self.web3.toWei(amount, 'ether'),
+            value=value,
             data=data,
         ).sign(self.private_key)
-        return self.web3.toHex(rlp.encode(tx))
+        return encode_hex(tx.hash), self.web3.toHex(rlp.encode(tx))
+
+    def _encode_token_transfer(self, address, value):
+        """Encodes the data of a token transfer transaction.
+
+        :param str address: the address to send tokens to.
+
+        :param int value: the amount of token base units to transfer.
+
+        :returns: binary transaction data.
+        :rtype: bytes
+        """
+        hex_data = self.token_contract._encode_transaction_data('transfer', args=(address, value))
+        return hexstr_if_str(to_bytes, hex_data)
 
     @staticmethod
     def _get_filter_args(from_address, to_address):
@@ -555,13 +1253,28 @@ class TokenSDK(object):
             raise ValueError('either from_address or to_address or both must be provided')
         filter_args = {}
         if from_address:
-            validate_address(from_address)
-            filter_args['from'] = from_address
+            filter_args['from'] = canonical_address(from_address)
         if to_address:
-            validate_address(to_address)
-            filter_args['to'] = to_address
+            filter_args['to'] = canonical_address(to_address)
         return filter_args
 
+    @staticmethod
+    def _get_filter_bytes(filter_args):
+        """Get the raw bytes of the filter addresses, None for the missing ones.
+
+        :returns: the from address bytes and the to address bytes.
+        :rtype: tuple
+        """
+        from_address = filter_args.get('from')
+        to_address = filter_args.get('to')
+        return from_address.raw if from_address else None, to_address.raw if to_address else None
+
+    @staticmethod
+    def _match_filter(from_raw, to_raw, tx_from_raw, tx_to_raw):
+        """Check whether transaction addresses match a filter. All addresses are raw bytes, None if missing."""
+        return (from_raw is not None and tx_from_raw == from_raw and (to_raw is None or tx_to_raw == to_raw) or
+                to_raw is not None and tx_to_raw == to_raw)
+
 
 def create_keyfile(private_key, password, filename):
     """Creates a wallet keyfile.
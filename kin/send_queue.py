@@ -0,0 +1,581 @@
+# -*- coding: utf-8 -*
+
+# Copyright (C) 2017 Kin Foundation
+
+from collections import OrderedDict
+import json
+import os
+import threading
+from time import time
+
+from .address import canonical_address
+from .compat import queue
+from .exceptions import SdkNotConfiguredError
+from .rpc import is_known_transaction_error
+from .sdk import (
+    RETRY_ATTEMPTS,
+    RETRY_DELAY,
+)
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# transaction states, as recorded in the write-ahead log.
+SIGNED = 'signed'        # signed and logged, not yet accepted by the node
+SENT = 'sent'            # accepted by the node
+CONFIRMED = 'confirmed'  # found mined during recovery
+FAILED = 'failed'        # rejected by the node, or its nonce was used by another transaction
+
+POLL_TIMEOUT = 1  # how long the submitter blocks before checking whether it should stop
+MAX_RETRY_DELAY = 30
+DEFAULT_CLOSE_TIMEOUT = 60  # seconds close() waits for the queued transactions to be submitted
+
+DEFAULT_AUDIT_INTERVAL = 10  # seconds between nonce audits
+
+
+class WriteAheadLog(object):
+    """An append-only log of JSON records, one record per line.
+    A partially written last line, left by a crash in the middle of a write, is ignored when loading.
+    """
+
+    def __init__(self, path):
+        """Create a new write-ahead log.
+
+        :param str path: the log file path.
+        """
+        self.path = path
+        self._file = None
+
+    def load(self):
+        """Load all the records in the log.
+
+        :returns: the records.
+        :rtype: list
+        """
+        if not os.path.exists(self.path):
+            return []
+        records = []
+        with open(self.path, 'r') as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    logger.warning('ignoring partially written record in %s', self.path)
+                    break
+                records.append(json.loads(line))
+        return records
+
+    def append(self, records, sync=True):
+        """Append records to the log.
+
+        :param list records: the records to append.
+
+        :param bool sync: whether to flush the records to the disk before returning.
+        """
+        if not self._file:
+            self._file = open(self.path, 'a')
+        self._file.write(''.join(json.dumps(record) + '\n' for record in records))
+        self._file.flush()
+        if sync:
+            os.fsync(self._file.fileno())
+
+    def rewrite(self, records):
+        """Atomically replace the log content with the given records.
+
+        :param list records: the new log records.
+        """
+        self.close()
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(''.join(json.dumps(record) + '\n' for record in records))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.path)
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+
+class SendQueue(object):
+    """A crash-safe queue of outgoing transactions.
+
+    Transactions are assigned locally reserved nonces and signed when queued. Each signed transaction is appended
+    to a write-ahead log on disk before being submitted to the node by a background thread, in nonce order.
+    When started, the queue recovers from the log: it reconciles the logged transactions with the node and
+    resubmits the ones the node does not know.
+
+    Payments may carry an idempotency key. Queuing a payment with a key already in the log returns the original
+    transaction id instead of sending again, so that a payment retried after a crash is sent exactly once.
+    """
+
+    def __init__(self, sdk, wal_path):
+        """Create a new send queue.
+
+        :param sdk: the SDK whose wallet sends the transactions.
+        :type sdk: :class:`~kin.TokenSDK`
+
+        :param str wal_path: the write-ahead log file path.
+
+        :raises: :class:`~kin.exceptions.SdkNotConfiguredError`: if the SDK was not configured with a private key.
+        """
+        if not sdk.address:
+            raise SdkNotConfiguredError('address not configured')
+        self.sdk = sdk
+        self.wal = WriteAheadLog(wal_path)
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # tx_id -> entry, in the order of signing
+        self._keys = {}  # idempotency key -> tx_id
+        self._next_nonce = None
+        self._queue = queue.Queue()
+        self._thread = None
+        self._running = False
+        self._stop_event = threading.Event()  # interrupts the retry delays
+
+    def start(self):
+        """Recover from the write-ahead log and start submitting transactions."""
+        if self._running:
+            return
+        self.recover()
+        self._stop_event.clear()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='kin-send-queue')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self, wait=True, timeout=DEFAULT_CLOSE_TIMEOUT):
+        """Stop submitting transactions. Transactions not submitted yet stay in the write-ahead log, and are
+        submitted when the queue is started again.
+
+        :param bool wait: whether to submit the queued transactions first.
+
+        :param float timeout: the maximal time to wait for the queued transactions to be submitted, in seconds,
+            for example while the node is unreachable. None waits until they are all submitted.
+        """
+        if wait and self._running:
+            self._wait_submitted(timeout)
+        self._running = False
+        self._stop_event.set()
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+        self.wal.close()
+
+    def send_ether(self, address, amount, key=None):
+        """Queue an Ether transfer.
+
+        :param str address: the address to send Ether to.
+
+        :param amount: the amount of Ether to transfer (an int amount of Wei in base units mode).
+
+        :param str key: an optional idempotency key of the payment.
+
+        :returns: transaction id
+        :rtype: str
+
+        :raises: ValueError: if the address or the amount are invalid.
+        """
+        address = canonical_address(address).checksum
+        return self._enqueue([(address, self.sdk._to_base_units(amount), b'', key, address)])[0]
+
+    def send_tokens(self, address, amount, key=None):
+        """Queue a token transfer.
+
+        :param str address: the address to send tokens to.
+
+        :param amount: the amount of tokens to transfer (an int amount of base units in base units mode).
+
+        :param str key: an optional idempotency key of the payment.
+
+        :returns: transaction id
+        :rtype: str
+
+        :raises: ValueError: if the address or the amount are invalid.
+        """
+        return self.send_tokens_many([(address, amount, key)])[0]
+
+    def send_tokens_many(self, payments):
+        """Queue several token transfers. The transfers are logged with a single disk flush.
+
+        :param list payments: a list of (address, amount, key) tuples, where key is an optional idempotency key.
+
+        :returns: the transaction ids, in the order of the payments.
+        :rtype: list
+
+        :raises: ValueError: if any of the addresses or amounts is invalid. In this case nothing is queued.
+        """
+        items = []
+        for address, amount, key in payments:
+            address = canonical_address(address).checksum
+            data = self.sdk._encode_token_transfer(address, self.sdk._to_base_units(amount))
+            items.append((self.sdk.token_contract.address, 0, data, key, address))
+        return self._enqueue(items)
+
+    def get_transaction_state(self, tx_id):
+        """Get the state of a queued transaction.
+
+        :param str tx_id: transaction id.
+
+        :returns: one of `signed`, `sent`, `confirmed` or `failed`, or None if the transaction is not in the queue.
+        :rtype: str
+        """
+        with self._lock:
+            entry = self._entries.get(tx_id)
+            return entry['state'] if entry else None
+
+    def stats(self):
+        """Get the number of transactions in each state, the number of transactions waiting to be submitted
+        and the next nonce to use.
+
+        :rtype: dict
+        """
+        with self._lock:
+            stats = {SIGNED: 0, SENT: 0, CONFIRMED: 0, FAILED: 0}
+            for entry in self._entries.values():
+                stats[entry['state']] += 1
+            stats['queued'] = self._queue.qsize()
+            stats['next_nonce'] = self._next_nonce
+            return stats
+
+    def nonce_snapshot(self):
+        """Get the logged transactions by nonce, and the next nonce to use.
+        Failed transactions are left out, since they did not use their nonce.
+
+        :returns: a dict of nonce to a copy of the transaction entry, and the next nonce (None before the queue
+            was started).
+        :rtype: tuple
+        """
+        with self._lock:
+            entries = dict((entry['nonce'], dict(entry)) for entry in self._entries.values()
+                           if entry['state'] != FAILED)
+            return entries, self._next_nonce
+
+    def resubmit(self, tx_id):
+        """Queue a sent transaction for submission again, after the node dropped it.
+
+        :param str tx_id: transaction id.
+
+        :raises: ValueError: if the transaction is not in the queue.
+        """
+        with self._lock:
+            entry = self._entries.get(tx_id)
+            if not entry:
+                raise ValueError('transaction {} is not in the queue'.format(tx_id))
+            self._queue.put(entry)
+
+    def fill_nonce(self, nonce):
+        """Sign, log and queue a zero-value transfer to self at a nonce that has no transaction.
+
+        :param int nonce: the nonce to fill.
+
+        :returns: the transaction id.
+        :rtype: str
+        """
+        with self._lock:
+            tx_id, raw_tx = self.sdk._sign_transaction(self.sdk.address, 0, b'', nonce)
+            entry = {'op': SIGNED, 'tx_id': tx_id, 'nonce': nonce, 'key': None, 'to': self.sdk.address,
+                     'raw': raw_tx, 'state': SIGNED}
+            self.wal.append([dict((k, v) for k, v in entry.items() if k != 'state')])
+            self._entries[tx_id] = entry
+            self._queue.put(entry)
+            return tx_id
+
+    def recover(self):
+        """Load the write-ahead log and reconcile it with the node.
+        Logged transactions found mined are marked confirmed. Transactions whose nonce was used by another mined
+        transaction are marked failed. All the other unconfirmed transactions are resubmitted, in nonce order.
+        The log is then compacted, keeping the raw transactions only for those not yet confirmed.
+        """
+        entries = OrderedDict()
+        for record in self.wal.load():
+            if record['op'] == SIGNED:
+                entries[record['tx_id']] = dict(record, state=SIGNED)
+            elif record['tx_id'] in entries:
+                entries[record['tx_id']]['state'] = record['op']
+
+        eth = self.sdk.web3.eth
+        confirmed_count = eth.getTransactionCount(self.sdk.address, 'latest')
+        resubmit = []
+        for entry in sorted(entries.values(), key=lambda e: e['nonce']):
+            if entry['state'] in (CONFIRMED, FAILED):
+                continue
+            tx = eth.getTransaction(entry['tx_id'])
+            if tx and tx.get('blockNumber'):
+                entry['state'] = CONFIRMED
+            elif entry['nonce'] < confirmed_count:
+                logger.error('transaction %s failed: nonce %d was used by another transaction',
+                             entry['tx_id'], entry['nonce'])
+                entry['state'] = FAILED
+            else:
+                resubmit.append(entry)
+
+        nonces = [entry['nonce'] + 1 for entry in entries.values() if entry['state'] != FAILED]
+        next_nonce = max([eth.getTransactionCount(self.sdk.address, 'pending')] + nonces)
+
+        records = []
+        for entry in entries.values():
+            record = {'op': SIGNED, 'tx_id': entry['tx_id'], 'nonce': entry['nonce'], 'key': entry.get('key'),
+                      'to': entry.get('to')}
+            if entry['state'] not in (CONFIRMED, FAILED):
+                record['raw'] = entry['raw']
+            records.append(record)
+            if entry['state'] != SIGNED:
+                records.append({'op': entry['state'], 'tx_id': entry['tx_id']})
+        self.wal.rewrite(records)
+
+        with self._lock:
+            self._entries = entries
+            self._keys = dict((entry['key'], tx_id) for tx_id, entry in entries.items() if entry.get('key'))
+            self._next_nonce = next_nonce
+            for entry in resubmit:
+                self._queue.put(entry)
+        logger.info('send queue recovered: %d transactions, %d resubmitted, next nonce %d',
+                    len(entries), len(resubmit), next_nonce)
+
+    def _enqueue(self, items):
+        """Sign, log and queue transactions.
+
+        :param list items: a list of (address, value, data, key, recipient) tuples.
+
+        :returns: the transaction ids.
+        :rtype: list
+        """
+        with self._lock:
+            if self._next_nonce is None:
+                raise ValueError('send queue not started')
+            tx_ids = []
+            keys = {}
+            new_entries = []
+            nonce = self._next_nonce
+            for address, value, data, key, recipient in items:
+                if key is not None:
+                    tx_id = self._keys.get(key) or keys.get(key)
+                    if tx_id:
+                        tx_ids.append(tx_id)
+                        continue
+                tx_id, raw_tx = self.sdk._sign_transaction(address, value, data, nonce)
+                new_entries.append({'op': SIGNED, 'tx_id': tx_id, 'nonce': nonce, 'key': key, 'to': recipient,
+                                    'raw': raw_tx, 'state': SIGNED})
+                if key is not None:
+                    keys[key] = tx_id
+                tx_ids.append(tx_id)
+                nonce += 1
+
+            # the transactions must be on the disk before they can reach the node
+            self.wal.append([dict((k, v) for k, v in entry.items() if k != 'state') for entry in new_entries])
+            self._next_nonce = nonce
+            self._keys.update(keys)
+            for entry in new_entries:
+                self._entries[entry['tx_id']] = entry
+                self._queue.put(entry)
+            return tx_ids
+
+    def _wait_submitted(self, timeout):
+        """Wait until the queued transactions are submitted, or the timeout expires."""
+        deadline = time() + timeout if timeout is not None else None
+        done = self._queue.all_tasks_done
+        with done:
+            while self._queue.unfinished_tasks:
+                remaining = deadline - time() if deadline is not None else POLL_TIMEOUT
+                if remaining <= 0:
+                    logger.warning('closing with %d transactions not submitted, they stay in the log',
+                                   self._queue.unfinished_tasks)
+                    return
+                done.wait(min(remaining, POLL_TIMEOUT))
+
+    def _run(self):
+        while self._running:
+            try:
+                entry = self._queue.get(timeout=POLL_TIMEOUT)
+            except queue.Empty:
+                continue
+            try:
+                state = self._submit(entry)
+                if state:
+                    with self._lock:
+                        entry['state'] = state
+                    if state == SENT:
+                        self.sdk._invalidate_balances(self.sdk.address, entry.get('to'))
+                    # no need to sync, a lost record only means the transaction is checked with the node on recovery
+                    self.wal.append([{'op': state, 'tx_id': entry['tx_id']}], sync=False)
+            except Exception:
+                logger.exception('transaction %s submission failed', entry['tx_id'])
+            finally:
+                self._queue.task_done()
+
+    def _submit(self, entry):
+        """Submit a signed transaction to the node.
+        Connection errors are retried until the queue is stopped, since resubmitting a signed transaction is safe.
+        A transaction rejected for its nonce is failed only if the node does not know it: an earlier attempt whose
+        response was lost may have been accepted.
+
+        :returns: the new transaction state, or None if the queue was stopped before the transaction was submitted.
+        :rtype: str
+        """
+        attempts = 0
+        delay = RETRY_DELAY
+        while self._running:
+            try:
+                self.sdk.web3.eth.sendRawTransaction(entry['raw'])
+                return SENT
+            except ValueError as e:
+                message = _error_message(e)
+                if is_known_transaction_error(message):  # submitted before
+                    return SENT
+                if 'nonce' in message:
+                    # an earlier attempt may have reached the node, and the transaction was mined since
+                    try:
+                        known = self.sdk.web3.eth.getTransaction(entry['tx_id']) is not None
+                    except Exception as lookup_error:
+                        logger.warning('transaction %s lookup failed, retrying: %s', entry['tx_id'], lookup_error)
+                        self._stop_event.wait(delay)
+                        delay = min(delay * 2, MAX_RETRY_DELAY)
+                        continue
+                    if known:
+                        return SENT
+                if attempts < RETRY_ATTEMPTS and 'nonce' not in message:
+                    attempts += 1
+                    self._stop_event.wait(RETRY_DELAY)
+                    continue
+                logger.error('transaction %s (nonce %d) rejected: %s', entry['tx_id'], entry['nonce'], message)
+                return FAILED
+            except Exception as e:
+                logger.warning('transaction %s submission failed, retrying: %s', entry['tx_id'], e)
+                self._stop_event.wait(delay)
+                delay = min(delay * 2, MAX_RETRY_DELAY)
+        return None
+
+
+class NonceAuditor(object):
+    """Detects and fills nonce gaps in the transactions of a send queue.
+
+    A transaction that is dropped by the node, or rejected after its nonce was reserved, leaves a gap: all the
+    later transactions wait in the node queue, and are never mined. The auditor periodically compares the node
+    pending transaction count (the next nonce after the transactions the node can mine) with the nonces recorded
+    in the send queue log. A gap is filled by resubmitting the logged transaction with the missing nonce, or if
+    there is none, by sending a zero-value transfer to self with that nonce.
+    """
+
+    def __init__(self, send_queue, interval=DEFAULT_AUDIT_INTERVAL):
+        """Create a new nonce auditor.
+
+        :param send_queue: the send queue to audit.
+        :type send_queue: :class:`~kin.SendQueue`
+
+        :param float interval: the time between audits, in seconds.
+        """
+        self.send_queue = send_queue
+        self.interval = interval
+
+        self._lock = threading.Lock()
+        self._audits = 0
+        self._gaps = 0
+        self._resubmitted = 0
+        self._filled = 0
+        self._blocked_since = None
+        self._blocked_time = 0.0
+        self._last_audit = None
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start auditing in a background thread."""
+        if self._thread:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='kin-nonce-auditor')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop auditing."""
+        self._stop_event.set()
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def audit(self):
+        """Check the send queue for nonce gaps, and fill them.
+
+        :returns: the gap nonces found.
+        :rtype: list
+        """
+        send_queue = self.send_queue
+        # the log is read before the node, so that transactions recorded as sent are known to the node
+        entries, next_nonce = send_queue.nonce_snapshot()
+        if next_nonce is None:
+            return []
+        sent_nonces = [nonce for nonce, entry in entries.items() if entry['state'] == SENT]
+
+        eth = send_queue.sdk.web3.eth
+        confirmed_count = eth.getTransactionCount(send_queue.sdk.address, 'latest')
+        pending_count = eth.getTransactionCount(send_queue.sdk.address, 'pending')
+
+        gaps = []
+        if sent_nonces and max(sent_nonces) >= pending_count:
+            # the node does not have the transaction with the pending count nonce, and holds the later ones back
+            gaps = [nonce for nonce in range(pending_count, max(sent_nonces) + 1)
+                    if nonce not in entries or nonce == pending_count and entries[nonce]['state'] == SENT]
+
+        for nonce in gaps:
+            entry = entries.get(nonce)
+            if entry:
+                logger.warning('nonce gap at %d: transaction %s was dropped, resubmitting', nonce, entry['tx_id'])
+                send_queue.resubmit(entry['tx_id'])
+            else:
+                tx_id = send_queue.fill_nonce(nonce)
+                logger.warning('nonce gap at %d: filling with transaction %s', nonce, tx_id)
+
+        now = time()
+        with self._lock:
+            self._audits += 1
+            self._last_audit = {'confirmed_count': confirmed_count, 'pending_count': pending_count,
+                                'next_nonce': next_nonce}
+            if gaps:
+                self._gaps += len(gaps)
+                self._resubmitted += sum(1 for nonce in gaps if nonce in entries)
+                self._filled += sum(1 for nonce in gaps if nonce not in entries)
+                if self._blocked_since is None:
+                    self._blocked_since = now
+            elif self._blocked_since is not None:
+                blocked = now - self._blocked_since
+                self._blocked_time += blocked
+                self._blocked_since = None
+                logger.warning('nonce gaps filled, sending was blocked for %.1f seconds', blocked)
+        return gaps
+
+    def stats(self):
+        """Get the auditor statistics.
+
+        :returns: a dict with the number of audits, the number of gaps found, of transactions resubmitted and of
+            zero-value transfers sent to fill gaps, the total time sending was blocked by gaps, the time the
+            current gap is blocking sending (0 if none), and the nonce counts of the last audit: the confirmed
+            and pending transaction counts of the node and the next nonce of the send queue.
+        :rtype: dict
+        """
+        with self._lock:
+            blocked_for = time() - self._blocked_since if self._blocked_since is not None else 0.0
+            return {
+                'audits': self._audits,
+                'gaps': self._gaps,
+                'resubmitted': self._resubmitted,
+                'filled': self._filled,
+                'blocked_time': self._blocked_time + blocked_for,
+                'blocked_for': blocked_for,
+                'last_audit': self._last_audit,
+            }
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.audit()
+            except Exception:
+                logger.exception('nonce audit failed')
+
+
+def _error_message(error):
+    """Extract the message of a JSON-RPC error raised by web3."""
+    if error.args and isinstance(error.args[0], dict):
+        return error.args[0].get('message', '')
+    return str(error)
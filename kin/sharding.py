@@ -0,0 +1,521 @@
+# -*- coding: utf-8 -*
+
+# Copyright (C) 2017 Kin Foundation
+
+"""Token transaction monitoring sharded across worker processes.
+
+A single ingestion thread fetches and decodes every block once, and finds the token transfers of the watched
+addresses. The transfers are partitioned by a hash of the watched address across worker processes, each owning the
+callbacks of its slice of the addresses, so that the callbacks are not limited to a single core. Transfers are packed
+into fixed size binary records, and each worker receives a single buffer per block over a pipe: nothing is pickled
+on the way.
+"""
+
+from binascii import hexlify, unhexlify
+from collections import Counter
+import multiprocessing
+import struct
+import threading
+import zlib
+
+from eth_utils import from_wei
+
+from .address import Address, address_bytes, canonical_address
+from .monitor import BlockTracker
+from .rpc import (
+    batch_request,
+    chunked_batch_request,
+    format_block,
+    hex_to_int,
+)
+from .sdk import (
+    ERC20_TRANSFER_ABI_PREFIX,
+    FILTER_POLL_INTERVAL,
+    KIN_CONTRACT_ADDRESS,
+    TransactionStatus,
+)
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# a transfer record: status, transaction hash, from address, to address, amount (a 256 bit big-endian integer).
+_RECORD = struct.Struct('>B32s20s20s32s')
+
+# the number of blocks a confirmed transfer waits for its receipt, before it is reported with the UNKNOWN status.
+RECEIPT_WAIT_BLOCKS = 10
+
+# message kinds, the first byte of the messages sent to a worker.
+_TRANSFERS = b'T'
+_WATCH = b'W'
+_UNWATCH = b'U'
+_STOP = b'S'
+
+
+class ShardedTokenMonitor(object):
+    """Monitors the token transactions of a large set of addresses, calling back from a pool of worker processes.
+
+    Each watched address is owned by one worker, chosen by a hash of the address. The callback is called by the
+    owning worker, once per watched address of a transfer, so a transfer between two watched addresses is reported
+    to both. The transactions of an address are reported in order. Mined transactions are reported once
+    confirmed, and reported again with the `ROLLED_BACK` status if their block is orphaned. Pending transactions
+    are not reported. A transfer whose receipt the node does not have yet once confirmed is reported at a later
+    block, when the receipt is found.
+
+    A single ingestion thread sends to all the workers, and sending to a worker blocks once its pipe buffer is
+    full. So a worker behind on its callbacks stalls the ingestion, and with it every other shard, rather than
+    piling the transfers up in memory. Keep the callbacks fast, for example by queueing the slow work elsewhere.
+    Sending does not hold the monitor lock, so :meth:`stats` is never blocked by a slow worker. If a worker dies,
+    the transfers of its shard are lost and counted, and the other shards are not affected.
+    """
+
+    def __init__(self, provider, callback_fn, token_address=KIN_CONTRACT_ADDRESS, num_workers=None,
+                 confirmations=1, base_units=False, cache=None):
+        """Create a new sharded monitor. Call :meth:`start` to start monitoring.
+
+        :param provider: JSON-RPC provider to fetch the blocks with.
+        :type provider: :class:`web3:providers:BaseProvider`
+
+        :param callback_fn: the callback function with the signature
+            `func(address, tx_id, status, from_address, to_address, amount)`, where `address` is the watched
+            address of the transfer. The amount is a Decimal, or an int in base units mode. It is called in the
+            worker processes, so it must be picklable (a module level function) on platforms that spawn processes
+            rather than fork them.
+
+        :param str token_address: the address of the token contract.
+
+        :param int num_workers: the number of worker processes. Defaults to the number of CPUs.
+
+        :param int confirmations: the number of block confirmations (including the transaction block itself) after
+            which a mined transaction is reported.
+
+        :param bool base_units: if True, amounts are integers in base units, otherwise they are in KIN.
+
+        :param cache: a cache whose balances of the watched addresses are invalidated when they transfer tokens.
+        :type cache: :class:`~kin.Cache`
+
+        :raises: ValueError: if some of the parameters are invalid.
+        """
+        if num_workers is not None and num_workers < 1:
+            raise ValueError('number of workers must be positive')
+        if confirmations < 1:
+            raise ValueError('confirmations must be positive')
+        self.provider = provider
+        self.callback_fn = callback_fn
+        self.num_workers = num_workers or multiprocessing.cpu_count()
+        self.base_units = base_units
+        self.cache = cache
+        self._token_raw = canonical_address(token_address).raw
+
+        # guards the watched addresses, the block tracker, the worker senders and the counters
+        self._lock = threading.Lock()
+        self._shards = {}  # watched address bytes -> worker index
+        self._block_tracker = BlockTracker(self._fetch_block, confirmations)
+        # confirmed transfers waiting for their receipt: (block entry, transaction, from address bytes,
+        # to address bytes, amount bytes, number of blocks waited) tuples
+        self._waiting = []
+        self._senders = []
+        self._processes = []
+        self._filter_id = None
+        self._poll_thread = None
+        self._poll_stop = None
+        self._blocks = 0
+        self._transfers = 0
+        self._records = [0] * self.num_workers
+        self._lost = [0] * self.num_workers  # records not sent to a dead worker
+        # shared memory counters, written by the workers: delivered and failed callbacks per worker
+        self._counters = multiprocessing.RawArray('l', 2 * self.num_workers)
+
+    def start(self, poll=True):
+        """Start the worker processes, and the ingestion of new blocks.
+
+        :param bool poll: whether to poll the node for new blocks. If False, the blocks are passed to
+            :meth:`add_block` by the caller.
+        """
+        with self._lock:
+            if self._processes:
+                return
+            for index in range(self.num_workers):
+                recv_conn, send_conn = multiprocessing.Pipe(duplex=False)
+                process = multiprocessing.Process(
+                    target=_run_worker, args=(recv_conn, self.callback_fn, self.base_units, self._counters, index),
+                    name='kin-shard-{}'.format(index))
+                process.daemon = True
+                process.start()
+                recv_conn.close()
+                self._senders.append(_Sender(send_conn, index))
+                self._processes.append(process)
+            sends = self._queue_sends(_WATCH, self._by_shard(self._shards))
+        self._send(sends)
+
+        if poll:
+            self._filter_id = batch_request(self.provider, [('eth_newBlockFilter', [])])[0]
+            self._poll_stop = threading.Event()
+            self._poll_thread = threading.Thread(target=self._poll, args=(self._filter_id, self._poll_stop),
+                                                 name='kin-shard-ingestion')
+            self._poll_thread.daemon = True
+            self._poll_thread.start()
+
+    def watch(self, *addresses):
+        """Start reporting the token transactions of addresses.
+
+        :param addresses: the addresses to watch.
+
+        :raises: ValueError: if an address is invalid.
+        """
+        raws = [canonical_address(address).raw for address in addresses]
+        with self._lock:
+            new = {}
+            for raw in raws:
+                if raw not in self._shards:
+                    new[raw] = self._shards[raw] = _shard_of(raw, self.num_workers)
+            sends = self._queue_sends(_WATCH, self._by_shard(new))
+        self._send(sends)
+
+    def unwatch(self, *addresses):
+        """Stop reporting the token transactions of addresses.
+
+        :param addresses: the watched addresses.
+
+        :raises: ValueError: if an address is invalid.
+        """
+        raws = [canonical_address(address).raw for address in addresses]
+        with self._lock:
+            removed = {}
+            for raw in raws:
+                if raw in self._shards:
+                    removed[raw] = self._shards.pop(raw)
+            sends = self._queue_sends(_UNWATCH, self._by_shard(removed))
+        self._send(sends)
+
+    def add_block(self, block):
+        """Track a new block, and send the watched transfers of the confirmed and orphaned blocks to the workers.
+        Called by the ingestion thread, or by the caller if not polling.
+
+        :param dict block: the new block, with its transactions.
+        """
+        if self.cache:
+            self.cache.new_block(block['number'])
+        with self._lock:
+            sends = self._track_block(block)
+        self._send(sends)
+
+    def stats(self):
+        """Get the monitoring counters.
+
+        :returns: a dict with the following fields:
+            - workers: the number of live worker processes.
+            - addresses: the number of watched addresses.
+            - blocks: the number of blocks ingested.
+            - transfers: the number of confirmed transfers of watched addresses.
+            - reorgs: the number of chain reorganizations detected.
+            - shards: per worker, the number of watched addresses, of transfer records sent to it, of delivered
+              (called) and failed (raised exception) callbacks, and of transfer records lost since the worker died.
+        :rtype: dict
+        """
+        with self._lock:
+            addresses = Counter(self._shards.values())
+            return {
+                'workers': len([process for process in self._processes if process.is_alive()]),
+                'addresses': len(self._shards),
+                'blocks': self._blocks,
+                'transfers': self._transfers,
+                'reorgs': self._block_tracker.reorgs,
+                'shards': [{
+                    'addresses': addresses[index],
+                    'records': self._records[index],
+                    'delivered': self._counters[2 * index],
+                    'failed': self._counters[2 * index + 1],
+                    'lost': self._lost[index],
+                } for index in range(self.num_workers)],
+            }
+
+    def close(self):
+        """Stop the ingestion, and stop the workers after they call back on the transfers sent to them.
+        Must not be called from a monitoring callback.
+        """
+        if self._poll_stop:
+            self._poll_stop.set()
+            if self._poll_thread is not threading.current_thread():
+                self._poll_thread.join()
+            self._poll_stop = self._poll_thread = None
+        if self._filter_id is not None:
+            try:
+                batch_request(self.provider, [('eth_uninstallFilter', [self._filter_id])])
+            except Exception as e:
+                logger.warning('cannot uninstall filter %s: %s', self._filter_id, e)
+            self._filter_id = None
+
+        with self._lock:
+            sends = self._queue_sends(_STOP, dict((index, []) for index in range(len(self._senders))))
+            senders, processes = self._senders, self._processes
+            self._senders, self._processes = [], []
+        self._send(sends)  # after the messages queued before
+        for sender, process in zip(senders, processes):
+            process.join()
+            sender.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # helpers
+
+    def _track_block(self, block):
+        """Track a new block, and queue the watched transfers of the confirmed and orphaned blocks.
+        Must be called with the lock held.
+
+        :returns: the messages to send, see :meth:`_queue_sends`.
+        :rtype: list
+        """
+        if not self._senders:
+            return []
+        orphaned, confirmed = self._block_tracker.add(block)
+        self._blocks += 1
+        messages = {}
+
+        for entry in orphaned:
+            for index, record in reversed(entry.events):
+                fields = _RECORD.unpack(record)
+                messages.setdefault(index, []).append(_RECORD.pack(TransactionStatus.ROLLED_BACK, *fields[1:]))
+                self._invalidate_balances(*fields[2:4])
+
+        # the transfers of an orphaned block still waiting for their receipt were not reported
+        transfers = [transfer for transfer in self._waiting if transfer[0] not in orphaned]
+        for entry in confirmed:
+            matched = self._match_transfers(entry.block['transactions'])
+            transfers.extend((entry,) + transfer + (0,) for transfer in matched)
+            entry.block = None  # keep only what is needed for a rollback
+        receipts = self._fetch_receipts([transfer[1] for transfer in transfers])
+
+        self._waiting = []
+        for transfer, receipt in zip(transfers, receipts):
+            entry, tx, from_raw, to_raw, amount_raw, waited = transfer
+            if not receipt:
+                if waited < RECEIPT_WAIT_BLOCKS:  # the node may be lagging behind, look again at the next block
+                    self._waiting.append(transfer[:5] + (waited + 1,))
+                    continue
+                logger.warning('no receipt of transaction %s, reporting an unknown status', tx['hash'])
+            record = _RECORD.pack(_mined_status(tx, receipt), unhexlify(tx['hash'][2:]), from_raw, to_raw, amount_raw)
+            for index in set(self._shards[raw] for raw in (from_raw, to_raw) if raw in self._shards):
+                entry.events.append((index, record))
+                messages.setdefault(index, []).append(record)
+            self._invalidate_balances(from_raw, to_raw)
+            self._transfers += 1
+
+        for index, records in messages.items():
+            self._records[index] += len(records)
+        return self._queue_sends(_TRANSFERS, messages)
+
+    def _poll(self, filter_id, stop_event):
+        """Poll the latest block filter and ingest the new blocks in order."""
+        while not stop_event.is_set():
+            try:
+                for block_hash in batch_request(self.provider, [('eth_getFilterChanges', [filter_id])])[0] or []:
+                    if stop_event.is_set():
+                        break
+                    block = self._fetch_block(block_hash)
+                    if block:  # not already orphaned
+                        self.add_block(block)
+            except Exception:
+                logger.exception('block poll failed')
+            stop_event.wait(FILTER_POLL_INTERVAL)
+
+    def _fetch_block(self, block_hash):
+        """Fetch a full block by hash, or None if it is missing."""
+        return format_block(batch_request(self.provider, [('eth_getBlockByHash', [block_hash, True])])[0])
+
+    def _match_transfers(self, txs):
+        """Find the token transfers of the watched addresses. Must be called with the lock held.
+
+        :param list txs: the block transactions.
+
+        :returns: a list of (transaction, from address bytes, to address bytes, amount bytes) tuples.
+        :rtype: list
+        """
+        prefix_length = len(ERC20_TRANSFER_ABI_PREFIX)
+        transfers = []
+        for tx in txs:
+            if address_bytes(tx.get('to')) != self._token_raw:
+                continue
+            data = tx.get('input') or ''
+            if not data.startswith(ERC20_TRANSFER_ABI_PREFIX) or len(data) < prefix_length + 128:
+                continue
+            # the arguments are two 32 byte words: the recipient address (right aligned) and the amount
+            try:
+                to_raw = unhexlify(data[prefix_length + 24:prefix_length + 64])
+                amount_raw = unhexlify(data[prefix_length + 64:prefix_length + 128])
+            except (TypeError, ValueError):  # malformed data
+                continue
+            from_raw = address_bytes(tx['from'])
+            if from_raw in self._shards or to_raw in self._shards:
+                transfers.append((tx, from_raw, to_raw, amount_raw))
+        return transfers
+
+    def _fetch_receipts(self, txs):
+        """Fetch the receipts of mined transactions with batch requests. If the node fails, all are missing."""
+        try:
+            return chunked_batch_request(self.provider, [('eth_getTransactionReceipt', [tx['hash']]) for tx in txs])
+        except Exception as e:
+            logger.warning('cannot fetch receipts, looking again at the next block: %s', e)
+            return [None] * len(txs)
+
+    def _invalidate_balances(self, *raws):
+        """Invalidate the cached balances of the watched addresses among raw addresses."""
+        if not self.cache:
+            return
+        keys = []
+        for raw in raws:
+            if raw in self._shards:
+                address = Address(raw)
+                keys.extend([('ether_balance', address), ('token_balance', address)])
+        self.cache.invalidate(*keys)
+
+    def _queue_sends(self, kind, parts_by_shard):
+        """Take the place of messages in the send order of their workers. Must be called with the lock held, so that
+        the messages are sent in the order of the changes they carry.
+
+        :param bytes kind: the message kind.
+
+        :param dict parts_by_shard: a dict of worker index -> list of records or addresses.
+
+        :returns: the messages to send with :meth:`_send`, as (sender, ticket, message, number of parts) tuples.
+        :rtype: list
+        """
+        if not self._senders:
+            return []
+        sends = []
+        for index, parts in parts_by_shard.items():
+            sender = self._senders[index]
+            sends.append((sender, sender.take_ticket(), kind + b''.join(parts), len(parts)))
+        return sends
+
+    def _send(self, sends):
+        """Send queued messages, without the lock. A dead worker does not affect the others."""
+        for sender, ticket, message, count in sends:
+            if not sender.send(ticket, message) and message[:1] == _TRANSFERS:
+                with self._lock:
+                    self._lost[sender.index] += count
+
+    @staticmethod
+    def _by_shard(shards):
+        """Group a dict of address bytes -> worker index by worker index."""
+        by_shard = {}
+        for raw, index in shards.items():
+            by_shard.setdefault(index, []).append(raw)
+        return by_shard
+
+
+class _Sender(object):
+    """Sends messages to a worker in the order of their tickets, so that the messages can be sent without holding
+    the monitor lock and still follow the order of the changes they carry.
+    """
+
+    def __init__(self, conn, index):
+        self.conn = conn
+        self.index = index
+        self.broken = False
+        self._cond = threading.Condition()
+        self._next_ticket = 0  # taken with the monitor lock held
+        self._turn = 0  # the ticket of the message sent next
+
+    def take_ticket(self):
+        ticket = self._next_ticket
+        self._next_ticket += 1
+        return ticket
+
+    def send(self, ticket, message):
+        """Send a message once the messages of the previous tickets are sent.
+
+        :returns: False if the pipe is broken (the worker died), True otherwise.
+        :rtype: bool
+        """
+        with self._cond:
+            while self._turn != ticket:
+                self._cond.wait()
+        try:
+            if not self.broken:
+                self.conn.send_bytes(message)
+        except Exception as e:
+            self.broken = True
+            logger.error('cannot send to shard worker %d, dropping its messages: %s', self.index, e)
+        finally:
+            with self._cond:
+                self._turn += 1
+                self._cond.notify_all()
+        return not self.broken
+
+
+def _shard_of(raw, num_workers):
+    """The index of the worker owning an address. The hash is stable across processes and python versions."""
+    return (zlib.crc32(raw) & 0xffffffff) % num_workers
+
+
+def _mined_status(tx, receipt):
+    """The status of a mined transaction, from its receipt. See :meth:`~kin.TokenSDK._get_tx_status`."""
+    if not receipt:
+        return TransactionStatus.UNKNOWN
+    status = receipt.get('status')
+    if status == '0x1':
+        return TransactionStatus.SUCCESS
+    if status == '0x0':
+        return TransactionStatus.FAIL
+    if hex_to_int(receipt.get('gasUsed')) < hex_to_int(tx.get('gas')):
+        return TransactionStatus.SUCCESS
+    return TransactionStatus.FAIL
+
+
+def _to_hex(raw):
+    return '0x' + hexlify(raw).decode('ascii')
+
+
+def _run_worker(conn, callback_fn, base_units, counters, index):
+    """The worker process loop: keep the owned slice of the watched addresses, and call back on their transfers.
+
+    :param conn: the receiving end of the pipe from the ingestion.
+
+    :param callback_fn: the monitoring callback function.
+
+    :param bool base_units: whether to report amounts in base units.
+
+    :param counters: the shared delivered and failed callback counters.
+
+    :param int index: the worker index.
+    """
+    addresses = set()
+    while True:
+        try:
+            message = conn.recv_bytes()
+        except EOFError:  # the ingestion process exited
+            return
+        kind = message[:1]
+        if kind == _STOP:
+            return
+        if kind in (_WATCH, _UNWATCH):
+            raws = [message[offset:offset + 20] for offset in range(1, len(message), 20)]
+            if kind == _WATCH:
+                addresses.update(raws)
+            else:
+                addresses.difference_update(raws)
+            continue
+
+        for offset in range(1, len(message), _RECORD.size):
+            status, tx_hash, from_raw, to_raw, amount_raw = _RECORD.unpack_from(message, offset)
+            owned = [raw for raw in (from_raw, to_raw) if raw in addresses]
+            if not owned:  # stopped watching since the transfer was sent
+                continue
+            if from_raw == to_raw:
+                owned = owned[:1]
+            amount = int(hexlify(amount_raw), 16)
+            if not base_units:
+                amount = from_wei(amount, 'ether')
+            args = (_to_hex(tx_hash), status, _to_hex(from_raw), _to_hex(to_raw), amount)
+            for raw in owned:
+                try:
+                    callback_fn(_to_hex(raw), *args)
+                except Exception:
+                    counters[2 * index + 1] += 1
+                    logger.exception('monitoring callback failed')
+                counters[2 * index] += 1
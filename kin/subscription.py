@@ -0,0 +1,477 @@
+# -*- coding: utf-8 -*
+
+# Copyright (C) 2017 Kin Foundation
+
+import codecs
+from collections import deque
+import itertools
+import json
+import re
+import socket
+import threading
+from time import sleep
+
+from .exceptions import SdkConfigurationError
+from .rpc import chunked_batch_request, hex_to_int
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# default connection configuration.
+DEFAULT_TIMEOUT = 10
+POLL_TIMEOUT = 1  # how long the reader blocks before checking whether it should stop
+
+# default reconnect configuration (exponential backoff).
+RECONNECT_DELAY = 0.5
+MAX_RECONNECT_DELAY = 30
+
+# the number of recently delivered items remembered to avoid duplicates after a gap fill.
+DEDUP_WINDOW = 256
+
+# the largest IPC message, in characters. A larger one is taken for a broken stream, and the connection is reset.
+MAX_MESSAGE_SIZE = 32 * 1024 * 1024
+
+# subscription kinds supported by eth_subscribe.
+NEW_HEADS = 'newHeads'
+NEW_PENDING_TRANSACTIONS = 'newPendingTransactions'
+LOGS = 'logs'
+
+
+class SubscriptionClient(object):
+    """A persistent JSON-RPC connection (WebSocket or IPC) receiving `eth_subscribe` push notifications.
+    The connection is served by a single reader thread that dispatches notifications to the callbacks.
+    When the connection is lost, the client reconnects, re-subscribes and fills the gap: the headers
+    and logs of the blocks produced while disconnected are fetched and delivered before the live ones.
+    Pending transactions that arrived while disconnected cannot be recovered, they are only seen once mined.
+    """
+
+    def __init__(self, endpoint_uri, timeout=DEFAULT_TIMEOUT, reconnect_delay=RECONNECT_DELAY):
+        """Create a new subscription client.
+
+        :param str endpoint_uri: a `ws://` or `wss://` URI of a WebSocket endpoint, or a path to an IPC socket.
+
+        :param float timeout: the timeout in seconds of JSON-RPC calls made over the connection.
+
+        :param float reconnect_delay: the initial delay in seconds between reconnect attempts.
+        """
+        self.endpoint_uri = endpoint_uri
+        self.timeout = timeout
+        self.reconnect_delay = reconnect_delay
+        self.reconnects = 0
+
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._request_ids = itertools.count(1)
+        self._connection = None
+        self._thread = None
+        self._running = False
+
+        self._subscriptions = []  # all subscriptions, to re-subscribe on reconnect
+        self._subscriptions_by_id = {}
+        self._pending_subscribe_requests = {}  # request id -> subscription
+        self._pending_calls = {}  # request id -> [event, response]
+        self._backlog = []  # notifications received during reconnect
+
+    def start(self):
+        """Connect and start the reader thread.
+
+        :raises: :class:`~kin.exceptions.SdkConfigurationError`: if cannot connect to the endpoint.
+        """
+        if self._running:
+            return
+        try:
+            self._connection = _connect(self.endpoint_uri, POLL_TIMEOUT)
+        except SdkConfigurationError:
+            raise
+        except Exception as e:
+            raise SdkConfigurationError('cannot connect to subscription endpoint: ' + str(e))
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='kin-subscription')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self, wait=True):
+        """Stop the reader thread and close the connection.
+
+        :param bool wait: whether to wait for the reader thread to exit before closing the connection.
+            Otherwise the connection is closed right away, and the reader thread exits on its own.
+        """
+        self._running = False
+        if wait and self._thread and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+        if self._connection:
+            self._connection.close()
+            self._connection = None
+
+    @property
+    def num_subscriptions(self):
+        """The number of node subscriptions."""
+        with self._lock:
+            return len(self._subscriptions)
+
+    def subscribe(self, kind, callback_fn, params=None):
+        """Subscribe to notifications. Subscribing twice to the same kind and params shares the node subscription.
+
+        :param str kind: the subscription kind, one of `newHeads`, `newPendingTransactions` or `logs`.
+
+        :param callback_fn: the callback function with the signature `func(result)`, where result is a block
+            header, a transaction hash or a log entry, depending on the subscription kind.
+
+        :param dict params: additional subscription parameters, e.g. the address and topics of a `logs` subscription.
+        """
+        with self._lock:
+            for subscription in self._subscriptions:
+                if subscription.kind == kind and subscription.params == params:
+                    subscription.callbacks.append(callback_fn)
+                    return
+            subscription = _Subscription(kind, params)
+            subscription.callbacks.append(callback_fn)
+            self._subscriptions.append(subscription)
+        try:
+            self._call('eth_subscribe', subscription.rpc_params(), subscription)
+        except Exception:
+            with self._lock:
+                self._subscriptions.remove(subscription)
+            raise
+
+    # reader thread
+
+    def _run(self):
+        while self._running:
+            try:
+                for message in self._connection.recv():
+                    self._handle_message(message)
+            except Exception as e:
+                if not self._running:
+                    break
+                logger.warning('subscription connection lost: %s', e)
+                self._reconnect()
+
+    def _handle_message(self, message):
+        if message.get('method') == 'eth_subscription':
+            params = message['params']
+            subscription = self._subscriptions_by_id.get(params['subscription'])
+            if subscription:
+                self._deliver(subscription, params['result'])
+            return
+
+        request_id = message.get('id')
+        subscription = self._pending_subscribe_requests.pop(request_id, None)
+        if subscription and 'result' in message:
+            # bind before signaling, so that the notifications following the response are not lost
+            subscription.id = message['result']
+            self._subscriptions_by_id[subscription.id] = subscription
+        pending_call = self._pending_calls.get(request_id)
+        if pending_call:
+            pending_call[1] = message
+            pending_call[0].set()
+
+    def _deliver(self, subscription, result):
+        """Call the subscription callbacks, skipping the items already delivered."""
+        key = subscription.dedup_key(result)
+        if key is not None:
+            if key in subscription.recent:
+                return
+            subscription.recent.append(key)
+        block_number = subscription.block_number(result)
+        if block_number is not None and block_number > subscription.last_block_number:
+            subscription.last_block_number = block_number
+
+        for callback_fn in list(subscription.callbacks):
+            try:
+                callback_fn(result)
+            except Exception:
+                logger.exception('subscription callback failed')
+
+    def _reconnect(self):
+        """Reconnect, re-subscribe and fill the gap. Runs on the reader thread."""
+        self._connection.close()
+        self._fail_pending_calls()
+        delay = self.reconnect_delay
+        while self._running:
+            try:
+                self._connection = _connect(self.endpoint_uri, POLL_TIMEOUT)
+                self._subscriptions_by_id.clear()
+                for subscription in list(self._subscriptions):
+                    subscription.id = self._call_inline('eth_subscribe', subscription.rpc_params())
+                    self._subscriptions_by_id[subscription.id] = subscription
+                for subscription in list(self._subscriptions):
+                    self._fill_gap(subscription)
+                self.reconnects += 1
+                break
+            except Exception as e:
+                logger.warning('subscription reconnect failed: %s', e)
+                if self._connection:
+                    self._connection.close()
+                sleep(delay)
+                delay = min(delay * 2, MAX_RECONNECT_DELAY)
+
+        backlog, self._backlog = self._backlog, []
+        for message in backlog:
+            self._handle_message(message)
+
+    def _fill_gap(self, subscription):
+        """Deliver the items of the blocks produced since the last delivered item of a subscription."""
+        if subscription.last_block_number < 0:
+            return  # nothing was delivered yet, so there is no gap to fill
+        if subscription.kind == NEW_HEADS:
+            head = hex_to_int(self._call_inline('eth_blockNumber', []))
+            calls = [('eth_getBlockByNumber', ['0x%x' % block_number, False])
+                     for block_number in range(subscription.last_block_number + 1, head + 1)]
+            for header in chunked_batch_request(_InlineBatchProvider(self), calls):
+                if header:
+                    self._deliver(subscription, header)
+        elif subscription.kind == LOGS:
+            # the last block may have been delivered partially, duplicates are filtered out by _deliver
+            log_filter = dict(subscription.params or {})
+            log_filter.update({'fromBlock': '0x%x' % subscription.last_block_number, 'toBlock': 'latest'})
+            for entry in self._call_inline('eth_getLogs', [log_filter]) or []:
+                self._deliver(subscription, entry)
+
+    # JSON-RPC calls
+
+    def _call(self, method, params, subscription=None):
+        """Make a call over the connection and wait for the reader thread to receive the response."""
+        request_id = next(self._request_ids)
+        pending_call = [threading.Event(), None]
+        self._pending_calls[request_id] = pending_call
+        if subscription:
+            self._pending_subscribe_requests[request_id] = subscription
+        try:
+            self._send({'jsonrpc': '2.0', 'id': request_id, 'method': method, 'params': params})
+            if not pending_call[0].wait(self.timeout):
+                raise IOError('timeout waiting for {} response'.format(method))
+        finally:
+            self._pending_calls.pop(request_id, None)
+            self._pending_subscribe_requests.pop(request_id, None)
+        response = pending_call[1]
+        if 'error' in response:
+            raise ValueError(response['error'])
+        return response.get('result')
+
+    def _call_inline(self, method, params):
+        """Make a call over the connection and read the response on the calling (reader) thread.
+        Notifications received meanwhile are kept in the backlog.
+        """
+        request_id = next(self._request_ids)
+        self._send({'jsonrpc': '2.0', 'id': request_id, 'method': method, 'params': params})
+        response = self._recv_inline(lambda message: isinstance(message, dict) and message.get('id') == request_id,
+                                     method)
+        if 'error' in response:
+            raise ValueError(response['error'])
+        return response.get('result')
+
+    def _batch_inline(self, calls):
+        """Make a batch of calls over the connection and read the responses on the calling (reader) thread,
+        as :meth:`_call_inline` does.
+
+        :param list calls: a list of (method, params) tuples.
+
+        :returns: the JSON-RPC responses, in the same order as the calls.
+        :rtype: list
+        """
+        request_ids = [next(self._request_ids) for _ in calls]
+        self._send([{'jsonrpc': '2.0', 'id': request_id, 'method': method, 'params': params}
+                    for request_id, (method, params) in zip(request_ids, calls)])
+        response = self._recv_inline(lambda message: isinstance(message, list) and
+                                     any(r.get('id') == request_ids[0] for r in message), 'batch')
+        responses_by_id = dict((r.get('id'), r) for r in response)
+        return [responses_by_id.get(request_id, {'error': 'no response'}) for request_id in request_ids]
+
+    def _recv_inline(self, match_fn, method):
+        """Read messages on the calling (reader) thread until the response matching `match_fn` arrives.
+        The other messages are kept in the backlog.
+        """
+        waited = 0
+        while waited < self.timeout:
+            messages = self._connection.recv()
+            if not messages:
+                waited += POLL_TIMEOUT
+            for i, message in enumerate(messages):
+                if match_fn(message):
+                    self._backlog.extend(messages[i + 1:])
+                    return message
+                self._backlog.append(message)
+        raise IOError('timeout waiting for {} response'.format(method))
+
+    def _send(self, message):
+        with self._send_lock:
+            self._connection.send(message)
+
+    def _fail_pending_calls(self):
+        """Release the callers waiting for responses that will never arrive."""
+        for pending_call in list(self._pending_calls.values()):
+            pending_call[1] = {'error': 'connection lost'}
+            pending_call[0].set()
+
+
+class _InlineBatchProvider(object):
+    """Exposes the batched calls of a subscription client reader thread to the batch helpers of :mod:`kin.rpc`."""
+
+    def __init__(self, client):
+        self._client = client
+
+    def make_batch_request(self, calls):
+        return self._client._batch_inline(calls)
+
+
+class _Subscription(object):
+    """Subscription state: callbacks and the position in the chain, to fill gaps on reconnect."""
+    __slots__ = ('kind', 'params', 'id', 'callbacks', 'last_block_number', 'recent')
+
+    def __init__(self, kind, params=None):
+        self.kind = kind
+        self.params = params
+        self.id = None
+        self.callbacks = []
+        self.last_block_number = -1
+        self.recent = deque(maxlen=DEDUP_WINDOW)
+
+    def rpc_params(self):
+        if self.params is None:
+            return [self.kind]
+        return [self.kind, self.params]
+
+    def dedup_key(self, result):
+        if self.kind == NEW_HEADS:
+            return result.get('hash')
+        if self.kind == LOGS:
+            return result.get('blockHash'), result.get('logIndex')
+        return None
+
+    def block_number(self, result):
+        if self.kind == NEW_HEADS:
+            return hex_to_int(result.get('number'))
+        if self.kind == LOGS:
+            return hex_to_int(result.get('blockNumber'))
+        return None
+
+
+def _connect(endpoint_uri, timeout):
+    if endpoint_uri.startswith('ws://') or endpoint_uri.startswith('wss://'):
+        return _WebsocketConnection(endpoint_uri, timeout)
+    return _IPCConnection(endpoint_uri, timeout)
+
+
+# the characters that delimit JSON values and strings
+_FRAME_TOKENS = re.compile(r'[{}\[\]"\\]')
+
+
+class _IPCConnection(object):
+    """A JSON-RPC connection over a unix domain socket. Messages are a stream of concatenated JSON objects
+    (or arrays, for batches). A malformed or oversized message raises IOError, so that the connection is reset.
+    """
+
+    def __init__(self, path, timeout):
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.settimeout(timeout)
+        self._socket.connect(path)
+        self._text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self._buffer = ''
+        # the framing state of the first buffered message, kept between reads
+        self._scan_pos = 0
+        self._depth = 0
+        self._in_string = False
+
+    def send(self, message):
+        self._socket.sendall(json.dumps(message).encode('utf-8'))
+
+    def recv(self):
+        """Read the available messages. Returns an empty list on timeout."""
+        try:
+            data = self._socket.recv(65536)
+        except socket.timeout:
+            return []
+        if not data:
+            raise IOError('connection closed')
+        self._buffer += self._text_decoder.decode(data)
+
+        messages = []
+        while True:
+            self._buffer = self._buffer.lstrip()
+            if not self._buffer:
+                break
+            if self._buffer[0] not in '{[':
+                raise IOError('malformed message: {!r}'.format(self._buffer[:100]))
+            end = self._frame_end()
+            if end is None:  # incomplete message, wait for more data
+                if len(self._buffer) > MAX_MESSAGE_SIZE:
+                    raise IOError('message larger than {} characters'.format(MAX_MESSAGE_SIZE))
+                break
+            try:
+                messages.append(json.loads(self._buffer[:end]))
+            except ValueError as e:
+                raise IOError('malformed message: {}'.format(e))
+            self._buffer = self._buffer[end:]
+        return messages
+
+    def _frame_end(self):
+        """Find the end of the first buffered message, resuming the scan where the last read left it.
+
+        :returns: the index following the message, or None if the message is incomplete.
+        :rtype: int
+        """
+        buffer = self._buffer
+        pos = self._scan_pos
+        while True:
+            match = _FRAME_TOKENS.search(buffer, pos)
+            if not match:
+                self._scan_pos = len(buffer)
+                return None
+            token, pos = match.group(), match.end()
+            if self._in_string:
+                if token == '\\':
+                    if pos == len(buffer):  # the escaped character is not read yet
+                        self._scan_pos = match.start()
+                        return None
+                    pos += 1
+                elif token == '"':
+                    self._in_string = False
+            elif token == '"':
+                self._in_string = True
+            elif token in '{[':
+                self._depth += 1
+            elif token in '}]':
+                self._depth -= 1
+                if self._depth == 0:
+                    self._scan_pos = 0
+                    return pos
+
+    def close(self):
+        try:
+            self._socket.close()
+        except socket.error:
+            pass
+
+
+class _WebsocketConnection(object):
+    """A JSON-RPC connection over a WebSocket. Requires the optional `websocket-client` package."""
+
+    def __init__(self, uri, timeout):
+        try:
+            import websocket
+        except ImportError:
+            raise SdkConfigurationError('websocket-client package is required for websocket subscriptions')
+        self._timeout_error = websocket.WebSocketTimeoutException
+        self._ws = websocket.create_connection(uri, timeout=timeout)
+
+    def send(self, message):
+        self._ws.send(json.dumps(message))
+
+    def recv(self):
+        """Read the next message. Returns an empty list on timeout."""
+        try:
+            data = self._ws.recv()
+        except self._timeout_error:
+            return []
+        if not data:
+            raise IOError('connection closed')
+        return [json.loads(data)]
+
+    def close(self):
+        try:
+            self._ws.close()
+        except Exception:
+            pass
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*
+
+# Copyright (C) 2017 Kin Foundation
+
+"""Bulk wallet loading.
+
+Decrypting a keystore file runs a deliberately expensive key derivation function. Loading many wallets decrypts
+their keystores in parallel, in a pool of processes, so that the startup time is divided by the number of cores.
+"""
+
+import json
+import multiprocessing
+import threading
+
+from eth_keys import keys
+from web3.utils.encoding import (
+    hexstr_if_str,
+    to_bytes,
+)
+
+from .address import canonical_address
+from .compat import string_types
+from .exceptions import SdkConfigurationError
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Wallet(object):
+    """A wallet loaded from a keystore file by :func:`load_wallets`.
+    The private key may still be decrypted in the background: accessing it waits for the decryption.
+    Pass the wallet to :class:`~kin.TokenSDK` to use it.
+    """
+
+    def __init__(self, keyfile, address, result, pool):
+        """Create a new wallet.
+
+        :param str keyfile: the keystore file path.
+
+        :param str address: the address stored in the keystore file, or None.
+
+        :param result: the pending result of the keystore decryption, a (private key, error message) tuple.
+        :type result: :class:`multiprocessing.pool.AsyncResult`
+
+        :param pool: the process pool decrypting the keystore, referenced until the decryption is done.
+        """
+        self.keyfile = keyfile
+        self._address = address
+        self._result = result
+        self._pool = pool
+        self._private_key = None
+        self._lock = threading.Lock()
+
+    @property
+    def address(self):
+        """The wallet address. Known without decrypting the keystore, unless the keystore does not include it."""
+        if self._address is None:
+            self.unlock()
+        return self._address
+
+    @property
+    def unlocked(self):
+        """Whether the keystore decryption is done."""
+        return self._private_key is not None or self._result.ready()
+
+    @property
+    def private_key(self):
+        """The wallet private key, waiting for the keystore decryption if needed.
+
+        :raises: :class:`~kin.exceptions.SdkConfigurationError`: if the keystore cannot be decrypted.
+        """
+        return self.unlock()
+
+    def unlock(self):
+        """Wait for the keystore decryption.
+
+        :returns: the private key.
+
+        :raises: :class:`~kin.exceptions.SdkConfigurationError`: if the keystore cannot be decrypted, or if the
+            key does not match the address stored in the keystore.
+        """
+        with self._lock:
+            if self._private_key is None:
+                private_key, error = self._result.get()
+                self._pool = None
+                if error:
+                    raise SdkConfigurationError('keyfile decode error: {}: {}'.format(self.keyfile, error))
+                address = keys.PrivateKey(hexstr_if_str(to_bytes, private_key)).public_key.to_checksum_address()
+                if self._address and self._address != address:
+                    raise SdkConfigurationError('keyfile address mismatch: {}'.format(self.keyfile))
+                self._address = address
+                self._private_key = private_key
+            return self._private_key
+
+    def __repr__(self):
+        return 'Wallet({})'.format(self.keyfile)
+
+
+def load_wallets(keyfiles, password, num_workers=None, lazy=False, progress_fn=None):
+    """Load wallets from keystore files, decrypting the keystores in parallel in a pool of processes.
+
+    :param list keyfiles: the keystore file paths.
+
+    :param password: the password of all the keystores, or a dict of keystore file path -> password.
+
+    :param int num_workers: the number of decrypting processes. Defaults to the number of CPUs.
+
+    :param bool lazy: if True, return right away and decrypt the keystores in the background. The wallet
+        addresses can be used right away (if stored in the keystores), and a private key is waited for when first
+        used, for example by the first transaction sent with the wallet.
+
+    :param progress_fn: a function with the signature `func(done, total)`, called when a keystore is decrypted.
+        It is called from a background thread.
+
+    :returns: the wallets, in the order of the keystore files.
+    :rtype: list of :class:`~kin.Wallet`
+
+    :raises: :class:`~kin.exceptions.SdkConfigurationError`: if a keystore file is invalid. Unless loading lazily,
+        also if a keystore cannot be decrypted.
+    """
+    from ethereum.tools import keys as ekeys
+
+    keystores = []
+    for keyfile in keyfiles:
+        with open(keyfile, 'r') as f:
+            try:
+                keystore = json.load(f)
+            except Exception:
+                raise SdkConfigurationError('invalid json in keystore file: {}'.format(keyfile))
+        if not ekeys.check_keystore_json(keystore):
+            raise SdkConfigurationError('invalid keystore file: {}'.format(keyfile))
+        keystores.append(keystore)
+    if not keystores:
+        return []
+
+    total = len(keystores)
+    progress = {'done': 0}
+    progress_lock = threading.Lock()
+
+    def on_unlocked(_):
+        with progress_lock:
+            progress['done'] += 1
+            done = progress['done']
+        logger.debug('decrypted %d of %d keystores', done, total)
+        if progress_fn:
+            try:
+                progress_fn(done, total)
+            except Exception:
+                logger.exception('progress callback failed')
+
+    pool = multiprocessing.Pool(min(num_workers or multiprocessing.cpu_count(), total))
+    wallets = []
+    for keyfile, keystore in zip(keyfiles, keystores):
+        keyfile_password = password if isinstance(password, string_types) else password[keyfile]
+        result = pool.apply_async(_decode_keystore, (keystore, keyfile_password), callback=on_unlocked)
+        wallets.append(Wallet(keyfile, _keystore_address(keystore), result, pool))
+    pool.close()  # the workers exit once all the keystores are decrypted
+
+    if not lazy:
+        try:
+            for wallet in wallets:
+                wallet.unlock()
+        except Exception:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    return wallets
+
+
+def _decode_keystore(keystore, password):
+    """Decrypt a keystore. Runs in a pool process.
+
+    :returns: the private key and an error message, one of which is None.
+    :rtype: tuple
+    """
+    from ethereum.tools import keys as ekeys
+    try:
+        return ekeys.decode_keystore_json(keystore, password), None
+    except Exception as e:
+        return None, str(e) or e.__class__.__name__
+
+
+def _keystore_address(keystore):
+    """The checksum address stored in a keystore, or None."""
+    address = keystore.get('address')
+    if not address:
+        return None
+    try:
+        return canonical_address('0x' + address if not address.startswith('0x') else address).checksum
+    except (ValueError, TypeError):
+        return None
@@ -30,5 +30,12 @@ setup(
         'Programming Language :: Python :: 3',
     ],
     install_requires=requires,
+    extras_require={
+        'websocket': ['websocket-client>=0.44.0'],
+        'export': ['numpy>=1.13', 'pyarrow>=0.16.0'],
+    },
     tests_require=tests_requires,
+    entry_points={
+        'console_scripts': ['kin-payout = kin.payout:main'],
+    },
 )
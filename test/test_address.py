@@ -0,0 +1,56 @@
+from binascii import unhexlify
+import pickle
+
+import pytest
+
+from kin.address import (
+    Address,
+    address_bytes,
+    canonical_address,
+)
+
+CHECKSUM_ADDRESS = '0x8B455Ab06C6F7ffaD9fDbA11776E2115f1DE14BD'
+LOWER_ADDRESS = CHECKSUM_ADDRESS.lower()
+
+
+def test_canonical_address():
+    address = canonical_address(CHECKSUM_ADDRESS)
+    assert address.raw == unhexlify(LOWER_ADDRESS[2:])
+    assert address.hex == LOWER_ADDRESS
+    assert address.checksum == CHECKSUM_ADDRESS
+    assert str(address) == CHECKSUM_ADDRESS
+
+    # all the forms of an address are the same instance
+    assert canonical_address(LOWER_ADDRESS) is address
+    assert canonical_address(address) is address
+    assert Address(address.raw) is address
+    assert pickle.loads(pickle.dumps(address)) is address
+    assert address == canonical_address(LOWER_ADDRESS)
+    assert address != canonical_address('0x' + '0' * 40)
+    assert len(set([address, canonical_address(LOWER_ADDRESS)])) == 1
+
+
+def test_canonical_address_fail():
+    with pytest.raises(ValueError):
+        canonical_address('0x123')
+    with pytest.raises(ValueError):  # wrong checksum
+        canonical_address(CHECKSUM_ADDRESS[:-1] + 'd')
+    with pytest.raises(ValueError, message='address must be 20 bytes long'):
+        Address(b'\x01' * 19)
+
+
+def test_address_bytes():
+    assert address_bytes(CHECKSUM_ADDRESS) == address_bytes(LOWER_ADDRESS) == canonical_address(LOWER_ADDRESS).raw
+    assert address_bytes(None) is None
+
+
+def test_canonical_address_forms():
+    address = canonical_address(CHECKSUM_ADDRESS)
+    assert canonical_address(CHECKSUM_ADDRESS[2:]) is address  # without the 0x prefix
+    assert canonical_address(LOWER_ADDRESS[2:]) is address
+    assert canonical_address(address.raw) is address  # raw bytes
+    assert canonical_address(bytearray(address.raw)) is address
+    with pytest.raises(ValueError):
+        canonical_address(LOWER_ADDRESS[4:])
+    with pytest.raises(ValueError):
+        canonical_address(b'\x01' * 19)
@@ -0,0 +1,91 @@
+from time import sleep
+
+import pytest
+
+from kin import Cache
+
+
+class Loader(object):
+    def __init__(self, value):
+        self.value = value
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return self.value
+
+
+def test_create_fail():
+    with pytest.raises(ValueError, message='cache size must be positive'):
+        Cache(size=0)
+    with pytest.raises(ValueError, message='cache ttl must be positive'):
+        Cache(ttl=0)
+
+
+def test_read_through():
+    cache = Cache()
+    load = Loader(10)
+    assert cache.get('a', load) == 10
+    assert cache.get('a', load) == 10
+    assert load.calls == 1
+    stats = cache.stats()
+    assert stats['hits'] == 1 and stats['misses'] == 1 and stats['size'] == 1
+
+
+def test_lru_eviction():
+    cache = Cache(size=2)
+    cache.get('a', Loader(1))
+    cache.get('b', Loader(2))
+    cache.get('a', Loader(1))  # 'a' is now the most recently used
+    cache.get('c', Loader(3))  # evicts 'b'
+    load = Loader(2)
+    cache.get('b', load)
+    assert load.calls == 1
+    load = Loader(1)
+    cache.get('c', load)
+    assert load.calls == 0
+    assert cache.stats()['evictions'] == 2
+
+
+def test_ttl():
+    cache = Cache(ttl=0.05)
+    load = Loader(1)
+    cache.get('a', load)
+    cache.get('decimals', load, static=True)
+    sleep(0.1)
+    cache.get('a', load)
+    cache.get('decimals', load, static=True)  # static values never expire
+    assert load.calls == 3
+
+
+def test_per_block():
+    cache = Cache(ttl=None, per_block=True)
+    load = Loader(1)
+    cache.get('a', load)
+    cache.get('decimals', load, static=True)
+    cache.new_block(5)
+    cache.get('a', load)
+    cache.get('decimals', load, static=True)
+    assert load.calls == 3
+    cache.new_block(4)  # an older block, e.g. delivered late
+    cache.get('a', load)
+    assert load.calls == 3
+
+
+def test_invalidate():
+    cache = Cache()
+    load = Loader(1)
+    cache.get('a', load)
+    cache.get('b', load)
+    cache.invalidate('a', 'c')
+    cache.get('a', load)
+    cache.get('b', load)
+    assert load.calls == 3
+    assert cache.stats()['invalidations'] == 1
+
+    # a value loaded while being invalidated is not cached, it may be stale
+    def load_and_invalidate():
+        cache.invalidate('d')
+        return 1
+    cache.get('d', load_and_invalidate)
+    assert cache.stats()['size'] == 2
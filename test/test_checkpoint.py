@@ -0,0 +1,34 @@
+import os
+
+from kin import FileCheckpoint, SqliteCheckpoint
+
+
+def test_file_checkpoint(tmpdir):
+    path = str(tmpdir.join('checkpoint.json'))
+    checkpoint = FileCheckpoint(path)
+    assert checkpoint.load() is None
+
+    checkpoint.save(10, '0xa')
+    checkpoint.save(11, '0xb')
+    assert checkpoint.load() == (11, '0xb')
+    assert FileCheckpoint(path).load() == (11, '0xb')
+    assert os.listdir(str(tmpdir)) == ['checkpoint.json']  # no temporary files left
+
+
+def test_sqlite_checkpoint(tmpdir):
+    path = str(tmpdir.join('checkpoints.db'))
+    checkpoint1 = SqliteCheckpoint(path, name='first')
+    checkpoint2 = SqliteCheckpoint(path, name='second')
+    assert checkpoint1.load() is None
+
+    checkpoint1.save(10, '0xa')
+    checkpoint1.save(11, '0xb')
+    checkpoint2.save(20, '0xc')
+    assert checkpoint1.load() == (11, '0xb')
+    assert checkpoint2.load() == (20, '0xc')
+    checkpoint1.close()
+    checkpoint2.close()
+
+    checkpoint = SqliteCheckpoint(path, name='first')
+    assert checkpoint.load() == (11, '0xb')
+    checkpoint.close()
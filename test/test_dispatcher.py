@@ -0,0 +1,139 @@
+import threading
+
+import pytest
+
+from kin import Dispatcher
+
+
+def test_create_fail():
+    with pytest.raises(ValueError, message='number of workers must be positive'):
+        Dispatcher(num_workers=0)
+    with pytest.raises(ValueError, message='queue size must not be less than the number of workers'):
+        Dispatcher(num_workers=4, queue_size=2)
+    with pytest.raises(ValueError, message='invalid overflow policy: bad'):
+        Dispatcher(overflow_policy='bad')
+
+
+def test_ordering_per_key():
+    dispatcher = Dispatcher(num_workers=4, queue_size=1000, overflow_policy=Dispatcher.BLOCK)
+    calls = {}
+    lock = threading.Lock()
+
+    def callback(key, i):
+        with lock:
+            calls.setdefault(key, []).append(i)
+
+    for i in range(100):
+        for key in ('a', 'b', 'c', 'd', 'e'):
+            dispatcher.submit(key, callback, key, i)
+    dispatcher.close()
+
+    assert sorted(calls.keys()) == ['a', 'b', 'c', 'd', 'e']
+    for key in calls:
+        assert calls[key] == list(range(100))
+    stats = dispatcher.stats()
+    assert stats['submitted'] == stats['delivered'] == 500
+    assert stats['dropped'] == stats['failed'] == stats['queued'] == 0
+
+
+def test_drop_newest():
+    dispatcher = Dispatcher(num_workers=1, queue_size=2)
+    assert dispatcher.overflow_policy == Dispatcher.DROP_NEWEST  # the default
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def callback(i):
+        started.set()
+        release.wait()
+        calls.append(i)
+
+    assert dispatcher.submit('a', callback, 0)
+    assert started.wait(5)  # the worker took the first call and is blocked on it
+    assert dispatcher.submit('a', callback, 1)
+    assert dispatcher.submit('a', callback, 2)
+    assert not dispatcher.submit('a', callback, 3)  # the queue is full, the submitter is not blocked
+    assert dispatcher.stats()['dropped'] == 1
+
+    release.set()
+    dispatcher.close()
+    assert calls == [0, 1, 2]
+
+
+def test_drop_oldest():
+    dispatcher = Dispatcher(num_workers=1, queue_size=2, overflow_policy=Dispatcher.DROP_OLDEST)
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def callback(i):
+        started.set()
+        release.wait()
+        calls.append(i)
+
+    dispatcher.submit('a', callback, 0)
+    assert started.wait(5)
+    for i in range(1, 5):
+        assert dispatcher.submit('a', callback, i)
+    assert dispatcher.stats()['dropped'] == 2
+
+    release.set()
+    dispatcher.close()
+    assert calls == [0, 3, 4]
+
+
+def test_failed_callback():
+    dispatcher = Dispatcher(num_workers=1, queue_size=10)
+    calls = []
+
+    def callback(i):
+        if i == 1:
+            raise Exception('callback error')
+        calls.append(i)
+
+    for i in range(3):
+        dispatcher.submit('a', callback, i)
+    dispatcher.close()
+
+    assert calls == [0, 2]  # a failed callback does not stop the worker
+    stats = dispatcher.stats()
+    assert stats['delivered'] == 3
+    assert stats['failed'] == 1
+
+
+def test_submit_after_close():
+    dispatcher = Dispatcher(num_workers=1, queue_size=1, overflow_policy=Dispatcher.BLOCK)
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def callback(i):
+        started.set()
+        release.wait()
+        calls.append(i)
+
+    dispatcher.submit('a', callback, 0)
+    assert started.wait(5)  # the worker took the first call and is blocked on it
+    dispatcher.submit('a', callback, 1)  # fills the queue
+
+    # a submitter blocked on the full queue gives up once the dispatcher is closed
+    results = []
+    blocked = threading.Thread(target=lambda: results.append(dispatcher.submit('a', callback, 2)))
+    blocked.start()
+    blocked.join(0.2)
+    assert blocked.is_alive()  # waiting for a free slot
+    closer = threading.Thread(target=dispatcher.close)
+    closer.start()
+    closer.join(0.2)
+    assert closer.is_alive()  # waiting for the blocked worker
+    release.set()
+    blocked.join(5)
+    closer.join(5)
+    assert not blocked.is_alive() and not closer.is_alive()
+    assert results == [2 in calls]  # queued before the workers stopped, or dropped
+
+    assert not dispatcher.submit('a', callback, 3)  # the queue has room, but the dispatcher is closed
+    assert 3 not in calls
+    stats = dispatcher.stats()
+    assert stats['submitted'] == 4
+    assert stats['delivered'] + stats['dropped'] == 4
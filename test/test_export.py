@@ -0,0 +1,106 @@
+from binascii import hexlify
+import os
+
+import pytest
+
+from kin.export import (
+    TRANSFER_EVENT_TOPIC,
+    decode_transfer_logs,
+    export_transfers,
+    iter_transfer_chunks,
+)
+
+np = pytest.importorskip('numpy')
+
+TOKEN_ADDRESS = '0xEF2Fcc998847DB203DEa15fC49d0872C7614910C'
+FROM_ADDRESS = '4c6527c2beb032d46cfe0648072cab641ca0aa80'
+TO_ADDRESS = '8b455ab06c6f7ffad9fdba11776e2115f1de14bd'
+
+
+def transfer_log(block_number, tx_index, amount):
+    return {
+        'address': TOKEN_ADDRESS.lower(),
+        'blockNumber': hex(block_number),
+        'transactionIndex': hex(tx_index),
+        'logIndex': '0x0',
+        'transactionHash': '0x' + '{:064x}'.format(block_number * 1000 + tx_index),
+        'topics': [TRANSFER_EVENT_TOPIC, '0x' + '0' * 24 + FROM_ADDRESS, '0x' + '0' * 24 + TO_ADDRESS],
+        'data': '0x' + '{:064x}'.format(amount),
+    }
+
+
+class Provider(object):
+    """A stand-in provider, with one transfer per tx index in every block."""
+
+    def __init__(self, transfers_per_block=2):
+        self.transfers_per_block = transfers_per_block
+        self.calls = []
+
+    def make_batch_request(self, calls):
+        responses = []
+        for method, params in calls:
+            assert method == 'eth_getLogs'
+            log_filter = params[0]
+            self.calls.append(log_filter)
+            first, last = int(log_filter['fromBlock'], 16), int(log_filter['toBlock'], 16)
+            responses.append({'result': [transfer_log(number, index, (index + 1) * 10 ** 18)
+                                         for number in range(first, last + 1)
+                                         for index in range(self.transfers_per_block)]})
+        return responses
+
+
+def test_decode_transfer_logs():
+    logs = [transfer_log(5, 0, 1500000000000000000), transfer_log(5, 1, 1)]
+    logs.append(dict(logs[0], topics=logs[0]['topics'][:1]))  # not an ERC20 transfer, skipped
+    columns = decode_transfer_logs(logs)
+
+    assert columns['block_number'].tolist() == [5, 5]
+    assert columns['tx_index'].tolist() == [0, 1]
+    assert columns['from'].shape == (2, 20)
+    assert columns['from'][0].tobytes() == bytes(bytearray.fromhex(FROM_ADDRESS))
+    assert columns['to'][1].tobytes() == bytes(bytearray.fromhex(TO_ADDRESS))
+    assert columns['amount'].tolist() == [1500000, 0]  # fixed-point, 6 decimals
+    assert int(hexlify(columns['amount_raw'][1].tobytes()), 16) == 1  # exact
+
+    assert decode_transfer_logs([])['amount'].shape == (0,)
+    with pytest.raises(ValueError, message='amount too large for 6 decimals'):
+        decode_transfer_logs([transfer_log(1, 0, 10 ** 40)])
+
+
+def test_iter_transfer_chunks():
+    provider = Provider()
+    chunks = list(iter_transfer_chunks(provider, TOKEN_ADDRESS, 10, 34, chunk_blocks=10, num_workers=2))
+    assert [(first, last) for first, last, _ in chunks] == [(10, 19), (20, 29), (30, 34)]
+    assert chunks[2][2]['block_number'].tolist() == [30, 30, 31, 31, 32, 32, 33, 33, 34, 34]
+    assert all(call['address'] == TOKEN_ADDRESS and call['topics'] == [TRANSFER_EVENT_TOPIC]
+               for call in provider.calls)
+
+
+def test_export_npz(tmpdir):
+    path = str(tmpdir.join('transfers'))
+    assert export_transfers(Provider(), TOKEN_ADDRESS, path, 1, 25, chunk_blocks=10) == 50
+    files = sorted(os.listdir(path))
+    assert files == ['transfers-0000000001-0000000010.npz', 'transfers-0000000011-0000000020.npz',
+                     'transfers-0000000021-0000000025.npz']
+    chunk = np.load(os.path.join(path, files[2]))
+    assert chunk['block_number'].tolist() == [21, 21, 22, 22, 23, 23, 24, 24, 25, 25]
+    assert chunk['amount'].sum() == 5 * 3000000
+
+    with pytest.raises(ValueError, message='invalid export format: csv'):
+        export_transfers(Provider(), TOKEN_ADDRESS, path, 1, 25, format='csv')
+
+
+@pytest.mark.parametrize('format', ['arrow', 'parquet'])
+def test_export_arrow(tmpdir, format):
+    pa = pytest.importorskip('pyarrow')
+    path = str(tmpdir.join('transfers.' + format))
+    assert export_transfers(Provider(), TOKEN_ADDRESS, path, 1, 25, format=format, chunk_blocks=10) == 50
+
+    if format == 'parquet':
+        import pyarrow.parquet as pq
+        table = pq.read_table(path)
+    else:
+        table = pa.ipc.open_stream(pa.OSFile(path, 'rb')).read_all()
+    assert table.num_rows == 50
+    assert table.column('block_number').to_pylist()[:4] == [1, 1, 2, 2]
+    assert table.column('to').to_pylist()[0] == bytes(bytearray.fromhex(TO_ADDRESS))
@@ -0,0 +1,286 @@
+import threading
+from time import sleep, time
+
+import pytest
+
+from kin.monitor import (
+    BlockTracker,
+    LRUSet,
+    MonitorHandle,
+    PendingTxIngestor,
+    iter_block_range,
+)
+
+
+class Chain(object):
+    """A synthetic chain of blocks, allowing forks."""
+
+    def __init__(self):
+        self.blocks = {}
+        genesis = {'number': 0, 'hash': '0x0', 'parentHash': None, 'transactions': []}
+        self.blocks[genesis['hash']] = genesis
+        self.head = genesis
+
+    def mine(self, parent=None, fork=''):
+        parent = parent or self.head
+        number = parent['number'] + 1
+        block = {'number': number, 'hash': '0x{}{}'.format(fork, number), 'parentHash': parent['hash'],
+                 'transactions': []}
+        self.blocks[block['hash']] = block
+        self.head = block
+        return block
+
+    def get_block(self, block_hash):
+        return self.blocks.get(block_hash)
+
+
+def numbers(entries):
+    return [entry.number for entry in entries]
+
+
+def test_create_fail():
+    with pytest.raises(ValueError, message='confirmations must be positive'):
+        BlockTracker(None, confirmations=0)
+    with pytest.raises(ValueError, message='buffer size must be greater than confirmations'):
+        BlockTracker(None, confirmations=3, buffer_size=3)
+
+
+def test_confirm_on_arrival():
+    chain = Chain()
+    tracker = BlockTracker(chain.get_block)
+    for number in range(1, 4):
+        orphaned, confirmed = tracker.add(chain.mine())
+        assert orphaned == []
+        assert numbers(confirmed) == [number]
+    assert tracker.add(chain.head) == ([], [])  # duplicates are ignored
+    assert tracker.head.number == 3
+
+
+def test_confirmation_depth():
+    chain = Chain()
+    tracker = BlockTracker(chain.get_block, confirmations=3)
+    assert tracker.add(chain.mine()) == ([], [])
+    assert tracker.add(chain.mine()) == ([], [])
+    orphaned, confirmed = tracker.add(chain.mine())
+    assert numbers(confirmed) == [1]
+    orphaned, confirmed = tracker.add(chain.mine())
+    assert numbers(confirmed) == [2]
+
+
+def test_fill_missing_blocks():
+    chain = Chain()
+    tracker = BlockTracker(chain.get_block, buffer_size=4)
+    tracker.add(chain.mine())
+    for _ in range(9):
+        chain.mine()
+    orphaned, confirmed = tracker.add(chain.head)
+    assert orphaned == []
+    assert numbers(confirmed) == list(range(2, 11))  # longer than the buffer, nothing is lost
+
+
+def test_reorg():
+    chain = Chain()
+    tracker = BlockTracker(chain.get_block)
+    for _ in range(3):
+        tracker.add(chain.mine())
+    fork_point = chain.get_block('0x1')
+
+    # the fork becomes longer than the original chain
+    chain.mine(fork_point, fork='f')
+    chain.mine(fork='f')
+    orphaned, confirmed = tracker.add(chain.mine(fork='f'))
+    assert [entry.hash for entry in orphaned] == ['0x3', '0x2']
+    assert [entry.hash for entry in confirmed] == ['0xf2', '0xf3', '0xf4']
+    assert tracker.reorgs == 1
+    assert tracker.head.hash == '0xf4'
+
+
+def test_reorg_before_confirmation():
+    chain = Chain()
+    tracker = BlockTracker(chain.get_block, confirmations=2)
+    tracker.add(chain.mine())
+    tracker.add(chain.mine())  # confirms block 1
+    tracker.add(chain.mine())  # confirms block 2
+
+    orphaned, confirmed = tracker.add(chain.mine(chain.get_block('0x2'), fork='f'))
+    assert numbers(orphaned) == [3]
+    assert not orphaned[0].confirmed  # never reported, nothing to roll back
+    assert confirmed == []
+    orphaned, confirmed = tracker.add(chain.mine(fork='f'))
+    assert [entry.hash for entry in confirmed] == ['0xf3']
+
+
+def test_deep_reorg():
+    chain = Chain()
+    tracker = BlockTracker(chain.get_block, buffer_size=3)
+    for _ in range(5):
+        tracker.add(chain.mine())
+
+    fork_head = chain.mine(chain.get_block('0x0'), fork='f')
+    for _ in range(5):
+        fork_head = chain.mine(fork='f')
+    orphaned, confirmed = tracker.add(fork_head)
+    assert numbers(orphaned) == [5, 4, 3]
+    # the new chain is reported as far back as the buffer allowed
+    assert [entry.hash for entry in confirmed] == ['0xf3', '0xf4', '0xf5', '0xf6']
+
+
+def test_seed():
+    chain = Chain()
+    for _ in range(3):
+        chain.mine()
+    tracker = BlockTracker(chain.get_block)
+    tracker.seed(3, '0x3')
+    assert tracker.head.number == 3 and tracker.head.confirmed
+
+    chain.mine()
+    orphaned, confirmed = tracker.add(chain.mine())
+    assert orphaned == []
+    assert numbers(confirmed) == [4, 5]
+
+
+def test_iter_block_range():
+    fetched = []
+    lock = threading.Lock()
+
+    def fetch_blocks(first, last):
+        with lock:
+            fetched.append((first, last))
+        return [{'number': number} for number in range(first, last + 1)]
+
+    blocks = iter_block_range(fetch_blocks, 10, 56, num_workers=3, batch_size=5)
+    assert [block['number'] for block in blocks] == list(range(10, 57))
+    assert sorted(fetched) == [(start, min(start + 4, 56)) for start in range(10, 57, 5)]
+    assert list(iter_block_range(fetch_blocks, 10, 9)) == []
+
+
+def test_lru_set():
+    lru = LRUSet(3)
+    assert not lru.add('a')
+    assert not lru.add('b')
+    assert not lru.add('c')
+    assert lru.add('a')  # already there, now the most recently used
+    assert not lru.add('d')  # evicts 'b'
+    assert 'b' not in lru
+    assert 'a' in lru and 'c' in lru and 'd' in lru
+    assert len(lru) == 3
+    lru.discard('a')
+    assert 'a' not in lru
+
+
+def wait_for(condition, timeout=5):
+    deadline = time() + timeout
+    while not condition():
+        if time() > deadline:
+            return False
+        sleep(0.001)
+    return True
+
+
+def test_pending_tx_ingestor():
+    batches = []
+    handled = []
+    release = threading.Event()
+
+    def fetch_txs(tx_ids):
+        release.wait()
+        batches.append(list(tx_ids))
+        return [{'hash': tx_id} if tx_id != 'missing' else None for tx_id in tx_ids]
+
+    ingestor = PendingTxIngestor(fetch_txs, handled.extend, batch_size=3)
+    ingestor.start()
+    try:
+        ingestor.add(['a'])
+        sleep(0.1)  # the first fetch is blocked, the rest are queued meanwhile
+        ingestor.add(['b', 'c', 'a', 'missing'])
+        ingestor.add(['d', 'b'])
+        release.set()
+        assert wait_for(lambda: ingestor.stats()['fetched'] == 5)
+
+        assert batches == [['a'], ['b', 'c', 'missing'], ['d']]
+        assert [tx['hash'] for tx in handled] == ['a', 'b', 'c', 'd']
+        stats = ingestor.stats()
+        assert stats['received'] == 7
+        assert stats['skipped'] == 2
+        assert stats['dropped'] == stats['queued'] == 0
+
+        # forgotten transactions are handled again
+        ingestor.forget('a')
+        ingestor.add(['a'])
+        assert wait_for(lambda: len(handled) == 5)
+    finally:
+        ingestor.close()
+
+
+def test_pending_tx_ingestor_queue_full():
+    release = threading.Event()
+
+    def fetch_txs(tx_ids):
+        release.wait()
+        return []
+
+    ingestor = PendingTxIngestor(fetch_txs, lambda txs: None, queue_size=2)
+    ingestor.start()
+    try:
+        ingestor.add(['a'])
+        sleep(0.1)
+        ingestor.add(['b', 'c', 'd'])
+        assert ingestor.stats()['dropped'] == 1
+        assert 'd' not in ingestor.seen  # dropped ids can be received again
+    finally:
+        release.set()
+        ingestor.close()
+
+
+def test_pending_tx_ingestor_fetch_fail():
+    handled = []
+    failures = [IOError('node error')]
+
+    def fetch_txs(tx_ids):
+        if failures:
+            raise failures.pop()
+        return [{'hash': tx_id} for tx_id in tx_ids]
+
+    ingestor = PendingTxIngestor(fetch_txs, handled.extend)
+    ingestor.start()
+    try:
+        ingestor.add(['a'])
+        assert wait_for(lambda: 'a' not in ingestor.seen)  # the failed fetch forgets the id
+        assert handled == [] and ingestor.stats()['fetched'] == 0
+
+        # so that it is handled when received again
+        ingestor.add(['a'])
+        assert wait_for(lambda: handled == [{'hash': 'a'}])
+    finally:
+        ingestor.close()
+
+
+def test_monitor_handle():
+    stops = []
+    handle = MonitorHandle(lambda: stops.append(1))
+    assert not handle.stopped
+    handle.stop()
+    handle.stop()
+    assert handle.stopped and stops == [1]
+
+    with MonitorHandle(lambda: stops.append(2)) as handle:
+        assert not handle.stopped
+    assert handle.stopped and stops == [1, 2]
+
+
+def test_pending_tx_ingestor_close_no_wait():
+    fetching = threading.Event()
+    release = threading.Event()
+
+    def fetch(tx_ids):
+        fetching.set()
+        release.wait()
+        return []
+
+    ingestor = PendingTxIngestor(fetch, lambda txs: None)
+    ingestor.start()
+    ingestor.add(['a'])
+    assert fetching.wait(5)
+    ingestor.close(wait=False)  # does not wait for the blocked fetch
+    assert not ingestor.running
+    release.set()
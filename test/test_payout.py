@@ -0,0 +1,196 @@
+from binascii import unhexlify
+import csv
+from decimal import Decimal
+import io
+import json
+
+import pytest
+
+from kin import payout
+from kin.payout import (
+    Payout,
+    estimate_cost,
+    iter_payments,
+    load_results,
+    main,
+    parse_amount,
+    validate_payments,
+)
+
+from test_send_queue import ADDRESS, Node, Sdk
+
+RECIPIENT = '0x8B455Ab06C6F7ffaD9fDbA11776E2115f1DE14BD'
+
+
+def write_csv(tmpdir, rows, name='payments.csv'):
+    path = tmpdir.join(name)
+    path.write('\n'.join(rows) + '\n')
+    return str(path)
+
+
+def test_iter_payments(tmpdir):
+    path = write_csv(tmpdir, ['address,amount', RECIPIENT + ',10', '', RECIPIENT + ', 0.5 ', 'bad'])
+    assert list(iter_payments(path)) == [(2, RECIPIENT, '10'), (4, RECIPIENT, '0.5'), (5, None, None)]
+
+    path = tmpdir.join('payments.jsonl')
+    path.write('{"address": "%s", "amount": 10}\n\n{"address": "%s"}\n' % (RECIPIENT, RECIPIENT))
+    assert list(iter_payments(str(path))) == [(1, RECIPIENT, 10), (3, None, None)]
+
+
+def test_parse_amount():
+    assert parse_amount('10') == Decimal('10')
+    assert parse_amount(0.1) == Decimal('0.1')
+    assert parse_amount('1000', base_units=True) == 1000
+    with pytest.raises(ValueError, message='invalid amount: ten'):
+        parse_amount('ten')
+    with pytest.raises(ValueError, message='amount must be positive'):
+        parse_amount('-1')
+    with pytest.raises(ValueError, message='amount must be an integer in base units mode'):
+        parse_amount('0.5', base_units=True)
+    with pytest.raises(ValueError, message='amount has more than 18 decimals'):
+        parse_amount('0.0000000000000000001')
+
+
+def test_validate_payments(tmpdir):
+    path = write_csv(tmpdir, [RECIPIENT + ',10', RECIPIENT + ',2.5'])
+    assert validate_payments(path) == (2, Decimal('12.5'), [])
+
+    path = write_csv(tmpdir, [RECIPIENT + ',10', '0x123,1', RECIPIENT + ',0'])
+    count, total, errors = validate_payments(path)
+    assert count == 1
+    assert len(errors) == 2 and errors[0].startswith('row 2:') and errors[1].startswith('row 3:')
+
+
+def test_invalid_file_sends_nothing(tmpdir):
+    path = write_csv(tmpdir, [RECIPIENT + ',10', 'bad'])
+    assert main([path]) == 1
+    assert not tmpdir.join('payments.results.csv').exists()
+
+
+def read_results(path):
+    with open(path) as f:
+        return list(csv.DictReader(f))
+
+
+def test_payout(tmpdir):
+    path = write_csv(tmpdir, ['{},{}'.format(RECIPIENT, amount) for amount in range(1, 101)])
+    results_path = str(tmpdir.join('results.csv'))
+    node = Node()
+    sdk = Sdk(node)
+    sdk.base_units = False
+
+    out = io.StringIO() if str is not bytes else io.BytesIO()
+    payout = Payout(sdk, path, results_path, concurrency=10, out=out)
+    assert payout.run() == (100, 0, 0)
+    results = read_results(results_path)
+    assert sorted(int(result['row']) for result in results) == list(range(1, 101))
+    assert all(result['status'] == 'sent' for result in results)
+    assert len(node.pool) == 100
+
+    # resuming a complete payout sends nothing
+    assert Payout(sdk, path, results_path, out=out).run() == (0, 0, 100)
+    assert len(node.pool) == 100
+
+
+def test_payout_resume(tmpdir):
+    path = write_csv(tmpdir, ['{},{}'.format(RECIPIENT, amount) for amount in range(1, 6)])
+    results_path = str(tmpdir.join('results.csv'))
+    node = Node()
+    sdk = Sdk(node)
+    sdk.base_units = False
+    out = io.StringIO() if str is not bytes else io.BytesIO()
+
+    node.error = ValueError({'code': -32000, 'message': 'nonce too low'})
+    assert Payout(sdk, path, results_path, out=out).run() == (0, 5, 0)
+    sent, failures = load_results(results_path)
+    assert sent == set() and sorted(failures) == list(range(1, 6))
+    assert all(len(tx_ids) == 1 for tx_ids in failures.values())
+
+    # failed rows are sent again
+    node.error = None
+    assert Payout(sdk, path, results_path, out=out).run() == (5, 0, 0)
+    sent, failures = load_results(results_path)
+    assert sent == set(range(1, 6)) and failures == {}
+    assert len(node.pool) == 5
+
+
+def test_payout_failed_but_mined(tmpdir):
+    path = write_csv(tmpdir, ['{},{}'.format(RECIPIENT, amount) for amount in range(1, 4)])
+    results_path = str(tmpdir.join('results.csv'))
+    node = Node()
+    sdk = Sdk(node)
+    sdk.base_units = False
+    out = io.StringIO() if str is not bytes else io.BytesIO()
+
+    # the node mines the first transfers, but their responses are lost, and the retries are rejected as
+    # 'nonce too low' for transactions the node already holds
+    node.lost_responses = 2
+    assert Payout(sdk, path, results_path, out=out).run() == (3, 0, 0)
+    assert len(node.mined) == 2 and len(node.pool) == 1
+
+    # a row recorded as failed, whose transfer is known to the node, is not paid again
+    path = write_csv(tmpdir, ['{},{}'.format(RECIPIENT, amount) for amount in range(1, 3)], name='more.csv')
+    results_path = str(tmpdir.join('more-results.csv'))
+    node.error = ValueError({'code': -32000, 'message': 'nonce too low'})
+    assert Payout(sdk, path, results_path, out=out).run() == (0, 2, 0)
+    node.error = None
+    _, failures = load_results(results_path)
+    node.pool[failures[1][0]] = 100  # the first failed transfer reached the node after all
+    sent_before = len(node.sent)
+    assert Payout(sdk, path, results_path, out=out).run() == (1, 0, 1)
+    assert len(node.sent) == sent_before + 1
+    sent, failures = load_results(results_path)
+    assert sent == set([1, 2]) and failures == {}
+
+
+def test_payout_gap(tmpdir):
+    path = write_csv(tmpdir, ['{},{}'.format(RECIPIENT, amount) for amount in range(1, 6)])
+    results_path = str(tmpdir.join('results.csv'))
+    node = Node()
+    sdk = Sdk(node)
+    sdk.base_units = False
+    out = io.StringIO() if str is not bytes else io.BytesIO()
+
+    # the third transfer is rejected after its nonce was reserved, which holds the later transfers back
+    node.nonce_errors[2] = ValueError({'code': -32000, 'message': 'insufficient funds'})
+    assert Payout(sdk, path, results_path, out=out).run() == (4, 1, 0)
+
+    # until the gap is filled with a transfer to self
+    assert node.getTransactionCount(ADDRESS, 'pending') == 5
+    assert node.sent[-1].endswith(':2')
+
+
+class EstimatingSdk(Sdk):
+    """A stand-in SDK whose provider estimates more gas for the transfers to a new address."""
+
+    def __init__(self, node):
+        Sdk.__init__(self, node)
+        self.base_units = True
+        self.batches = []
+        self.provider = type('Provider', (object,), {'make_batch_request': self._estimate})()
+
+    def _estimate(self, calls):
+        self.batches.append(len(calls))
+        return [{'result': hex(51000 if b'new' in unhexlify(params[0]['data'][2:]) else 36000)}
+                for _, params in calls]
+
+    def _from_base_units(self, amount):
+        return amount
+
+    def get_token_balance(self):
+        return 1000
+
+    def get_ether_balance(self):
+        return 10 ** 18
+
+
+def test_estimate_cost(tmpdir, monkeypatch):
+    monkeypatch.setattr(payout, 'DEFAULT_BATCH_SIZE', 2)
+    path = write_csv(tmpdir, [RECIPIENT + ',10', 'new,20', RECIPIENT + ',30', RECIPIENT + ',40', 'new,50'])
+    sdk = EstimatingSdk(Node())
+
+    # every row is estimated, in batches
+    estimate = estimate_cost(sdk, path, 5, 150)
+    assert sdk.batches == [2, 2, 1]
+    assert estimate['gas'] == 3 * 36000 + 2 * 51000
+    assert estimate['payments'] == 5 and estimate['tokens'] == 150
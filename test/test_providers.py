@@ -0,0 +1,302 @@
+import threading
+from time import sleep, time
+
+import pytest
+import requests
+
+from kin.providers import (
+    LOW_PRIORITY,
+    BroadcastProvider,
+    HedgedProvider,
+    RateLimitedProvider,
+)
+
+
+class Provider(object):
+    """A stand-in provider answering with its name after a delay."""
+
+    def __init__(self, name, delay=0, error=None):
+        self.name = name
+        self.delay = delay
+        self.error = error
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def make_request(self, method, params):
+        with self._lock:
+            self.calls.append(method)
+        sleep(self.delay)
+        if self.error:
+            raise self.error
+        return {'jsonrpc': '2.0', 'id': 1, 'result': self.name}
+
+    def make_batch_request(self, calls):
+        return [self.make_request(method, params) for method, params in calls]
+
+    def isConnected(self):
+        return True
+
+
+def test_create_fail():
+    with pytest.raises(ValueError, message='at least one provider is required'):
+        HedgedProvider([])
+    with pytest.raises(ValueError, message='write method cannot be hedged: eth_sendRawTransaction'):
+        HedgedProvider([Provider('a')], hedged_methods=['eth_call', 'eth_sendRawTransaction'])
+    with pytest.raises(ValueError, message='percentile must be between 0 and 100'):
+        HedgedProvider([Provider('a')], percentile=100)
+    with pytest.raises(ValueError, message='budget must be between 0 and 1'):
+        HedgedProvider([Provider('a')], budget=2)
+
+
+def test_hedge():
+    primary, secondary = Provider('primary', delay=0.5), Provider('secondary')
+    provider = HedgedProvider([primary, secondary], budget=1, initial_delay=0.05)
+    assert provider.make_request('eth_call', [])['result'] == 'secondary'
+    assert provider.stats() == {'requests': 1, 'hedged': 1, 'hedge_wins': 1, 'budget_denied': 0, 'failovers': 0}
+
+    # a fast primary is not hedged
+    primary.delay = 0
+    assert provider.make_request('eth_call', [])['result'] == 'primary'
+    assert provider.stats()['hedged'] == 1
+    provider.close()
+
+
+def test_no_hedge_for_writes():
+    primary, secondary = Provider('primary', delay=0.2), Provider('secondary')
+    provider = HedgedProvider([primary, secondary], budget=1, initial_delay=0.01)
+    assert provider.make_request('eth_sendRawTransaction', ['0x01'])['result'] == 'primary'
+    assert provider.make_request('eth_getTransactionCount', ['0x01', 'pending'])['result'] == 'primary'
+    assert provider.make_batch_request([('eth_call', [])]) == [{'jsonrpc': '2.0', 'id': 1, 'result': 'primary'}]
+    assert secondary.calls == []
+    assert provider.stats()['requests'] == 0
+    provider.close()
+
+
+def test_budget():
+    primary, secondary = Provider('primary', delay=0.05), Provider('secondary')
+    provider = HedgedProvider([primary, secondary], budget=0.25, initial_delay=0.01)
+    for _ in range(8):
+        provider.make_request('eth_getBalance', [])
+    stats = provider.stats()
+    assert stats['hedged'] == 2  # a hedge is earned every 4 requests
+    assert stats['budget_denied'] == 6
+    assert len(secondary.calls) == 2
+    provider.close()
+
+
+def test_percentile_delay():
+    primary, secondary = Provider('primary', delay=0.01), Provider('secondary')
+    provider = HedgedProvider([primary, secondary], budget=1, initial_delay=1)
+    for _ in range(20):
+        provider.make_request('eth_call', [])
+    assert provider.stats()['hedged'] == 0
+
+    # once the latencies are known, a request slower than the percentile is hedged
+    primary.delay = 0.3
+    assert provider.make_request('eth_call', [])['result'] == 'secondary'
+    assert provider.stats()['hedged'] == 1
+    provider.close()
+
+
+def test_failures():
+    primary, secondary = Provider('primary', delay=0.2, error=IOError('primary down')), Provider('secondary')
+    provider = HedgedProvider([primary, secondary], budget=1, initial_delay=0.01)
+    assert provider.make_request('eth_call', [])['result'] == 'secondary'
+
+    # a failed hedge does not hide the primary response
+    primary.error, secondary.error = None, IOError('secondary down')
+    assert provider.make_request('eth_call', [])['result'] == 'primary'
+
+    # when all fail, the first error is raised
+    primary.error = IOError('primary down')
+    primary.delay = 0
+    with pytest.raises(IOError, message='primary down'):
+        provider.make_request('eth_call', [])
+    provider.close()
+
+
+def test_failover():
+    primary, secondary = Provider('primary', error=IOError('primary down')), Provider('secondary')
+    provider = HedgedProvider([primary, secondary], budget=0, initial_delay=1)
+
+    # a primary error fails over at once, even with no budget left for hedges
+    start = time()
+    assert provider.make_request('eth_call', [])['result'] == 'secondary'
+    assert time() - start < 0.5
+    assert provider.stats() == {'requests': 1, 'hedged': 0, 'hedge_wins': 0, 'budget_denied': 0, 'failovers': 1}
+
+    # when the backup fails as well, the primary error is raised
+    secondary.error = IOError('secondary down')
+    with pytest.raises(IOError, message='primary down'):
+        provider.make_request('eth_call', [])
+    assert provider.stats()['failovers'] == 2
+    provider.close()
+
+
+def test_null_reads_by_hash():
+    class LaggingProvider(Provider):
+        def make_request(self, method, params):
+            response = Provider.make_request(self, method, params)
+            response['result'] = None  # the transaction is not known yet
+            return response
+
+    primary, secondary = Provider('primary', delay=0.2), LaggingProvider('secondary')
+    provider = HedgedProvider([primary, secondary], budget=1, initial_delay=0.01)
+    assert provider.make_request('eth_getTransactionReceipt', ['0x01'])['result'] == 'primary'
+    assert provider.stats()['hedge_wins'] == 0
+
+    # a null result is returned when the other request fails
+    primary.error = IOError('primary down')
+    assert provider.make_request('eth_getTransactionByHash', ['0x01'])['result'] is None
+    provider.close()
+
+
+def test_rate_limit_create_fail():
+    with pytest.raises(ValueError, message='rate must be positive'):
+        RateLimitedProvider(Provider('a'), 0)
+    with pytest.raises(ValueError, message='rate of eth_call must be positive'):
+        RateLimitedProvider(Provider('a'), 10, method_rates={'eth_call': 0})
+    with pytest.raises(ValueError, message='invalid priority of eth_call: 5'):
+        RateLimitedProvider(Provider('a'), 10, priorities={'eth_call': 5})
+
+
+def test_rate_limit():
+    node = Provider('node')
+    provider = RateLimitedProvider(node, rate=50, burst=5)
+    start = time()
+    for _ in range(15):
+        assert provider.make_request('eth_blockNumber', [])['result'] == 'node'
+    assert 0.15 < time() - start < 1  # 5 at once, then 10 at 50 per second
+    assert len(provider.make_batch_request([('eth_call', [])] * 3)) == 3
+
+    stats = provider.stats()
+    assert stats['queued'] == 0
+    assert stats['queue_delay']['normal']['requests'] == 15
+    assert stats['queue_delay']['low']['requests'] == 1
+    assert 0 < stats['queue_delay']['normal']['max'] < 1
+
+
+def test_rate_limit_priority():
+    node = Provider('node')
+    provider = RateLimitedProvider(node, rate=20, burst=1, priorities={'eth_blockNumber': LOW_PRIORITY})
+    provider.make_request('eth_blockNumber', [])  # empty the bucket
+
+    def request(method):
+        provider.make_request(method, [])
+
+    threads = [threading.Thread(target=request, args=(method,))
+               for method in ['eth_getBalance', 'eth_blockNumber', 'eth_getBlockByNumber']]
+    for thread in threads:
+        thread.start()
+        sleep(0.01)
+    sleep(0.01)
+    # sends jump the queue
+    thread = threading.Thread(target=request, args=('eth_sendRawTransaction',))
+    thread.start()
+    threads.append(thread)
+    for thread in threads:
+        thread.join()
+    assert node.calls[1:] == ['eth_sendRawTransaction', 'eth_getBlockByNumber', 'eth_getBalance',
+                              'eth_blockNumber']
+
+
+def test_rate_limit_large_batch():
+    node = Provider('node')
+    provider = RateLimitedProvider(node, rate=20, burst=2, method_rates={'eth_getBalance': 20})
+    assert len(provider.make_batch_request([('eth_getBalance', [])] * 100)) == 100
+    # the batch takes a full bucket only, a send waits for a token and not for 100 of them
+    start = time()
+    provider.make_request('eth_sendRawTransaction', [])
+    provider.make_request('eth_getBalance', [])
+    assert time() - start < 0.5
+
+
+def test_rate_limit_method_budget():
+    node = Provider('node')
+    provider = RateLimitedProvider(node, rate=1000, method_rates={'eth_getBalance': 10})
+    start = time()
+    for _ in range(13):
+        provider.make_request('eth_getBalance', [])
+    assert time() - start > 0.25  # 10 at once, then 3 at 10 per second
+    # other methods are not held back
+    start = time()
+    for _ in range(4):
+        provider.make_request('eth_call', [])
+    assert time() - start < 0.1
+
+
+def test_rate_limit_throttled():
+    class ThrottledProvider(Provider):
+        rejections = 2
+
+        def make_request(self, method, params):
+            if self.rejections:
+                self.rejections -= 1
+                response = requests.Response()
+                response.status_code = 429
+                raise requests.exceptions.HTTPError('429 Too Many Requests', response=response)
+            return Provider.make_request(self, method, params)
+
+    provider = RateLimitedProvider(ThrottledProvider('node'), rate=100)
+    assert provider.make_request('eth_call', [])['result'] == 'node'
+    assert provider.stats()['throttled'] == 2
+
+
+class Node(Provider):
+    """A stand-in node answering raw transaction sends with an error, or the transaction hash."""
+
+    def __init__(self, name, delay=0, error=None, rpc_error=None):
+        Provider.__init__(self, name, delay, error)
+        self.rpc_error = rpc_error
+
+    def make_request(self, method, params):
+        response = Provider.make_request(self, method, params)
+        if method == 'eth_sendRawTransaction':
+            if self.rpc_error:
+                return {'jsonrpc': '2.0', 'id': 1, 'error': {'code': -32000, 'message': self.rpc_error}}
+            response['result'] = TX_ID
+        return response
+
+
+RAW_TX = '0x0102'
+TX_ID = '0x22ae6da6b482f9b1b19b0b897c3fd43884180a1c5ee361e1107a1bc635649dda'  # keccak(0x0102)
+
+
+def test_broadcast():
+    nodes = [Node('slow', delay=0.3), Node('fast'), Node('failed', error=IOError('down'))]
+    provider = BroadcastProvider(nodes)
+    start = time()
+    assert provider.make_request('eth_sendRawTransaction', [RAW_TX])['result'] == TX_ID
+    assert time() - start < 0.2  # the first acceptance is authoritative
+    assert all(node.calls == ['eth_sendRawTransaction'] for node in nodes)
+
+    # other requests go to the first node only
+    assert provider.make_request('eth_getTransactionCount', [])['result'] == 'slow'
+    assert provider.make_batch_request([('eth_call', [])])[0]['result'] == 'slow'
+    assert nodes[1].calls == ['eth_sendRawTransaction']
+
+    sleep(0.4)
+    stats = provider.stats()
+    assert stats['transactions'] == 1 and stats['failed'] == 0
+    assert stats['endpoints']['0']['accepted'] == 1 and stats['endpoints']['0']['max_latency'] >= 0.3
+    assert stats['endpoints']['1']['accepted'] == 1 and stats['endpoints']['1']['first'] == 1
+    assert stats['endpoints']['2']['failed'] == 1
+    provider.close()
+
+
+def test_broadcast_known():
+    nodes = [Node('a', rpc_error='nonce too low'), Node('b', delay=0.05, rpc_error='already known')]
+    provider = BroadcastProvider(nodes)
+    assert provider.make_request('eth_sendRawTransaction', [RAW_TX])['result'] == TX_ID
+    assert provider.stats()['endpoints']['0']['rejected'] == 1
+
+    # when all nodes reject, the first node error is returned
+    nodes[1].rpc_error = 'insufficient funds'
+    assert provider.make_request('eth_sendRawTransaction', [RAW_TX])['error']['message'] == 'nonce too low'
+    assert provider.stats()['failed'] == 1
+
+    # not to be taken for a 'known transaction' error
+    nodes[1].rpc_error = 'unknown account'
+    assert provider.make_request('eth_sendRawTransaction', [RAW_TX])['error']['message'] == 'nonce too low'
+    assert provider.stats()['failed'] == 2
+    provider.close()
@@ -2,10 +2,14 @@
 from decimal import Decimal
 import json
 import kin
+from kin.compat import integer_types
 import os
 import pytest
 import sys
-from time import sleep
+import threading
+from time import sleep, time
+
+from web3.providers.base import BaseProvider
 
 # Ropsten constants
 ROPSTEN_ADDRESS = '0x4c6527c2BEB032D46cfe0648072cAb641cA0aA80'
@@ -211,6 +215,43 @@ def test_send_tokens_fail(test_sdk, testnet):
     # but will result in failed onchain transaction
 
 
+def test_base_units(testnet):
+    sdk = kin.TokenSDK(provider_endpoint_uri=testnet.provider_endpoint_uri, private_key=testnet.private_key,
+                       contract_address=testnet.contract_address, contract_abi=testnet.contract_abi,
+                       base_units=True)
+    assert sdk.base_units
+
+    ether_balance = sdk.get_ether_balance()
+    assert isinstance(ether_balance, integer_types) and ether_balance > 0
+    token_balance = sdk.get_address_token_balance(testnet.address)
+    assert isinstance(token_balance, integer_types) and token_balance > 0
+
+    with pytest.raises(ValueError, message='amount must be an integer in base units mode'):
+        sdk.send_tokens(testnet.address, 0.5)
+    with pytest.raises(ValueError, message='amount must be an integer in base units mode'):
+        sdk.send_ether(testnet.address, Decimal('0.001'))
+    with pytest.raises(ValueError, message='amount must be positive'):
+        sdk.send_tokens(testnet.address, 0)
+
+
+def test_cache(testnet):
+    cache = kin.Cache(size=100, ttl=60)
+    sdk = kin.TokenSDK(provider_endpoint_uri=testnet.provider_endpoint_uri, private_key=testnet.private_key,
+                       contract_address=testnet.contract_address, contract_abi=testnet.contract_abi,
+                       cache=cache)
+    token_balance = sdk.get_token_balance()
+    assert sdk.get_address_token_balance(testnet.address) == token_balance
+    assert sdk.get_token_decimals() == 18
+    assert sdk.get_token_decimals() == 18
+    stats = sdk.get_cache_stats()
+    assert stats['hits'] == 2 and stats['misses'] == 2
+
+    # own sends invalidate the balances of both addresses
+    sdk.send_tokens(testnet.address, 1)
+    sdk.get_token_balance()
+    assert sdk.get_cache_stats()['misses'] == 3
+
+
 def test_get_transaction_status(test_sdk, testnet):
     # unknown
     tx_status = test_sdk.get_transaction_status('0xdeadbeefdeadbeefdeadbeefdeadbeefdeadbeefdeadbeefdeadbeefdeadbeef')
@@ -253,6 +294,337 @@ def test_get_transaction_data(test_sdk, testnet):
         assert tx_data.num_confirmations == calc_confirmations or tx_data.num_confirmations == calc_confirmations + 1
 
 
+def test_get_transactions_data(test_sdk, testnet):
+    unknown_tx_id = '0xdeadbeefdeadbeefdeadbeefdeadbeefdeadbeefdeadbeefdeadbeefdeadbeef'
+    assert test_sdk.get_transactions_data([]) == []
+    tx_data_list = test_sdk.get_transactions_data([unknown_tx_id])
+    assert len(tx_data_list) == 1
+    assert tx_data_list[0].tx_id == unknown_tx_id
+    assert tx_data_list[0].status == kin.TransactionStatus.UNKNOWN
+    assert tx_data_list[0].num_confirmations == -1
+
+    # some tests for Ropsten only
+    if testnet.type == 'ropsten':
+        tx_ids = ['0x86d51e5547b714232d39e86e86295c20e0241f38d9b828c080cc1ec561f34daf',  # successful ether transfer
+                  unknown_tx_id,
+                  '0xb5101d58c1e51271837b5343e606b751512882e4f4b175b2f6dae68b7a42d4ab',  # successful token transfer
+                  '0x7a3f2c843a04f6050258863dbea3fec3651b107baa5419e43adb6118478da36b']  # failed token transfer
+        tx_data_list = test_sdk.get_transactions_data(tx_ids, batch_size=2)
+        assert [tx_data.tx_id for tx_data in tx_data_list] == tx_ids
+        assert [tx_data.status for tx_data in tx_data_list] == [kin.TransactionStatus.SUCCESS,
+                                                                 kin.TransactionStatus.UNKNOWN,
+                                                                 kin.TransactionStatus.SUCCESS,
+                                                                 kin.TransactionStatus.FAIL]
+        # results must be the same as those of the single transaction lookup
+        for tx_id, tx_data in zip(tx_ids, tx_data_list):
+            single_tx_data = test_sdk.get_transaction_data(tx_id)
+            if single_tx_data.from_address:
+                assert tx_data.from_address.lower() == single_tx_data.from_address.lower()
+                assert tx_data.to_address.lower() == single_tx_data.to_address.lower()
+            assert tx_data.ether_amount == single_tx_data.ether_amount
+            assert tx_data.token_amount == single_tx_data.token_amount
+            assert tx_data.num_confirmations <= single_tx_data.num_confirmations
+
+
+class StandInNode(BaseProvider):
+    """A stand-in node provider answering transaction lookups."""
+
+    def __init__(self, txs):
+        BaseProvider.__init__(self)
+        self.txs = txs
+
+    def isConnected(self):
+        return True
+
+    def make_request(self, method, params):
+        if method == 'eth_blockNumber':
+            result = '0xa'
+        elif method == 'eth_getTransactionByHash':
+            result = self.txs.get(params[0])
+        elif method == 'eth_getTransactionReceipt':
+            result = {'transactionHash': params[0], 'status': '0x1', 'gasUsed': '0x5208'}
+        else:
+            raise ValueError('unexpected method: ' + method)
+        return {'jsonrpc': '2.0', 'id': 1, 'result': result}
+
+
+def stand_in_tx(tx_id, to, data):
+    return {'hash': tx_id, 'from': TESTRPC_ADDRESS.lower(), 'to': to, 'value': '0x0', 'input': data,
+            'blockNumber': '0x6', 'blockHash': '0x' + '01' * 32, 'transactionIndex': '0x0', 'nonce': '0x1',
+            'gas': '0x15f90', 'gasPrice': '0x1'}
+
+
+def test_transaction_data_decoding():
+    token = kin.sdk.KIN_CONTRACT_ADDRESS
+    recipient = '0x00000000000000000000000000000000000012ab'  # leading zeros are kept
+    amount_word = '%064x' % (2 * 10 ** 18)
+    transfer_id, approve_id, other_id = ['0x%064x' % i for i in range(1, 4)]
+    sdk = kin.TokenSDK(provider=StandInNode({
+        transfer_id: stand_in_tx(transfer_id, token, '0xa9059cbb' + '0' * 24 + recipient[2:] + amount_word),
+        # a call to another method of the token contract
+        approve_id: stand_in_tx(approve_id, token, '0x095ea7b3' + '0' * 24 + recipient[2:] + amount_word),
+        # a transfer call to another contract
+        other_id: stand_in_tx(other_id, TESTRPC_ADDRESS.lower(),
+                              '0xa9059cbb' + '0' * 24 + recipient[2:] + amount_word),
+    }))
+
+    tx_data_list = sdk.get_transactions_data([transfer_id, approve_id, other_id])
+    single_tx_data_list = [sdk.get_transaction_data(tx_id) for tx_id in (transfer_id, approve_id, other_id)]
+    for tx_data_list in (tx_data_list, single_tx_data_list):
+        transfer, approve, other = tx_data_list
+        assert transfer.to_address == recipient
+        assert transfer.token_amount == 2
+        assert transfer.num_confirmations == 5
+        assert transfer.status == kin.TransactionStatus.SUCCESS
+        assert approve.to_address.lower() == token and approve.token_amount == 0
+        assert other.to_address.lower() == TESTRPC_ADDRESS.lower() and other.token_amount == 0
+
+
+def block_hash(number, fork=0):
+    return '0x%062x%02x' % (number, fork)
+
+
+def ether_tx(tx_id, block=None):
+    return {'hash': tx_id, 'from': TESTRPC_ADDRESS.lower(), 'to': ROPSTEN_ADDRESS.lower(), 'value': '0x1',
+            'input': '0x', 'nonce': '0x1', 'gas': '0x5208', 'gasPrice': '0x1',
+            'blockNumber': block['number'] if block else None, 'blockHash': block['hash'] if block else None,
+            'transactionIndex': '0x0' if block else None}
+
+
+class StandInChain(BaseProvider):
+    """A stand-in node serving a chain of blocks of Ether transactions, and the pending transaction and block
+    filters.
+    """
+
+    def __init__(self):
+        BaseProvider.__init__(self)
+        self.blocks = {}  # block hash -> block
+        self.chain = {}  # block number -> block hash, of the canonical chain
+        self.txs = {}  # transaction hash -> transaction
+        self.new_tx_ids = []
+        self.new_block_hashes = []
+        self.filters = set()
+        self.failing = set()  # methods answered with an error
+        self._lock = threading.Lock()
+
+    def isConnected(self):
+        return True
+
+    def make_request(self, method, params):
+        with self._lock:
+            if method in self.failing:
+                raise IOError('node error')
+            if method == 'eth_newPendingTransactionFilter':
+                result = '0x1'
+                self.filters.add(result)
+            elif method == 'eth_newBlockFilter':
+                result = '0x2'
+                self.filters.add(result)
+            elif method == 'eth_uninstallFilter':
+                result = params[0] in self.filters
+                self.filters.discard(params[0])
+            elif method == 'eth_getFilterChanges':
+                if params[0] == '0x1':
+                    result, self.new_tx_ids = self.new_tx_ids, []
+                else:
+                    result, self.new_block_hashes = self.new_block_hashes, []
+            elif method == 'eth_getBlockByHash':
+                result = self.blocks.get(params[0])
+            elif method == 'eth_getBlockByNumber':
+                result = self.blocks.get(self.chain.get(int(params[0], 16)))
+            elif method == 'eth_getTransactionByHash':
+                result = self.txs.get(params[0])
+            else:
+                raise ValueError('unexpected method: ' + method)
+        return {'jsonrpc': '2.0', 'id': 1, 'result': result}
+
+    def send(self, tx_id):
+        """Add a pending transaction."""
+        with self._lock:
+            self.txs[tx_id] = ether_tx(tx_id)
+            self.new_tx_ids.append(tx_id)
+
+    def mine(self, number, tx_ids=(), fork=0, parent_fork=0, announce=True):
+        """Add a block to the chain, announced to the block filter unless told otherwise."""
+        block = {'number': '0x%x' % number, 'hash': block_hash(number, fork),
+                 'parentHash': block_hash(number - 1, parent_fork)}
+        block['transactions'] = [ether_tx(tx_id, block) for tx_id in tx_ids]
+        with self._lock:
+            self.blocks[block['hash']] = block
+            self.chain[number] = block['hash']
+            for tx in block['transactions']:
+                self.txs[tx['hash']] = tx
+            if announce:
+                self.new_block_hashes.append(block['hash'])
+        return block
+
+
+def wait_for(condition_fn, timeout=5):
+    deadline = time() + timeout
+    while not condition_fn():
+        assert time() < deadline, 'timed out'
+        sleep(0.01)
+
+
+def test_monitor_start_fail():
+    chain = StandInChain()
+    sdk = kin.TokenSDK(provider=chain)
+    calls = []
+    for method in ('eth_newPendingTransactionFilter', 'eth_newBlockFilter'):
+        chain.failing = set([method])
+        with pytest.raises(IOError):
+            sdk.monitor_ether_transactions(lambda *args: calls.append(args), to_address=ROPSTEN_ADDRESS)
+        # the failed monitor is not registered, and the partly started ingestion is released
+        stats = sdk.get_monitoring_stats()
+        assert stats['monitors'] == stats['threads'] == stats['filters'] == 0
+        wait_for(lambda: threading.active_count() == 1)
+        assert chain.filters == set()
+
+    # the next monitor starts the ingestion over
+    chain.failing = set()
+    with sdk:
+        sdk.monitor_ether_transactions(lambda *args: calls.append(args), to_address=ROPSTEN_ADDRESS)
+        stats = sdk.get_monitoring_stats()
+        assert stats['monitors'] == 1 and stats['threads'] == 2 and stats['filters'] == 2
+        chain.mine(1, ['0x%064x' % 1])
+        wait_for(lambda: calls)
+        assert calls[0][:2] == ('0x%064x' % 1, kin.TransactionStatus.SUCCESS)
+    assert chain.filters == set()
+
+
+class CountingCheckpoint(kin.FileCheckpoint):
+    saves = 0
+
+    def save(self, block_number, block_hash):
+        self.saves += 1
+        kin.FileCheckpoint.save(self, block_number, block_hash)
+
+
+def test_monitor_checkpoint(tmpdir):
+    chain = StandInChain()
+    for number in range(1, 251):
+        chain.mine(number, ['0x%064x' % number], announce=False)
+    checkpoint = CountingCheckpoint(str(tmpdir.join('checkpoint.json')))
+    checkpoint.save(3, block_hash(3))
+    sdk = kin.TokenSDK(provider=chain, checkpoint=checkpoint)
+    calls = []
+
+    # resume from the checkpoint: blocks 4 to 250 are caught up, then the live block 251 follows
+    with sdk.monitor_ether_transactions(lambda *args: calls.append(args[0]), to_address=ROPSTEN_ADDRESS):
+        chain.mine(251, ['0x%064x' % 251])
+        wait_for(lambda: len(calls) == 248)
+        assert calls == ['0x%064x' % number for number in range(4, 252)]  # no gap, nothing reported twice
+        wait_for(lambda: checkpoint.load() == (251, block_hash(251)))  # saved after the callbacks
+        assert checkpoint.saves == 1 + 2 + 1 + 1  # the seed, two intervals, the end of the catch up, the live block
+        assert sdk.get_monitoring_stats()['catch_up']['blocks'] == 247
+    wait_for(lambda: threading.active_count() == 1)
+
+    # monitoring stopped in the middle of a catch up saves the last reported block
+    for number in range(252, 301):
+        chain.mine(number, ['0x%064x' % number], announce=False)
+    del calls[:]
+
+    def stop_at_260(tx_id, *args):
+        calls.append(tx_id)
+        if tx_id == '0x%064x' % 260:
+            monitor.stop()
+
+    monitor = sdk.monitor_ether_transactions(stop_at_260, to_address=ROPSTEN_ADDRESS)
+    chain.mine(301, ['0x%064x' % 301])
+    wait_for(lambda: monitor.stopped and threading.active_count() == 1)
+    assert calls == ['0x%064x' % number for number in range(252, 261)]
+    assert checkpoint.load() == (260, block_hash(260))
+
+    # and the next monitoring resumes right after it
+    del calls[:]
+    with sdk.monitor_ether_transactions(lambda *args: calls.append(args[0]), to_address=ROPSTEN_ADDRESS):
+        chain.mine(302, ['0x%064x' % 302])
+        wait_for(lambda: len(calls) == 42)
+        assert calls == ['0x%064x' % number for number in range(261, 303)]
+    sdk.close()
+
+
+def test_monitor_pending():
+    chain = StandInChain()
+    sdk = kin.TokenSDK(provider=chain)
+    calls = []
+    tx_a, tx_b, tx_c = ['0x%064x' % n for n in (0xa, 0xb, 0xc)]
+    with sdk.monitor_ether_transactions(lambda *args: calls.append(args[:2]), to_address=ROPSTEN_ADDRESS):
+        # a pending transaction is reported once, and again once mined
+        chain.send(tx_a)
+        chain.send(tx_a)
+        wait_for(lambda: calls)
+        chain.mine(1, [tx_a])
+        wait_for(lambda: len(calls) == 2)
+        assert calls == [(tx_a, kin.TransactionStatus.PENDING), (tx_a, kin.TransactionStatus.SUCCESS)]
+
+        # a transaction received as pending after it was reported mined is not reported as pending
+        chain.mine(2, [tx_b])
+        wait_for(lambda: len(calls) == 3)
+        chain.send(tx_b)
+        chain.send(tx_c)
+        wait_for(lambda: len(calls) == 4)
+        assert calls[2:] == [(tx_b, kin.TransactionStatus.SUCCESS), (tx_c, kin.TransactionStatus.PENDING)]
+        assert sdk.get_monitoring_stats()['pending']['skipped'] == 1
+    sdk.close()
+
+
+class KeyRecordingDispatcher(kin.Dispatcher):
+    def __init__(self, **kwargs):
+        kin.Dispatcher.__init__(self, **kwargs)
+        self.keys = []
+
+    def submit(self, key, callback_fn, *args):
+        self.keys.append(key)
+        return kin.Dispatcher.submit(self, key, callback_fn, *args)
+
+
+def test_monitor_dispatcher():
+    chain = StandInChain()
+    dispatcher = KeyRecordingDispatcher(num_workers=8)
+    sdk = kin.TokenSDK(provider=chain, dispatcher=dispatcher)
+    calls = []
+    # the calls of all the monitors of an address are ordered together
+    sdk.monitor_ether_transactions(lambda *args: calls.append(args[0]), to_address=ROPSTEN_ADDRESS)
+    sdk.monitor_ether_transactions(lambda *args: calls.append(args[0]), from_address=TESTRPC_ADDRESS,
+                                   to_address=ROPSTEN_ADDRESS)
+    sdk.monitor_ether_transactions(lambda *args: calls.append(args[0]), from_address=TESTRPC_ADDRESS)
+    chain.mine(1, ['0x%064x' % 1])
+    wait_for(lambda: len(calls) == 3)
+    sdk.close()
+    recipient, sender = kin.canonical_address(ROPSTEN_ADDRESS).raw, kin.canonical_address(TESTRPC_ADDRESS).raw
+    assert dispatcher.keys == [recipient, recipient, sender]
+
+
+def test_monitor_reorg():
+    chain = StandInChain()
+    sdk = kin.TokenSDK(provider=chain, confirmations=2)
+    calls = []
+    tx_a, tx_b, tx_c = ['0x%064x' % n for n in (0xa, 0xb, 0xc)]
+    with sdk.monitor_ether_transactions(lambda *args: calls.append(args[:2]), to_address=ROPSTEN_ADDRESS):
+        # a block is reported once the next block is on top of it
+        chain.mine(1, [tx_a])
+        chain.mine(2, [tx_b])
+        wait_for(lambda: calls)
+        chain.mine(3)
+        wait_for(lambda: len(calls) == 2)
+        assert calls == [(tx_a, kin.TransactionStatus.SUCCESS), (tx_b, kin.TransactionStatus.SUCCESS)]
+
+        # a fork from block 1 orphans the confirmed block 2: its transaction is rolled back, and reported again
+        # once confirmed in the new chain
+        chain.mine(2, [tx_c], fork=1, announce=False)
+        chain.mine(3, fork=1, parent_fork=1, announce=False)
+        chain.mine(4, [tx_b], fork=1, parent_fork=1)
+        wait_for(lambda: len(calls) == 4)
+        assert calls[2:] == [(tx_b, kin.TransactionStatus.ROLLED_BACK), (tx_c, kin.TransactionStatus.SUCCESS)]
+        assert sdk.get_monitoring_stats()['reorgs'] == 1
+
+        chain.mine(5, fork=1, parent_fork=1)
+        wait_for(lambda: len(calls) == 5)
+        assert calls[4] == (tx_b, kin.TransactionStatus.SUCCESS)
+    sdk.close()
+
+
 def test_monitor_ether_transactions(test_sdk, testnet):
     tx_statuses = {}
 
@@ -366,3 +738,33 @@ def test_monitor_token_transactions(test_sdk, testnet):
     assert tx_status == kin.TransactionStatus.SUCCESS
     tx_data = test_sdk.get_transaction_data(tx_id)
     assert tx_data.num_confirmations == 1
+
+
+def test_monitor_lifecycle(testnet):
+    sdk = kin.TokenSDK(private_key=testnet.private_key, provider_endpoint_uri=testnet.provider_endpoint_uri,
+                       contract_address=testnet.contract_address, contract_abi=testnet.contract_abi)
+    with sdk:
+        calls = []
+        monitors = [sdk.monitor_ether_transactions(lambda *args: calls.append(args), from_address=testnet.address)
+                    for _ in range(10)]
+        stats = sdk.get_monitoring_stats()
+        assert stats['monitors'] == 10
+        assert stats['threads'] == 2  # the filter poller and the pending transaction ingestor, for all monitors
+        assert stats['filters'] == 2
+
+        for monitor in monitors[1:]:
+            monitor.stop()
+        assert sdk.get_monitoring_stats()['monitors'] == 1
+
+        # stopping the last monitor uninstalls the filters
+        with monitors[0]:
+            pass
+        stats = sdk.get_monitoring_stats()
+        assert stats['monitors'] == 0 and stats['filters'] == 0
+
+        # monitoring again starts over
+        sdk.monitor_token_transactions(lambda *args: None, to_address=testnet.address)
+        assert sdk.get_monitoring_stats()['filters'] == 2
+
+    stats = sdk.get_monitoring_stats()
+    assert stats['monitors'] == stats['threads'] == stats['filters'] == 0
@@ -0,0 +1,357 @@
+import json
+import threading
+from time import sleep, time
+
+import pytest
+
+from kin.exceptions import SdkNotConfiguredError
+from kin.send_queue import (
+    CONFIRMED,
+    FAILED,
+    SENT,
+    SIGNED,
+    NonceAuditor,
+    SendQueue,
+    WriteAheadLog,
+)
+
+
+ADDRESS = '0x4c6527c2BEB032D46cfe0648072cAb641cA0aA81'
+RECIPIENT = '0x8B455Ab06C6F7ffaD9fDbA11776E2115f1DE14BD'
+TOKEN_ADDRESS = '0xEF2Fcc998847DB203DEa15fC49d0872C7614910C'
+
+
+class Node(object):
+    """A stand-in for the node, keeping the transactions sent by a single account."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pool = {}  # tx_id -> nonce
+        self.mined = {}  # tx_id -> nonce
+        self.sent = []  # raw transactions, in order of arrival
+        self.error = None
+        self.nonce_errors = {}  # nonce -> error raised for the first transaction sent with that nonce
+        self.rejected = {}  # nonce -> the id of the transaction rejected with the nonce error
+        self.lost_responses = 0  # transactions mined right away, whose responses are lost
+
+    def getTransactionCount(self, address, block):
+        with self.lock:
+            count = max(self.mined.values()) + 1 if self.mined else 0
+            if block == 'pending':  # pooled transactions after a nonce gap are not counted
+                nonces = set(self.pool.values())
+                while count in nonces:
+                    count += 1
+            return count
+
+    def getTransaction(self, tx_id):
+        with self.lock:
+            if tx_id in self.mined:
+                return {'hash': tx_id, 'blockNumber': 1}
+            if tx_id in self.pool:
+                return {'hash': tx_id, 'blockNumber': None}
+            return None
+
+    def sendRawTransaction(self, raw_tx):
+        with self.lock:
+            if self.error:
+                raise self.error
+            tx_id, nonce = raw_tx.split(':')
+            if int(nonce) in self.nonce_errors and self.rejected.setdefault(int(nonce), tx_id) == tx_id:
+                raise self.nonce_errors[int(nonce)]
+            self.sent.append(raw_tx)
+            if tx_id in self.mined:
+                raise ValueError({'code': -32000, 'message': 'nonce too low'})
+            if tx_id in self.pool:
+                raise ValueError({'code': -32000, 'message': 'known transaction: ' + tx_id})
+            if self.lost_responses:
+                self.lost_responses -= 1
+                self.mined[tx_id] = int(nonce)
+                raise IOError('read timed out')
+            self.pool[tx_id] = int(nonce)
+            return tx_id
+
+    def drop(self, tx_id):
+        with self.lock:
+            del self.pool[tx_id]
+
+    def mine(self):
+        with self.lock:
+            self.mined.update(self.pool)
+            self.pool.clear()
+
+
+class Sdk(object):
+    """A stand-in for the SDK, signing transactions as '<tx_id>:<nonce>'."""
+
+    def __init__(self, node, address=ADDRESS):
+        self.address = address
+        self.web3 = type('Web3', (object,), {'eth': node})()
+        self.token_contract = type('Contract', (object,), {'address': TOKEN_ADDRESS})()
+        self.signed = 0
+        self.invalidated = set()
+
+    def _to_base_units(self, amount):
+        if amount <= 0:
+            raise ValueError('amount must be positive')
+        return amount
+
+    def _encode_token_transfer(self, address, value):
+        return '{}:{}'.format(address, value)
+
+    def _invalidate_balances(self, *addresses):
+        self.invalidated.update(addresses)
+
+    def _sign_transaction(self, address, value, data, nonce):
+        self.signed += 1
+        tx_id = '0x{:x}{:x}'.format(hash((address, value, data)) & 0xffffffff, nonce)
+        return tx_id, '{}:{}'.format(tx_id, nonce)
+
+
+def wait_for(condition, timeout=5):
+    deadline = time() + timeout
+    while not condition():
+        if time() > deadline:
+            return False
+        sleep(0.001)
+    return True
+
+
+def test_wal(tmpdir):
+    path = str(tmpdir.join('wal'))
+    wal = WriteAheadLog(path)
+    assert wal.load() == []
+    wal.append([{'op': 'signed', 'tx_id': '0x1'}, {'op': 'signed', 'tx_id': '0x2'}])
+    wal.append([{'op': 'sent', 'tx_id': '0x1'}], sync=False)
+    wal.close()
+
+    # simulate a crash in the middle of a write
+    with open(path, 'a') as f:
+        f.write('{"op": "sent", "tx')
+    assert [record['tx_id'] for record in WriteAheadLog(path).load()] == ['0x1', '0x2', '0x1']
+
+    wal.rewrite([{'op': 'signed', 'tx_id': '0x3'}])
+    assert WriteAheadLog(path).load() == [{'op': 'signed', 'tx_id': '0x3'}]
+
+
+def test_create_fail(tmpdir):
+    with pytest.raises(SdkNotConfiguredError, message='address not configured'):
+        SendQueue(Sdk(Node(), address=None), str(tmpdir.join('wal')))
+
+
+def test_send(tmpdir):
+    node = Node()
+    node.pool['0xother'] = 0  # a transaction sent outside the queue
+    sdk = Sdk(node)
+    send_queue = SendQueue(sdk, str(tmpdir.join('wal')))
+    with pytest.raises(ValueError, message='send queue not started'):
+        send_queue.send_tokens(RECIPIENT, 1)
+    send_queue.start()
+    try:
+        with pytest.raises(ValueError, message='amount must be positive'):
+            send_queue.send_tokens_many([(RECIPIENT, 1, None), (RECIPIENT, 0, None)])
+        assert send_queue.stats()['next_nonce'] == 1  # nothing was queued
+
+        tx_ids = send_queue.send_tokens_many([(RECIPIENT, amount, None) for amount in range(1, 11)])
+        tx_ids.append(send_queue.send_ether(RECIPIENT, 5))
+        assert len(set(tx_ids)) == 11
+        assert wait_for(lambda: send_queue.stats()[SENT] == 11)
+    finally:
+        send_queue.close()
+
+    # submitted in nonce order
+    assert [int(raw_tx.split(':')[1]) for raw_tx in node.sent] == list(range(1, 12))
+    assert send_queue.get_transaction_state(tx_ids[0]) == SENT
+    assert send_queue.get_transaction_state('0xother') is None
+    assert sdk.invalidated == set([ADDRESS, RECIPIENT])  # cached balances
+
+
+def test_idempotency_key(tmpdir):
+    node = Node()
+    sdk = Sdk(node)
+    send_queue = SendQueue(sdk, str(tmpdir.join('wal')))
+    send_queue.start()
+    try:
+        tx_id = send_queue.send_tokens(RECIPIENT, 10, key='payment-1')
+        assert send_queue.send_tokens(RECIPIENT, 10, key='payment-1') == tx_id
+        tx_ids = send_queue.send_tokens_many([(RECIPIENT, 20, 'payment-2'), (RECIPIENT, 20, 'payment-2'),
+                                              (RECIPIENT, 10, 'payment-1')])
+        assert tx_ids[0] == tx_ids[1] and tx_ids[2] == tx_id
+        assert sdk.signed == 2
+    finally:
+        send_queue.close()
+
+
+def test_recover(tmpdir):
+    path = str(tmpdir.join('wal'))
+    node = Node()
+    sdk = Sdk(node)
+
+    # sign and log, but crash before submitting anything
+    send_queue = SendQueue(sdk, path)
+    send_queue.recover()
+    tx_ids = send_queue.send_tokens_many([(RECIPIENT, amount, 'payment-{}'.format(amount)) for amount in (1, 2, 3)])
+    send_queue.wal.close()
+    assert node.sent == []
+
+    # the first one did reach the node and got mined, the second one is in the pool
+    node.sendRawTransaction('{}:0'.format(tx_ids[0]))
+    node.mine()
+    node.sendRawTransaction('{}:1'.format(tx_ids[1]))
+
+    send_queue = SendQueue(sdk, path)
+    send_queue.start()
+    try:
+        assert send_queue.get_transaction_state(tx_ids[0]) == CONFIRMED
+        # payments retried after the crash are not sent again
+        assert send_queue.send_tokens(RECIPIENT, 3, key='payment-3') == tx_ids[2]
+        new_tx_id = send_queue.send_tokens(RECIPIENT, 4, key='payment-4')
+        assert wait_for(lambda: send_queue.stats()[SENT] == 3)
+        assert send_queue.stats()['next_nonce'] == 4
+    finally:
+        send_queue.close()
+    assert node.getTransaction(tx_ids[2]) and node.getTransaction(new_tx_id)
+
+    # the log is compacted on recovery, dropping the raw transactions of confirmed ones
+    records = [json.loads(line) for line in open(path)]
+    signed = dict((record['tx_id'], record) for record in records if record['op'] == SIGNED)
+    assert 'raw' not in signed[tx_ids[0]]
+    assert 'raw' in signed[tx_ids[2]]
+
+
+def test_recover_nonce_taken(tmpdir):
+    path = str(tmpdir.join('wal'))
+    node = Node()
+    sdk = Sdk(node)
+    send_queue = SendQueue(sdk, path)
+    send_queue.recover()
+    tx_id = send_queue.send_tokens(RECIPIENT, 1)
+    send_queue.wal.close()
+
+    # another transaction with the same nonce was mined meanwhile
+    node.sendRawTransaction('0xother:0')
+    node.mine()
+
+    send_queue = SendQueue(sdk, path)
+    send_queue.start()
+    try:
+        assert send_queue.get_transaction_state(tx_id) == FAILED
+        assert send_queue.stats()['next_nonce'] == 1
+    finally:
+        send_queue.close()
+
+
+def test_rejected(tmpdir):
+    node = Node()
+    node.error = ValueError({'code': -32000, 'message': 'nonce too low'})
+    send_queue = SendQueue(Sdk(node), str(tmpdir.join('wal')))
+    send_queue.start()
+    try:
+        tx_id = send_queue.send_ether(RECIPIENT, 1)
+        assert wait_for(lambda: send_queue.get_transaction_state(tx_id) == FAILED)
+
+        # the failed transaction did not use its nonce
+        assert send_queue.nonce_snapshot() == ({}, 1)
+        with pytest.raises(ValueError, message='transaction 0x1 is not in the queue'):
+            send_queue.resubmit('0x1')
+    finally:
+        send_queue.close()
+
+
+def test_rejected_unknown(tmpdir):
+    node = Node()
+    node.error = ValueError({'code': -32000, 'message': 'unknown account'})
+    send_queue = SendQueue(Sdk(node), str(tmpdir.join('wal')))
+    send_queue.start()
+    try:
+        # not to be taken for a 'known transaction' error
+        tx_id = send_queue.send_ether(RECIPIENT, 1)
+        assert wait_for(lambda: send_queue.get_transaction_state(tx_id) == FAILED)
+    finally:
+        send_queue.close()
+
+
+def test_close_node_down(tmpdir):
+    node = Node()
+    node.error = IOError('connection refused')
+    path = str(tmpdir.join('wal'))
+    send_queue = SendQueue(Sdk(node), path)
+    send_queue.start()
+    tx_id = send_queue.send_ether(RECIPIENT, 1)
+    start = time()
+    send_queue.close(timeout=0.2)  # does not wait for the node forever
+    assert time() - start < 2
+    assert send_queue.get_transaction_state(tx_id) == SIGNED
+
+    # the transaction is submitted once the queue is started again
+    node.error = None
+    send_queue = SendQueue(Sdk(node), path)
+    send_queue.start()
+    try:
+        assert wait_for(lambda: send_queue.get_transaction_state(tx_id) == SENT)
+    finally:
+        send_queue.close()
+
+
+def test_nonce_too_low_mined(tmpdir):
+    node = Node()
+    node.lost_responses = 1
+    send_queue = SendQueue(Sdk(node), str(tmpdir.join('wal')))
+    send_queue.start()
+    try:
+        # the first attempt was mined, but its response was lost: the retry is rejected for its nonce
+        tx_id = send_queue.send_ether(RECIPIENT, 1)
+        assert wait_for(lambda: send_queue.get_transaction_state(tx_id) == SENT)
+        assert len(node.sent) == 2
+    finally:
+        send_queue.close()
+
+
+def test_nonce_audit(tmpdir):
+    node = Node()
+    send_queue = SendQueue(Sdk(node), str(tmpdir.join('wal')))
+    send_queue.start()
+    auditor = NonceAuditor(send_queue)
+    try:
+        tx_ids = send_queue.send_tokens_many([(RECIPIENT, amount, None) for amount in (1, 2, 3)])
+        assert wait_for(lambda: send_queue.stats()[SENT] == 3)
+        assert auditor.audit() == []
+
+        # the node dropped a transaction, holding the later one back
+        node.drop(tx_ids[1])
+        assert node.getTransactionCount(ADDRESS, 'pending') == 1
+        assert auditor.audit() == [1]
+        assert wait_for(lambda: node.getTransactionCount(ADDRESS, 'pending') == 3)
+        stats = auditor.stats()
+        assert stats['gaps'] == 1 and stats['resubmitted'] == 1 and stats['blocked_for'] > 0
+        assert stats['last_audit'] == {'confirmed_count': 0, 'pending_count': 1, 'next_nonce': 3}
+
+        assert auditor.audit() == []
+        stats = auditor.stats()
+        assert stats['blocked_for'] == 0 and stats['blocked_time'] > 0
+    finally:
+        send_queue.close()
+
+
+def test_nonce_audit_fill(tmpdir):
+    node = Node()
+    sdk = Sdk(node)
+    send_queue = SendQueue(sdk, str(tmpdir.join('wal')))
+    send_queue.start()
+    auditor = NonceAuditor(send_queue, interval=0.01)
+    auditor.start()
+    try:
+        # a transaction rejected after its nonce was reserved leaves a gap
+        node.error = ValueError({'code': -32000, 'message': 'insufficient funds'})
+        tx_id = send_queue.send_ether(RECIPIENT, 1)
+        assert wait_for(lambda: send_queue.get_transaction_state(tx_id) == FAILED)
+        node.error = None
+        send_queue.send_ether(RECIPIENT, 2)
+
+        # filled with a transfer to self
+        assert wait_for(lambda: node.getTransactionCount(ADDRESS, 'pending') == 2)
+        assert auditor.stats()['filled'] == 1
+        assert send_queue.stats()[SENT] == 2
+        assert node.sent[-1].endswith(':0')
+    finally:
+        auditor.stop()
+        send_queue.close()
@@ -0,0 +1,270 @@
+import multiprocessing
+import os
+import threading
+from time import sleep, time
+
+import pytest
+
+from kin import sharding
+from kin.sdk import TransactionStatus
+from kin.sharding import ShardedTokenMonitor
+
+TOKEN_ADDRESS = '0x' + 'ee' * 20
+ADDRESS_A = '0x' + '11' * 20
+ADDRESS_B = '0x' + '33' * 20  # owned by the other worker
+ADDRESS_C = '0x' + '22' * 20
+ADDRESS_D = '0x' + '44' * 20
+
+_events = multiprocessing.Queue()
+_release = multiprocessing.Event()
+
+
+def record_event(*args):
+    _events.put(args)
+
+
+def record_worker(address, *args):
+    _events.put((address, os.getpid()))
+
+
+def blocked_callback(*args):
+    _release.wait()
+
+
+def busy_callback(*args):
+    deadline = time() + 0.002  # a CPU bound callback
+    while time() < deadline:
+        pass
+
+
+def get_events(count):
+    events = [_events.get(timeout=5) for _ in range(count)]
+    assert _events.empty()
+    return sorted(events)
+
+
+def block_hash(number, fork=0):
+    return '0x%062x%02x' % (number, fork)
+
+
+def transfer(tx_id, from_address, to_address, amount):
+    return {
+        'hash': '0x%064x' % tx_id,
+        'from': from_address,
+        'to': TOKEN_ADDRESS,
+        'gas': '0x15f90',
+        'input': '0xa9059cbb' + '0' * 24 + to_address[2:] + '%064x' % amount,
+    }
+
+
+def make_block(number, txs, fork=0, parent_fork=0):
+    return {
+        'number': number,
+        'hash': block_hash(number, fork),
+        'parentHash': block_hash(number - 1, parent_fork),
+        'transactions': txs,
+    }
+
+
+class Node(object):
+    """A stand-in node serving blocks, receipts and a block filter."""
+
+    def __init__(self):
+        self.blocks = {}
+        self.failed_txs = set()
+        self.missing_receipts = set()
+        self.new_blocks = []
+        self.filters = set()
+
+    def make_request(self, method, params):
+        if method == 'eth_getTransactionReceipt':
+            result = {'status': '0x0' if params[0] in self.failed_txs else '0x1'}
+            if params[0] in self.missing_receipts:
+                result = None
+        elif method == 'eth_getBlockByHash':
+            result = self.blocks.get(params[0])
+        elif method == 'eth_newBlockFilter':
+            self.filters.add('0x1')
+            result = '0x1'
+        elif method == 'eth_getFilterChanges':
+            result, self.new_blocks = self.new_blocks, []
+        elif method == 'eth_uninstallFilter':
+            self.filters.discard(params[0])
+            result = True
+        else:
+            raise ValueError('unexpected method: ' + method)
+        return {'jsonrpc': '2.0', 'id': 1, 'result': result}
+
+    def add(self, block):
+        self.blocks[block['hash']] = block
+        self.new_blocks.append(block['hash'])
+
+
+def test_create_fail():
+    with pytest.raises(ValueError, message='number of workers must be positive'):
+        ShardedTokenMonitor(Node(), record_event, TOKEN_ADDRESS, num_workers=0)
+    with pytest.raises(ValueError, message='confirmations must be positive'):
+        ShardedTokenMonitor(Node(), record_event, TOKEN_ADDRESS, confirmations=0)
+
+
+def test_sharded_monitor():
+    node = Node()
+    monitor = ShardedTokenMonitor(node, record_event, TOKEN_ADDRESS, num_workers=2, base_units=True)
+    monitor.watch(ADDRESS_A, ADDRESS_B)
+    monitor.start(poll=False)
+
+    node.failed_txs.add('0x%064x' % 2)
+    monitor.add_block(make_block(1, [
+        transfer(1, ADDRESS_A, ADDRESS_C, 5),
+        transfer(2, ADDRESS_C, ADDRESS_B, 7),
+        transfer(3, ADDRESS_C, ADDRESS_D, 9),  # not watched
+        dict(transfer(4, ADDRESS_A, ADDRESS_B, 1), to=ADDRESS_D),  # not a token transaction
+    ]))
+    assert get_events(2) == [
+        (ADDRESS_A, '0x%064x' % 1, TransactionStatus.SUCCESS, ADDRESS_A, ADDRESS_C, 5),
+        (ADDRESS_B, '0x%064x' % 2, TransactionStatus.FAIL, ADDRESS_C, ADDRESS_B, 7),
+    ]
+
+    # a transfer between two watched addresses is reported to both
+    monitor.add_block(make_block(2, [transfer(5, ADDRESS_A, ADDRESS_B, 3)]))
+    event = ('0x%064x' % 5, TransactionStatus.SUCCESS, ADDRESS_A, ADDRESS_B, 3)
+    assert get_events(2) == [(ADDRESS_A,) + event, (ADDRESS_B,) + event]
+
+    # block 2 is orphaned
+    monitor.add_block(make_block(2, [], fork=1))
+    rolled_back = ('0x%064x' % 5, TransactionStatus.ROLLED_BACK, ADDRESS_A, ADDRESS_B, 3)
+    assert get_events(2) == [(ADDRESS_A,) + rolled_back, (ADDRESS_B,) + rolled_back]
+
+    monitor.unwatch(ADDRESS_A)
+    monitor.add_block(make_block(3, [transfer(6, ADDRESS_A, ADDRESS_C, 2)], parent_fork=1))
+    monitor.close()
+    assert _events.empty()
+
+    stats = monitor.stats()
+    assert stats['workers'] == 0
+    assert stats['addresses'] == 1
+    assert stats['blocks'] == 4
+    assert stats['transfers'] == 3
+    assert stats['reorgs'] == 1
+    assert [shard['addresses'] for shard in stats['shards']] == [0, 1]
+    assert [shard['records'] for shard in stats['shards']] == [3, 3]
+    assert [shard['delivered'] for shard in stats['shards']] == [3, 3]
+    assert [shard['failed'] for shard in stats['shards']] == [0, 0]
+
+
+def test_sharded_monitor_poll():
+    node = Node()
+    with ShardedTokenMonitor(node, record_event, TOKEN_ADDRESS, num_workers=2, confirmations=2) as monitor:
+        monitor.watch(ADDRESS_C)
+        monitor.start()
+        assert node.filters == set(['0x1'])
+        node.add(make_block(1, [transfer(1, ADDRESS_A, ADDRESS_C, 10 ** 18)]))
+        node.add(make_block(2, []))
+        assert get_events(1) == [(ADDRESS_C, '0x%064x' % 1, TransactionStatus.SUCCESS, ADDRESS_A, ADDRESS_C, 1)]
+    assert node.filters == set()
+
+
+def test_sharded_monitor_missing_receipt(monkeypatch):
+    monkeypatch.setattr(sharding, 'RECEIPT_WAIT_BLOCKS', 2)
+    node = Node()
+    monitor = ShardedTokenMonitor(node, record_event, TOKEN_ADDRESS, num_workers=2, base_units=True)
+    monitor.watch(ADDRESS_A, ADDRESS_B)
+    monitor.start(poll=False)
+
+    # a transfer is reported once the node has its receipt
+    node.missing_receipts.update(['0x%064x' % 1, '0x%064x' % 3])
+    monitor.add_block(make_block(1, [transfer(1, ADDRESS_A, ADDRESS_C, 5), transfer(2, ADDRESS_C, ADDRESS_B, 7)]))
+    assert get_events(1) == [(ADDRESS_B, '0x%064x' % 2, TransactionStatus.SUCCESS, ADDRESS_C, ADDRESS_B, 7)]
+    node.missing_receipts.discard('0x%064x' % 1)
+    monitor.add_block(make_block(2, [transfer(3, ADDRESS_C, ADDRESS_B, 1)]))
+    assert get_events(1) == [(ADDRESS_A, '0x%064x' % 1, TransactionStatus.SUCCESS, ADDRESS_A, ADDRESS_C, 5)]
+
+    # or with an unknown status after waiting for it
+    monitor.add_block(make_block(3, []))
+    monitor.add_block(make_block(4, []))
+    assert get_events(1) == [(ADDRESS_B, '0x%064x' % 3, TransactionStatus.UNKNOWN, ADDRESS_C, ADDRESS_B, 1)]
+    monitor.close()
+    assert monitor.stats()['transfers'] == 3
+
+
+def test_sharded_monitor_dead_worker():
+    monitor = ShardedTokenMonitor(Node(), record_event, TOKEN_ADDRESS, num_workers=2, base_units=True)
+    monitor.watch(ADDRESS_A, ADDRESS_B)
+    monitor.start(poll=False)
+    monitor._processes[0].terminate()  # the worker of ADDRESS_A
+    monitor._processes[0].join()
+
+    # the transfers of the other shard are still reported
+    monitor.add_block(make_block(1, [transfer(1, ADDRESS_A, ADDRESS_C, 5), transfer(2, ADDRESS_C, ADDRESS_B, 7)]))
+    assert get_events(1) == [(ADDRESS_B, '0x%064x' % 2, TransactionStatus.SUCCESS, ADDRESS_C, ADDRESS_B, 7)]
+    monitor.add_block(make_block(2, [transfer(3, ADDRESS_A, ADDRESS_C, 1)]))
+    monitor.close()
+    assert _events.empty()
+    assert [shard['lost'] for shard in monitor.stats()['shards']] == [2, 0]
+
+
+def test_sharded_monitor_slow_worker():
+    monitor = ShardedTokenMonitor(Node(), blocked_callback, TOKEN_ADDRESS, num_workers=2, base_units=True)
+    monitor.watch(ADDRESS_A)
+    monitor.start(poll=False)
+    # more records than the pipe buffer holds, while the worker is blocked in a callback
+    block = make_block(1, [transfer(i, ADDRESS_A, ADDRESS_C, 1) for i in range(1000)])
+    ingestion = threading.Thread(target=monitor.add_block, args=(block,))
+    ingestion.start()
+    try:
+        deadline = time() + 5
+        while monitor.stats()['shards'][0]['records'] < 1000:
+            assert time() < deadline
+            sleep(0.01)
+        assert ingestion.is_alive()  # blocked on the full pipe, without blocking the monitor
+        monitor.watch(ADDRESS_B)
+        assert monitor.stats()['addresses'] == 2
+    finally:
+        _release.set()
+    ingestion.join(5)
+    monitor.close()
+    _release.clear()
+    assert sum(shard['delivered'] for shard in monitor.stats()['shards']) == 1000
+
+
+def test_sharded_monitor_distribution():
+    monitor = ShardedTokenMonitor(Node(), record_worker, TOKEN_ADDRESS, num_workers=4, base_units=True)
+    addresses = ['0x%040x' % i for i in range(1, 101)]
+    monitor.watch(*addresses)
+    monitor.start(poll=False)
+    monitor.add_block(make_block(1, [transfer(i, ADDRESS_C, addresses[i % len(addresses)], 1) for i in range(400)]))
+    events = get_events(400)
+    monitor.close()
+
+    # every worker has a share of the addresses and of the work, and each address is owned by a single worker
+    workers = {}
+    for address, pid in events:
+        workers.setdefault(address, set()).add(pid)
+    assert all(len(pids) == 1 for pids in workers.values())
+    assert len(set(pid for address, pid in events)) == 4
+    shards = monitor.stats()['shards']
+    assert sum(shard['addresses'] for shard in shards) == 100
+    assert sum(shard['delivered'] for shard in shards) == 400
+    assert all(shard['delivered'] >= 50 for shard in shards)
+    assert [shard['delivered'] for shard in shards] == [shard['addresses'] * 4 for shard in shards]
+
+
+def callback_time(num_workers, addresses, txs):
+    monitor = ShardedTokenMonitor(Node(), busy_callback, TOKEN_ADDRESS, num_workers=num_workers, base_units=True)
+    monitor.watch(*addresses)
+    monitor.start(poll=False)
+    start = time()
+    monitor.add_block(make_block(1, txs))
+    monitor.close()  # waits for the workers to call back on all the transfers
+    elapsed = time() - start
+    assert sum(shard['delivered'] for shard in monitor.stats()['shards']) == len(txs)
+    return elapsed
+
+
+@pytest.mark.skipif(multiprocessing.cpu_count() < 2, reason='needs several cores')
+def test_sharded_monitor_scaling():
+    addresses = ['0x%040x' % i for i in range(1, 101)]
+    txs = [transfer(i, ADDRESS_C, addresses[i % len(addresses)], 1) for i in range(400)]
+    one_worker = callback_time(1, addresses, txs)
+    two_workers = callback_time(2, addresses, txs)
+    assert two_workers < 0.75 * one_worker
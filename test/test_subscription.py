@@ -0,0 +1,299 @@
+import json
+import os
+import socket
+import tempfile
+import threading
+from time import sleep, time
+
+import pytest
+
+from web3.providers.base import BaseProvider
+
+import kin
+from kin import subscription
+from kin.subscription import (
+    NEW_HEADS,
+    NEW_PENDING_TRANSACTIONS,
+    SubscriptionClient,
+)
+
+SENDER = '0x8b455ab06c6f7ffad9fdba11776e2115f1de14bd'
+RECIPIENT = '0x4c6527c2beb032d46cfe0648072cab641ca0aa80'
+
+
+def block_hash(number):
+    return '0x%064x' % number
+
+
+def header(number):
+    return {'number': '0x%x' % number, 'hash': block_hash(number), 'parentHash': block_hash(number - 1)}
+
+
+def transaction(tx_id, block_number=None):
+    return {'hash': tx_id, 'from': SENDER, 'to': RECIPIENT, 'value': '0x1', 'input': '0x', 'nonce': '0x1',
+            'gas': '0x5208', 'gasPrice': '0x1',
+            'blockNumber': '0x%x' % block_number if block_number else None,
+            'blockHash': block_hash(block_number) if block_number else None,
+            'transactionIndex': '0x0' if block_number else None}
+
+
+class StandInNode(object):
+    """A stand-in for a node IPC endpoint: answers the subscription calls and pushes notifications."""
+
+    def __init__(self, path):
+        self.path = path
+        self.head = 0
+        self.connection = None
+        self.subscriptions = {}  # kind -> subscription id
+        self.connected = threading.Event()
+        self.batches = 0
+        self.txs = {}  # transaction hash -> transaction
+        self.block_txs = {}  # block number -> transactions
+
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen(5)
+        thread = threading.Thread(target=self._accept)
+        thread.daemon = True
+        thread.start()
+
+    def _accept(self):
+        while True:
+            try:
+                connection, _ = self.server.accept()
+            except socket.error:
+                return
+            self.connection = connection
+            self.subscriptions = {}
+            thread = threading.Thread(target=self._serve, args=(connection,))
+            thread.daemon = True
+            thread.start()
+
+    def _serve(self, connection):
+        decoder = json.JSONDecoder()
+        buf = ''
+        while True:
+            try:
+                data = connection.recv(65536)
+            except socket.error:
+                return
+            if not data:
+                return
+            buf += data.decode('utf-8')
+            while buf:
+                try:
+                    request, end = decoder.raw_decode(buf)
+                except ValueError:
+                    break
+                buf = buf[end:]
+                if isinstance(request, list):
+                    self.batches += 1
+                    self._send(connection, [self._respond(r) for r in request])
+                else:
+                    self._send(connection, self._respond(request))
+
+    def _respond(self, request):
+        return {'jsonrpc': '2.0', 'id': request['id'], 'result': self.answer(request['method'], request['params'])}
+
+    def answer(self, method, params):
+        if method == 'eth_subscribe':
+            subscription_id = '0x%x' % (len(self.subscriptions) + 1)
+            self.subscriptions[params[0]] = subscription_id
+            if params[0] == NEW_HEADS:
+                self.connected.set()
+            return subscription_id
+        if method == 'eth_blockNumber':
+            return '0x%x' % self.head
+        if method == 'eth_getBlockByNumber':
+            return header(int(params[0], 16))
+        if method == 'eth_getBlockByHash':
+            block = header(int(params[0], 16))
+            block['transactions'] = self.block_txs.get(int(params[0], 16), [])
+            return block
+        if method == 'eth_getTransactionByHash':
+            return self.txs.get(params[0])
+        raise ValueError('unexpected method ' + method)
+
+    @staticmethod
+    def _send(connection, message):
+        connection.sendall(json.dumps(message).encode('utf-8'))
+
+    def notify(self, kind, result):
+        self._send(self.connection, {'jsonrpc': '2.0', 'method': 'eth_subscription',
+                                     'params': {'subscription': self.subscriptions[kind], 'result': result}})
+
+    def send_transaction(self, tx_id):
+        self.txs[tx_id] = transaction(tx_id)
+        self.notify(NEW_PENDING_TRANSACTIONS, tx_id)
+
+    def mine(self, push=True, tx_ids=()):
+        self.head += 1
+        self.block_txs[self.head] = [transaction(tx_id, self.head) for tx_id in tx_ids]
+        for tx in self.block_txs[self.head]:
+            self.txs[tx['hash']] = tx
+        if push:
+            self.notify(NEW_HEADS, header(self.head))
+
+    def send_raw(self, data):
+        self.connection.sendall(data)
+
+    def drop(self):
+        self.connected.clear()
+        self.connection.shutdown(socket.SHUT_RDWR)
+        self.connection.close()
+
+    def close(self):
+        self.server.close()
+
+
+@pytest.fixture
+def node():
+    path = os.path.join(tempfile.mkdtemp(), 'node.ipc')
+    _node = StandInNode(path)
+    yield _node
+    _node.close()
+    os.remove(path)
+
+
+@pytest.fixture
+def client(node):
+    _client = SubscriptionClient(node.path, timeout=5, reconnect_delay=0.05)
+    _client.start()
+    yield _client
+    _client.close()
+
+
+def wait_for(condition, timeout=5):
+    deadline = time() + timeout
+    while not condition():
+        if time() > deadline:
+            return False
+        sleep(0.001)
+    return True
+
+
+def test_subscribe_new_heads(node, client):
+    headers = []
+    client.subscribe(NEW_HEADS, headers.append)
+    assert node.connected.wait(5)
+
+    for _ in range(3):
+        node.mine()
+    assert wait_for(lambda: len(headers) == 3)
+    assert [int(header['number'], 16) for header in headers] == [1, 2, 3]
+
+
+def test_subscribe_pending_transactions(node, client):
+    tx_ids = []
+    client.subscribe(NEW_HEADS, lambda header: None)
+    client.subscribe(NEW_PENDING_TRANSACTIONS, tx_ids.append)
+    assert node.connected.wait(5)
+
+    start = time()
+    node.notify(NEW_PENDING_TRANSACTIONS, '0xabc')
+    assert wait_for(lambda: tx_ids == ['0xabc'])
+    assert time() - start < 1  # pushed, not polled
+
+
+def test_shared_subscription(node, client):
+    headers1, headers2 = [], []
+    client.subscribe(NEW_HEADS, headers1.append)
+    client.subscribe(NEW_HEADS, headers2.append)
+    assert node.connected.wait(5)
+    assert len(node.subscriptions) == 1
+
+    node.mine()
+    assert wait_for(lambda: len(headers1) == 1 and len(headers2) == 1)
+
+
+def test_reconnect_fills_gap(node, client):
+    headers = []
+    client.subscribe(NEW_HEADS, headers.append)
+    assert node.connected.wait(5)
+
+    node.mine()
+    assert wait_for(lambda: len(headers) == 1)
+
+    # blocks produced while disconnected are never pushed
+    node.mine(push=False)
+    node.mine(push=False)
+    node.drop()
+    assert node.connected.wait(5)
+    assert wait_for(lambda: client.reconnects == 1)
+
+    node.mine()
+    assert wait_for(lambda: len(headers) == 4)
+    sleep(0.1)
+    assert [int(header['number'], 16) for header in headers] == [1, 2, 3, 4]
+    assert node.batches == 1  # the missed headers are fetched in a single batch
+
+
+def test_split_message(node, client):
+    tx_ids = []
+    client.subscribe(NEW_HEADS, lambda header: None)
+    client.subscribe(NEW_PENDING_TRANSACTIONS, tx_ids.append)
+    assert node.connected.wait(5)
+
+    # brackets and escaped quotes within strings do not end a message, even when split across reads
+    result = '0x"}]\\{'
+    message = json.dumps({'jsonrpc': '2.0', 'method': 'eth_subscription',
+                          'params': {'subscription': node.subscriptions[NEW_PENDING_TRANSACTIONS], 'result': result}})
+    split = message.index('\\') + 1
+    for part in (message[:split], message[split:] + message):
+        node.send_raw(part.encode('utf-8'))
+        sleep(0.05)  # separate reads
+    assert wait_for(lambda: tx_ids == [result, result])
+
+
+def test_malformed_message(node, client, monkeypatch):
+    headers = []
+    client.subscribe(NEW_HEADS, headers.append)
+    assert node.connected.wait(5)
+    node.connected.clear()
+
+    # the connection is reset instead of waiting for the rest of a message that never ends
+    node.send_raw(b'{"jsonrpc": "2.0", "method": x}')
+    assert node.connected.wait(5)
+    assert wait_for(lambda: client.reconnects == 1)
+    node.mine()
+    assert wait_for(lambda: len(headers) == 1)
+
+    # and so is it for a message too large to be buffered
+    monkeypatch.setattr(subscription, 'MAX_MESSAGE_SIZE', 1000)
+    node.connected.clear()
+    node.send_raw(b'{"jsonrpc": "2.0", "params": "' + b'x' * 1001)
+    assert node.connected.wait(5)
+    assert wait_for(lambda: client.reconnects == 2)
+
+
+class StandInProvider(BaseProvider):
+    """Serves the calls the SDK makes over its provider from a stand-in node."""
+
+    def __init__(self, node):
+        BaseProvider.__init__(self)
+        self.node = node
+
+    def make_request(self, method, params):
+        return {'jsonrpc': '2.0', 'id': 1, 'result': self.node.answer(method, params)}
+
+    def isConnected(self):
+        return True
+
+
+def test_sdk_subscription(node):
+    sdk = kin.TokenSDK(provider=StandInProvider(node), subscription_endpoint_uri=node.path)
+    calls = []
+    with sdk.monitor_ether_transactions(lambda *args: calls.append(args[:2]), to_address=RECIPIENT):
+        assert node.connected.wait(5)
+        stats = sdk.get_monitoring_stats()
+        assert stats['subscriptions'] == 2 and stats['filters'] == 0
+
+        # pending transactions and new blocks are pushed by the node
+        tx_id = '0x%064x' % 0xabc
+        node.send_transaction(tx_id)
+        assert wait_for(lambda: calls)
+        node.mine(tx_ids=[tx_id])
+        assert wait_for(lambda: len(calls) == 2)
+        assert calls == [(tx_id, kin.TransactionStatus.PENDING), (tx_id, kin.TransactionStatus.SUCCESS)]
+    assert sdk.get_monitoring_stats()['subscriptions'] == 0
+    sdk.close()
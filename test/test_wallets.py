@@ -0,0 +1,72 @@
+from binascii import unhexlify
+import json
+import shutil
+import threading
+
+import pytest
+
+import kin
+
+ROPSTEN_ADDRESS = '0x4c6527c2BEB032D46cfe0648072cAb641cA0aA80'
+ROPSTEN_PRIVATE_KEY = unhexlify('d60baaa34ed125af0570a3df7d4ad3e80dd5dc5070680573f8de0ecfc1977275')
+TEST_PASSWORD = 'password'
+TEST_KEYFILE = './test/test-wallet-keyfile.json'  # a keystore of the Ropsten private key
+
+
+@pytest.fixture
+def keyfiles(tmpdir):
+    paths = [str(tmpdir.join('keyfile-{}.json'.format(i))) for i in range(3)]
+    for path in paths:
+        shutil.copy(TEST_KEYFILE, path)
+    return paths
+
+
+def test_load_wallets(keyfiles):
+    progress = []
+    lock = threading.Lock()
+
+    def on_progress(done, total):
+        with lock:
+            progress.append((done, total))
+
+    wallets = kin.load_wallets(keyfiles, TEST_PASSWORD, num_workers=2, progress_fn=on_progress)
+    assert [wallet.keyfile for wallet in wallets] == keyfiles
+    assert all(wallet.unlocked for wallet in wallets)
+    assert all(wallet.address == ROPSTEN_ADDRESS for wallet in wallets)
+    assert all(wallet.private_key == ROPSTEN_PRIVATE_KEY for wallet in wallets)
+    assert sorted(progress) == [(1, 3), (2, 3), (3, 3)]
+    assert kin.load_wallets([], TEST_PASSWORD) == []
+
+
+def test_load_wallets_lazy(keyfiles):
+    passwords = {path: TEST_PASSWORD for path in keyfiles}
+    passwords[keyfiles[2]] = 'wrong'
+    wallets = kin.load_wallets(keyfiles, passwords, lazy=True)
+    assert wallets[0].private_key == ROPSTEN_PRIVATE_KEY
+    assert wallets[1].address == ROPSTEN_ADDRESS
+
+    # decryption errors are raised on first use
+    with pytest.raises(kin.SdkConfigurationError, message='keyfile decode error'):
+        wallets[2].private_key
+
+
+def test_load_wallets_fail(keyfiles, tmpdir):
+    with pytest.raises(kin.SdkConfigurationError, message='keyfile decode error'):
+        kin.load_wallets(keyfiles, 'wrong')
+
+    invalid = tmpdir.join('invalid.json')
+    invalid.write('not json')
+    with pytest.raises(kin.SdkConfigurationError, message='invalid json in keystore file'):
+        kin.load_wallets(keyfiles + [str(invalid)], TEST_PASSWORD)
+    invalid.write(json.dumps({'crypto': {}}))
+    with pytest.raises(kin.SdkConfigurationError, message='invalid keystore file'):
+        kin.load_wallets([str(invalid)], TEST_PASSWORD)
+
+    # a keystore whose address does not match its key
+    with open(keyfiles[0]) as f:
+        keystore = json.load(f)
+    keystore['address'] = '0' * 40
+    mismatch = tmpdir.join('mismatch.json')
+    mismatch.write(json.dumps(keystore))
+    with pytest.raises(kin.SdkConfigurationError, message='keyfile address mismatch'):
+        kin.load_wallets([str(mismatch)], TEST_PASSWORD)